@@ -1,4 +1,21 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
+
+
+def store_missing_concrete_types(sender, using='default', **kwargs):
+    # Runs after every app has been migrated, so the items of concept models
+    # from any app can be given their type, which migrations can't do.
+    from django.db import connections
+    from aristotle_mdr.models import _concept, store_missing_concrete_types
+    connection = connections[using]
+    table = _concept._meta.db_table
+    with connection.cursor() as cursor:
+        if table not in connection.introspection.table_names(cursor):
+            return
+        columns = [column.name for column in connection.introspection.get_table_description(cursor, table)]
+    # Migrating back to before the type was added leaves no column to fill.
+    if _concept._meta.get_field('_concrete_type').column in columns:
+        store_missing_concrete_types(using=using)
 
 
 class AristotleExtensionBaseConfig(AppConfig):
@@ -8,3 +25,10 @@ class AristotleExtensionBaseConfig(AppConfig):
 class AristotleMDRConfig(AristotleExtensionBaseConfig):
     name = 'aristotle_mdr'
     verbose_name = "Aristotle Metadata Registry"
+
+    def ready(self):
+        # Import every download module now, so misconfigured downloads are
+        # found at startup and requests don't need to import anything.
+        from aristotle_mdr import downloads
+        downloads.get_registry()
+        post_migrate.connect(store_missing_concrete_types, sender=self)
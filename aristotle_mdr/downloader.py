@@ -1,23 +1,59 @@
 # aristotle_ddi_utils
-from aristotle_mdr.utils import get_download_template_path_for_item
+from aristotle_mdr.utils import get_download_items_version, get_download_template_path_for_item, get_item_version
+from collections import deque
 import cgi
+import datetime
 import cStringIO as StringIO
-from django.http import HttpResponse, Http404
-# from django.shortcuts import render
+import hashlib
+import os
+import tempfile
+import time
+import zlib
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.db.models import Q
+from django.http import HttpResponse, Http404, StreamingHttpResponse
+from django.shortcuts import render
 from django.template.loader import select_template
 from django.template import Context
+from django.utils.encoding import force_bytes
+from django.utils.module_loading import import_string
 import xhtml2pdf.pisa as pisa
 import csv
 
+from aristotle_mdr import downloads, tasks
+from aristotle_mdr.exporter import Echo
 
-def render_to_pdf(template_src, context_dict):
+import logging
+logger = logging.getLogger(__name__)
+
+STREAMING_DOWNLOADS = ['csv-vd']
+CACHEABLE_DOWNLOADS = ['pdf']
+
+VALUE_CHUNK_SIZE = 1000
+# How long a failed PDF render is remembered before it is tried again.
+ERROR_CACHE_SECONDS = 60
+# How often a request waiting for a PDF checks the download cache for it.
+RENDER_POLL_SECONDS = 0.5
+
+
+def render_to_html(template_src, context_dict):
     # If the request template doesnt exist, we will give a default one.
     template = select_template([
         template_src,
         'aristotle_mdr/downloads/pdf/managedContent.html'
     ])
     context = Context(context_dict)
-    html = template.render(context)
+    return template.render(context)
+
+
+def html_to_pdf(html):
+    """
+    Converts the HTML of a download to a PDF, returning the PDF or ``None`` if
+    there were errors. This doesn't touch the database, so it is safe to run
+    in a separate process.
+    """
     result = StringIO.StringIO()
     pdf = pisa.pisaDocument(
         StringIO.StringIO(html.encode("UTF-8")),
@@ -25,43 +61,300 @@ def render_to_pdf(template_src, context_dict):
         encoding='UTF-8'
     )
     if not pdf.err:
-        return HttpResponse(result.getvalue(), content_type='application/pdf')
+        return result.getvalue()
+
+
+def pdf_error_response(html):
     return HttpResponse('We had some errors<pre>%s</pre>' % cgi.escape(html))
 
 
+def render_to_pdf(template_src, context_dict):
+    html = render_to_html(template_src, context_dict)
+    pdf = html_to_pdf(html)
+    if pdf is not None:
+        return HttpResponse(pdf, content_type='application/pdf')
+    return pdf_error_response(html)
+
+
+def get_setting(name, default):
+    return getattr(settings, 'ARISTOTLE_SETTINGS', {}).get(name, default)
+
+
+def get_download_cache():
+    """
+    Returns the storage that rendered downloads are cached in, as set by the
+    ``DOWNLOAD_CACHE_STORAGE`` and ``DOWNLOAD_CACHE_DIR`` options in
+    ``ARISTOTLE_SETTINGS``.
+    """
+    storage_class = get_setting('DOWNLOAD_CACHE_STORAGE', None)
+    if storage_class:
+        return import_string(storage_class)()
+    return FileSystemStorage(location=get_setting(
+        'DOWNLOAD_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'aristotle_mdr_downloads')
+    ))
+
+
+def pdf_cache_key(item, template, page_size, view, sub_items):
+    """
+    Returns the name a rendered PDF is cached under. This changes whenever
+    the item, its statuses or any of its download items are modified, and
+    each day so that statuses that start or end on a date are picked up.
+
+    Other items the PDF template shows, such as the data element concepts of
+    an object class, aren't part of the name, so changes to them only appear
+    once the item itself changes or the day ends. Items whose PDFs depend on
+    such items should include them in ``get_download_items``.
+    """
+    modified = [get_item_version(item), get_download_items_version(sub_items), datetime.date.today().isoformat()]
+    key = hashlib.sha1('|'.join([template, page_size, view] + modified).encode('utf-8')).hexdigest()
+    return 'pdf/%s/%s.pdf' % (item.pk, key)
+
+
+def get_render_error(storage, name):
+    """
+    Returns the HTML of a failed render of a PDF, if it failed in the last
+    ``ERROR_CACHE_SECONDS``. Older failures are removed so the PDF is rendered
+    again. Storages that can't tell how old a file is only keep a failure
+    until it has been shown once.
+    """
+    error_name = name + '.error.html'
+    if not storage.exists(error_name):
+        return None
+    try:
+        age = datetime.datetime.now() - storage.modified_time(error_name)
+        expired = age > datetime.timedelta(seconds=ERROR_CACHE_SECONDS)
+    except NotImplementedError:
+        age, expired = None, False
+    html = None
+    if not expired:
+        html = storage.open(error_name).read().decode('utf-8')
+    if expired or age is None:
+        storage.delete(error_name)
+    return html
+
+
+def _save_render(storage, name, html, pdf):
+    if pdf is not None:
+        storage.save(name, ContentFile(pdf))
+    else:
+        storage.save(name + '.error.html', ContentFile(html.encode('utf-8')))
+
+
+def render_pdf(name, item_id, template, page_size, view):
+    """
+    The deferred task that renders the PDF download of an item and saves it
+    to the download cache under ``name``. If rendering fails, the error is
+    saved in its place, so waiting requests show it instead of waiting for a
+    file that will never come.
+    """
+    from aristotle_mdr.models import _concept
+    storage = get_download_cache()
+    if storage.exists(name):
+        return
+    html = ''
+    try:
+        item = _concept.objects.get_subclass(pk=item_id)
+        html = render_to_html(template, pdf_context(item, page_size, view))
+        pdf = html_to_pdf(html)
+    except Exception:
+        logger.exception("Could not render the download '%s'" % name)
+        html, pdf = html or 'The download could not be created.', None
+    _save_render(storage, name, html, pdf)
+
+
+def _defer_render(template, context_dict, name):
+    # Keyed on the cache name, so a PDF is only rendered once however many
+    # requests for it come in, to any process, while it is waiting.
+    tasks.defer(
+        'aristotle_mdr.downloader.render_pdf', key='render_pdf_%s' % name,
+        name=name, item_id=context_dict['item'].pk, template=template,
+        page_size=context_dict['pagesize'], view=context_dict['view'],
+    )
+
+
+def _cached_response(storage, name):
+    """
+    Returns the response for a PDF, or the error from rendering it, if either
+    is in the download cache, otherwise ``None``.
+    """
+    if storage.exists(name):
+        return HttpResponse(storage.open(name).read(), content_type='application/pdf')
+    error_html = get_render_error(storage, name)
+    if error_html is not None:
+        return pdf_error_response(error_html)
+    return None
+
+
+def render_to_cached_pdf(request, template_src, context_dict, name):
+    """
+    Returns a PDF download from the download cache, rendering it if it isn't
+    there yet.
+
+    Rendering is done by a deferred task (see ``aristotle_mdr.tasks``), and the
+    request checks the download cache for the PDF for up to ``PDF_RENDER_WAIT``
+    seconds. If it isn't ready by then, a page asking the browser to check
+    back shortly is returned instead, and the PDF is served from the cache
+    once it is ready. With the ``'inline'`` ``DEFERRED_TASK_MODE`` the PDF is
+    rendered in the request.
+    """
+    storage = get_download_cache()
+    response = _cached_response(storage, name)
+    if response is not None:
+        return response
+
+    _defer_render(template_src, context_dict, name)
+    deadline = time.time() + get_setting('PDF_RENDER_WAIT', 5)
+    while True:
+        response = _cached_response(storage, name)
+        if response is not None:
+            return response
+        if time.time() >= deadline:
+            break
+        time.sleep(RENDER_POLL_SECONDS)
+    response = render(request, 'aristotle_mdr/downloads/preparing.html', {'item': context_dict.get('item')}, status=202)
+    response['Refresh'] = '5'
+    return response
+
+
+def pdf_context(item, page_size, view):
+    subItems = item.get_download_items()
+    return {
+        'item': item,
+        'subitems': subItems,
+        'tableOfContents': len(subItems) > 0,
+        'view': view,
+        'pagesize': page_size,
+    }
+
+
+def pdf_download(request, item):
+    """
+    Returns the template, context and cache name of the PDF download of an
+    item.
+    """
+    template = get_download_template_path_for_item(item, 'pdf')
+    context = pdf_context(
+        item,
+        request.GET.get('pagesize', getattr(settings, 'PDF_PAGE_SIZE', "A4")),
+        request.GET.get('view', '').lower(),
+    )
+    return template, context, pdf_cache_key(item, template, context['pagesize'], context['view'], context['subitems'])
+
+
 def download(request, downloadType, item):
     """Built in download method"""
-    template = get_download_template_path_for_item(item, downloadType)
-    from django.conf import settings
-    page_size = getattr(settings, 'PDF_PAGE_SIZE', "A4")
     if downloadType == "pdf":
-        subItems = item.get_download_items()
-        return render_to_pdf(
-            template,
-            {
-                'item': item,
-                'subitems': subItems,
-                'tableOfContents': len(subItems) > 0,
-                'view': request.GET.get('view', '').lower(),
-                'pagesize': request.GET.get('pagesize', page_size),
-            }
-        )
+        template, context, name = pdf_download(request, item)
+        return render_to_cached_pdf(request, template, context, name)
 
     elif downloadType == "csv-vd":
-        response = HttpResponse(content_type='text/csv')
-        response['Content-Disposition'] = 'attachment; filename="%s.csv"' % (
-            item.name
-        )
-
-        writer = csv.writer(response)
-        writer.writerow(['value', 'meaning', 'start date', 'end date', 'role'])
-        for v in item.permissibleValues.all():
-            writer.writerow(
-                [v.value, v.meaning, v.start_date, v.end_date, "permissible"]
-            )
-        for v in item.supplementaryValues.all():
-            writer.writerow(
-                [v.value, v.meaning, v.start_date, v.end_date, "supplementary"]
-            )
+        values = [
+            (item.permissibleValues, "permissible"),
+            (item.supplementaryValues, "supplementary"),
+        ]
+        lines = value_domain_csv_lines(values)
+        filename = "%s.csv" % item.name
+        content_type = 'text/csv'
+        if request.GET.get('compress') == 'gzip':
+            lines = gzip_stream(lines)
+            filename += '.gz'
+            content_type = 'application/gzip'
 
+        response = StreamingHttpResponse(lines, content_type=content_type)
+        response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+        # So clients know how many rows to expect before the download finishes.
+        response['X-Row-Count'] = sum(v.count() for v, role in values)
         return response
+
+
+def bundle(request, downloadType, items):
+    """
+    Yields the filename and content of the download of each item in a bundle.
+
+    PDFs already in the download cache are used as they are, and the rest are
+    all queued to be rendered at once by deferred tasks, each being yielded as
+    soon as it is in the cache. PDFs that can't be rendered, or aren't ready
+    within ``PDF_BUNDLE_WAIT`` seconds, are left out.
+    """
+    if downloadType != "pdf":
+        for entry in downloads.response_entries(downloads.get_downloader(downloadType), request, items):
+            yield entry
+        return
+
+    storage = get_download_cache()
+    pending = deque()
+
+    def finished_entries(deadline=None):
+        while pending:
+            filename, name = pending[0]
+            if storage.exists(name):
+                yield filename, storage.open(name).read()
+            elif get_render_error(storage, name) is not None:
+                logger.warning("Could not render '%s' for a download bundle" % name)
+            elif deadline is not None and time.time() >= deadline:
+                logger.warning("'%s' wasn't rendered in time for a download bundle" % name)
+            elif deadline is not None:
+                time.sleep(RENDER_POLL_SECONDS)
+                continue
+            else:
+                return
+            pending.popleft()
+
+    for item in items:
+        filename = downloads.bundle_filename(item, '.pdf')
+        template, context, name = pdf_download(request, item)
+        if storage.exists(name):
+            yield filename, storage.open(name).read()
+        elif get_render_error(storage, name) is not None:
+            continue
+        else:
+            _defer_render(template, context, name)
+            pending.append((filename, name))
+        # Hand back anything that has finished while later items are queued.
+        for entry in finished_entries():
+            yield entry
+    for entry in finished_entries(deadline=time.time() + get_setting('PDF_BUNDLE_WAIT', 300)):
+        yield entry
+
+
+def value_rows(values, chunk_size=VALUE_CHUNK_SIZE):
+    """
+    Yields the value, meaning, start date and end date of each value in a
+    queryset of permissible or supplementary values, in order. Only those
+    columns are read, ``chunk_size`` values at a time, using the position and
+    id of the last value in each chunk to fetch the next.
+    """
+    values = values.order_by('order', 'pk')
+    last_order, last_pk = None, None
+    while True:
+        chunk = values
+        if last_pk is not None:
+            chunk = chunk.filter(Q(order__gt=last_order) | Q(order=last_order, pk__gt=last_pk))
+        chunk = list(chunk.values_list(
+            'order', 'pk', 'value', 'meaning', 'start_date', 'end_date'
+        )[:chunk_size])
+        if not chunk:
+            return
+        for row in chunk:
+            yield row[2:]
+        last_order, last_pk = chunk[-1][:2]
+
+
+def value_domain_csv_lines(values):
+    writer = csv.writer(Echo())
+    yield writer.writerow(['value', 'meaning', 'start date', 'end date', 'role'])
+    for queryset, role in values:
+        for row in value_rows(queryset):
+            yield writer.writerow([
+                force_bytes(column) if column is not None else ''
+                for column in row
+            ] + [role])
+
+
+def gzip_stream(lines):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for line in lines:
+        data = compressor.compress(line)
+        if data:
+            yield data
+    yield compressor.flush()
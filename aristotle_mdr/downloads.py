@@ -0,0 +1,202 @@
+"""
+The registry of download formats available in the registry.
+
+The registry is built once from ``ARISTOTLE_DOWNLOADS`` when the app is
+loaded, so each download request only needs a dictionary lookup, and mistakes
+in the settings are found at startup rather than when someone first tries to
+download an item.
+
+A download module can declare what its downloads can do with these optional
+attributes of its ``downloader`` module, each a list of download types:
+
+``STREAMING_DOWNLOADS``
+    Downloads that return a ``StreamingHttpResponse``.
+``CACHEABLE_DOWNLOADS``
+    Downloads whose content only depends on the item, and not on the user
+    downloading it, so they can be cached and shared between users.
+
+A module can also provide a ``bundle`` function to build the entries of a
+bundle of many items itself, for example to render them in parallel.
+"""
+from collections import OrderedDict
+from importlib import import_module
+import os
+import re
+import zipfile
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.template import TemplateDoesNotExist
+from django.template.defaultfilters import slugify
+from django.template.loader import get_template
+
+from aristotle_mdr import exceptions as registry_exceptions
+
+_registry = None
+
+
+class Downloader(object):
+    """
+    A download format, with the ``download`` function that provides it.
+    """
+    def __init__(self, option, download, streaming=False, cacheable=False, bundle=None):
+        self.option = tuple(option)
+        self.download_type = option[0]
+        self.name = option[1]
+        self.icon = option[2]
+        self.module_name = option[3]
+        self.download = download
+        self.streaming = streaming
+        self.cacheable = cacheable
+        self.bundle = bundle
+
+    def __call__(self, request, item):
+        return self.download(request, self.download_type, item)
+
+    def can_download(self, item):
+        from aristotle_mdr.utils import get_download_template_path_for_item
+        try:
+            get_template(get_download_template_path_for_item(item, self.download_type))
+            return True
+        except TemplateDoesNotExist:
+            return False
+
+    def bundle_entries(self, request, items):
+        """
+        Yields a ``(filename, content)`` pair for the download of each of the
+        given items that can be downloaded in this format, as each is ready.
+        """
+        items = [item for item in items if self.can_download(item)]
+        if self.bundle is not None:
+            return self.bundle(request, self.download_type, items)
+        return response_entries(self, request, items)
+
+    def __repr__(self):
+        return '<Downloader: %s from %s>' % (self.download_type, self.module_name)
+
+
+def build_registry(download_options=None):
+    """
+    Returns an ordered dictionary mapping each download type to its
+    ``Downloader``, checking each option and importing each download module.
+    Where a download type is given more than once, the last one is used.
+    """
+    if download_options is None:
+        download_options = getattr(settings, 'ARISTOTLE_DOWNLOADS', [])
+    registry = OrderedDict()
+    for option in download_options:
+        download_type, module_name = option[0], option[3]
+        if not re.search('^[a-zA-Z0-9\-\.]+$', download_type):
+            raise registry_exceptions.BadDownloadTypeAbbreviation(
+                "Download type '%s' can only be composed of letters, numbers, hyphens or periods." % download_type
+            )
+        if not re.search('^[a-zA-Z0-9\_]+$', module_name):
+            raise registry_exceptions.BadDownloadModuleName(
+                "Download module '%s' isn't a valid Python module name." % module_name
+            )
+        try:
+            module = import_module('%s.downloader' % module_name)
+        except ImportError as e:
+            raise ImproperlyConfigured(
+                "Could not import the downloader for download type '%s' from '%s': %s" % (download_type, module_name, e)
+            )
+        if not callable(getattr(module, 'download', None)):
+            raise ImproperlyConfigured("'%s.downloader' has no download function." % module_name)
+        registry[download_type] = Downloader(
+            option, module.download,
+            streaming=download_type in getattr(module, 'STREAMING_DOWNLOADS', []),
+            cacheable=download_type in getattr(module, 'CACHEABLE_DOWNLOADS', []),
+            bundle=getattr(module, 'bundle', None),
+        )
+    return registry
+
+
+def get_registry():
+    global _registry
+    if _registry is None:
+        _registry = build_registry()
+    return _registry
+
+
+def get_downloader(download_type):
+    """
+    Returns the ``Downloader`` for the given download type, or ``None`` if
+    there isn't one.
+    """
+    return get_registry().get(download_type)
+
+
+def bundle_filename(item, extension):
+    return '%s-%s%s' % (slugify(item.name) or 'item', item.pk, extension)
+
+
+def response_entries(downloader, request, items):
+    """
+    Yields the bundle entries for the given items by calling the download
+    function for each in turn, skipping any that don't return a successful
+    response.
+    """
+    for item in items:
+        try:
+            response = downloader(request, item)
+        except TemplateDoesNotExist:
+            continue
+        if response.status_code != 200:
+            continue
+        if response.streaming:
+            content = b''.join(response.streaming_content)
+        else:
+            content = response.content
+        filename = re.search('filename="([^"]*)"', response.get('Content-Disposition', ''))
+        extension = os.path.splitext(filename.group(1))[1] if filename else ''
+        yield bundle_filename(item, extension or '.%s' % downloader.download_type), content
+
+
+class ZipStream(object):
+    # A write-only file for zipfile that hands back what has been written
+    # since it was last asked, so an archive can be streamed as it is built.
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.position += len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def read_written(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def zip_stream(entries):
+    """
+    Yields a zip archive of the given ``(filename, content)`` pairs, a piece
+    at a time as each entry is added.
+    """
+    stream = ZipStream()
+    archive = zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED)
+    names = set()
+    for filename, content in entries:
+        if filename in names:
+            continue
+        names.add(filename)
+        archive.writestr(filename, content)
+        yield stream.read_written()
+    archive.close()
+    yield stream.read_written()
+
+
+@receiver(setting_changed)
+def reset_registry(setting, **kwargs):
+    global _registry
+    if setting == 'ARISTOTLE_DOWNLOADS':
+        _registry = None
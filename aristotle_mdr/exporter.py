@@ -0,0 +1,140 @@
+"""
+Bulk export of registry content as CSV or newline-delimited JSON.
+
+Items are read in chunks of ids using the last id of each chunk to fetch the
+next, and each chunk is fetched with its workgroup, type and current statuses
+in a fixed number of queries. Rows are generated one at a time, so exports can
+be streamed to a response or file without holding the whole registry in memory.
+"""
+from django.contrib.contenttypes.models import ContentType
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.utils.encoding import force_bytes, force_text
+
+import csv
+import json
+
+from aristotle_mdr.models import STATES, _concept
+
+CHUNK_SIZE = 500
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'json': 'application/x-ndjson',
+}
+
+EXPORT_COLUMNS = [
+    'id', 'type', 'name', 'definition', 'workgroup',
+    'created', 'modified', 'is_public', 'is_locked', 'statuses',
+]
+
+
+def filter_types(items, types):
+    """
+    Filters a queryset of concepts to the given types, a list of strings of
+    the form ``app_label.model_name``. Raises ``ValueError`` if a type isn't a
+    kind of concept.
+    """
+    if not types:
+        return items
+    bare_type = ContentType.objects.get_for_model(_concept)
+    untyped = Q(_concrete_type__isnull=True) | Q(_concrete_type=bare_type)
+    matches = Q()
+    for label in types:
+        try:
+            app_label, model_name = label.lower().split('.')
+            ct = ContentType.objects.get_by_natural_key(app_label, model_name)
+        except (ValueError, ContentType.DoesNotExist):
+            raise ValueError("Unknown item type '%s'" % label)
+        model = ct.model_class()
+        if model is None or not issubclass(model, _concept) or model is _concept:
+            raise ValueError("Unknown item type '%s'" % label)
+        # Items that don't have their type stored yet are found through the
+        # subclass table instead.
+        matches |= Q(_concrete_type=ct) | (untyped & Q(pk__in=model.objects.values('pk')))
+    return items.filter(matches)
+
+
+def export_rows(items, chunk_size=CHUNK_SIZE):
+    """
+    Yields a dictionary for each item in the given queryset of concepts, in
+    order of id.
+    """
+    last_pk = 0
+    while True:
+        chunk = list(
+            items.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True).distinct()[:chunk_size]
+        )
+        if not chunk:
+            return
+        concepts = _concept.objects.filter(pk__in=chunk).order_by('pk').select_related(
+            'workgroup', '_concrete_type'
+        ).with_current_statuses()
+        types = dict(
+            (concept.pk, concept._concrete_type.model_class()) for concept in concepts
+            if concept._concrete_type is not None
+        )
+        untyped = [concept.pk for concept in concepts if types.get(concept.pk) in (None, _concept)]
+        if untyped:
+            # Items that don't have their type stored yet are looked up
+            # through the subclass tables, and have it stored for next time.
+            for item in _concept.objects.filter(pk__in=untyped).select_subclasses():
+                types[item.pk] = type(item)
+                item.store_concrete_type()
+        for concept in concepts:
+            model = types.get(concept.pk)
+            yield {
+                'id': concept.pk,
+                'type': '%s.%s' % (model._meta.app_label, model._meta.model_name) if model not in (None, _concept) else '',
+                'name': concept.name,
+                'definition': concept.definition,
+                'workgroup': concept.workgroup.name,
+                'created': concept.created,
+                'modified': concept.modified,
+                'is_public': concept._is_public,
+                'is_locked': concept._is_locked,
+                'statuses': [
+                    {
+                        'registration_authority': status.registrationAuthority.name,
+                        'state': force_text(STATES[status.state]),
+                        'registration_date': status.registrationDate,
+                    }
+                    for status in concept.current_status_list
+                ],
+            }
+        last_pk = chunk[-1]
+
+
+class Echo(object):
+    # A file-like object for csv.writer that hands back each row it is given.
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(EXPORT_COLUMNS)
+    for row in rows:
+        row = dict(row, statuses='; '.join(
+            '%s: %s' % (s['registration_authority'], s['state']) for s in row['statuses']
+        ))
+        yield writer.writerow([
+            force_bytes(row[column]) if row[column] is not None else ''
+            for column in EXPORT_COLUMNS
+        ])
+
+
+def json_lines(rows):
+    for row in rows:
+        yield json.dumps(row, cls=DjangoJSONEncoder) + "\n"
+
+
+def export(items, export_format, chunk_size=CHUNK_SIZE):
+    """
+    Returns a generator of the lines of an export of the given queryset of
+    concepts in ``export_format``, one of the keys of ``EXPORT_FORMATS``.
+    """
+    rows = export_rows(items, chunk_size=chunk_size)
+    if export_format == 'csv':
+        return csv_lines(rows)
+    return json_lines(rows)
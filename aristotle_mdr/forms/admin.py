@@ -6,7 +6,7 @@ from django.utils.translation import ugettext_lazy as _
 
 import aristotle_mdr.models as MDR
 import aristotle_mdr.widgets as widgets
-from aristotle_mdr.perms import user_can_edit
+from aristotle_mdr.perms import user_can_edit_many
 from aristotle_mdr.utils import concept_to_clone_dict
 from aristotle_mdr.forms.creation_wizards import WorkgroupVerificationMixin, UserAwareForm
 
@@ -101,11 +101,14 @@ class AdminConceptForm(autocomplete_light.ModelForm, UserAwareForm, WorkgroupVer
 
     def save(self, *args, **kwargs):
         instance = super(AdminConceptForm, self).save(*args, **kwargs)
-        for i in instance.supersedes.all():
-            if user_can_edit(self.request.user, i) and i not in self.cleaned_data['deprecated']:
+        superseded = list(instance.supersedes.all())
+        deprecated = list(self.cleaned_data['deprecated'])
+        can_edit = user_can_edit_many(self.request.user, superseded + deprecated)
+        for i in superseded:
+            if can_edit[i.id] and i not in deprecated:
                 instance.supersedes.remove(i)
-        for i in self.cleaned_data['deprecated']:
-            if user_can_edit(self.request.user, i):  # Would check item.supersedes but its a set
+        for i in deprecated:
+            if can_edit[i.id]:  # Would check item.supersedes but its a set
                 instance.supersedes.add(i)
 
         return instance
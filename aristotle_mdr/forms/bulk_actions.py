@@ -3,12 +3,11 @@ import autocomplete_light
 from django import forms
 from django.core.exceptions import PermissionDenied
 from django.db import transaction
-from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
 import aristotle_mdr.models as MDR
 from aristotle_mdr.forms import ChangeStatusForm
-from aristotle_mdr.perms import user_can_view, user_is_registrar
+from aristotle_mdr.perms import user_can_view_many, user_is_registrar
 from aristotle_mdr.forms.creation_wizards import UserAwareForm
 
 
@@ -116,7 +115,8 @@ class AddFavouriteForm(BulkActionForm):
 
     def make_changes(self):
         items = self.cleaned_data.get('items')
-        bad_items = [str(i.id) for i in items if not user_can_view(self.user, i)]
+        can_view = user_can_view_many(self.user, items)
+        bad_items = [str(i.id) for i in items if not can_view[i.id]]
         items = items.visible(self.user)
         self.user.profile.favourites.add(*items)
         return _(
@@ -149,7 +149,6 @@ class ChangeStateForm(ChangeStatusForm, BulkActionForm):
         self.add_registration_authority_field()
 
     def make_changes(self):
-        import reversion
         if not self.user.profile.is_registrar:
             raise PermissionDenied
         ras = self.cleaned_data['registrationAuthorities']
@@ -160,31 +159,28 @@ class ChangeStateForm(ChangeStatusForm, BulkActionForm):
         changeDetails = self.cleaned_data['changeDetails']
         failed = []
         success = []
-        with transaction.atomic(), reversion.revisions.create_revision():
-            reversion.revisions.set_user(self.user)
-
-            if regDate is None:
-                regDate = timezone.now().date()
-            for item in items:
-                for ra in ras:
-                    r = ra.register(item, state, self.user, regDate, cascade, changeDetails)
-                    for f in r['failed']:
-                        failed.append(f)
-                    for s in r['success']:
-                        success.append(s)
-            failed = list(set(failed))
-            success = list(set(success))
-            bad_items = sorted([str(i.id) for i in failed])
-            message = _(
-                "%(num_items)s items registered in %(num_ra)s registration authorities. \n"
-                "Some items failed, they had the id's: %(bad_ids)s"
-            ) % {
-                'num_items': len(items),
-                'num_ra': len(ras),
-                'bad_ids': ",".join(bad_items)
-            }
-            reversion.revisions.set_comment(message)
-            return message
+        with transaction.atomic():
+            for ra in ras:
+                r = ra.register_many(
+                    items, state, self.user,
+                    registrationDate=regDate,
+                    cascade=cascade,
+                    changeDetails=changeDetails,
+                )
+                failed.extend(r['failed'])
+                success.extend(r['success'])
+        failed = list(set(failed))
+        success = list(set(success))
+        bad_items = sorted([str(i.id) for i in failed])
+        message = _(
+            "%(num_items)s items registered in %(num_ra)s registration authorities. \n"
+            "Some items failed, they had the id's: %(bad_ids)s"
+        ) % {
+            'num_items': len(items),
+            'num_ra': len(ras),
+            'bad_ids': ",".join(bad_items)
+        }
+        return message
 
     @classmethod
     def can_use(cls, user):
@@ -2,7 +2,7 @@ import autocomplete_light
 
 from django import forms
 import aristotle_mdr.models as MDR
-from aristotle_mdr.perms import user_can_view
+from aristotle_mdr.perms import user_can_view_many
 
 
 class NewPostForm(forms.ModelForm):
@@ -27,7 +27,8 @@ class NewPostForm(forms.ModelForm):
         Its unlikely to happen in normal use.
         """
         relatedItems = self.cleaned_data['relatedItems']
-        relatedItems = [i for i in relatedItems if user_can_view(self.user, i)]
+        can_view = user_can_view_many(self.user, relatedItems)
+        relatedItems = [i for i in relatedItems if can_view[i.id]]
         return relatedItems
 
 
@@ -8,7 +8,7 @@ from django.utils import timezone
 from bootstrap3_datetime.widgets import DateTimePicker
 
 import aristotle_mdr.models as MDR
-from aristotle_mdr.perms import user_can_edit, user_can_view
+from aristotle_mdr.perms import user_can_edit, user_can_edit_many, user_can_view
 from aristotle_mdr.forms.creation_wizards import UserAwareForm
 
 
@@ -52,9 +52,8 @@ class DeprecateForm(forms.Form):
         olderItems = self.cleaned_data['olderItems']
         if self.item in olderItems:
             raise forms.ValidationError("An item may not supersede itself")
-        for i in olderItems:
-            if not user_can_edit(self.user, i):
-                raise forms.ValidationError("You cannot supersede an item that you do not have permission to edit")
+        if not all(user_can_edit_many(self.user, olderItems).values()):
+            raise forms.ValidationError("You cannot supersede an item that you do not have permission to edit")
         return olderItems
 
 
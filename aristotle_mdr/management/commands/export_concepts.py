@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand, CommandError
+from aristotle_mdr.models import _concept
+from aristotle_mdr import exporter
+
+
+class Command(BaseCommand):
+    help = 'Exports every item in the registry, with its workgroup and current statuses, as CSV or newline-delimited JSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--format', dest='export_format', default='csv', choices=sorted(exporter.EXPORT_FORMATS.keys()),
+            help='The format to export in.'
+        )
+        parser.add_argument(
+            '--type', action='append', dest='types', default=[],
+            help='Only export items of this type, given as app_label.model_name. Can be given more than once.'
+        )
+        parser.add_argument(
+            '--public-only', action='store_true', dest='public_only', default=False,
+            help='Only export items that are public.'
+        )
+        parser.add_argument(
+            '--output', dest='output', default=None,
+            help='The file to write the export to, instead of standard output.'
+        )
+        parser.add_argument(
+            '--chunk-size', type=int, default=exporter.CHUNK_SIZE, dest='chunk_size',
+            help='The number of items to read from the database at a time.'
+        )
+
+    def handle(self, *args, **options):
+        items = _concept.objects.all()
+        if options.get('public_only'):
+            items = items.public()
+        try:
+            items = exporter.filter_types(items, options.get('types'))
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        lines = exporter.export(items, options.get('export_format', 'csv'), chunk_size=options.get('chunk_size'))
+        if options.get('output'):
+            with open(options['output'], 'wb') as f:
+                f.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
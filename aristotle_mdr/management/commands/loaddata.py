@@ -0,0 +1,15 @@
+from django.core.management.commands import loaddata
+from django.db import transaction
+from aristotle_mdr.models import deferred_recache
+
+
+class Command(loaddata.Command):
+    help = loaddata.Command.help + (
+        ' The states of items whose statuses are loaded are recached once all the fixtures are loaded.'
+    )
+
+    def handle(self, *fixture_labels, **options):
+        # Statuses can be loaded before the items they belong to, so items
+        # can only be recached once everything is in place.
+        with transaction.atomic(using=options.get('database')), deferred_recache():
+            return super(Command, self).handle(*fixture_labels, **options)
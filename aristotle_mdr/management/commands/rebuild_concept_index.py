@@ -0,0 +1,170 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from aristotle_mdr.models import _concept
+from aristotle_mdr.signals import remove_from_index, update_concepts_in_index
+
+from collections import deque
+import json
+import multiprocessing
+import os
+import time
+
+
+def init_worker(using):
+    # Connections copied from the parent process can't be shared safely, so
+    # each worker opens its own.
+    import haystack
+    connections.close_all()
+    haystack.connections.reload(using)
+
+
+def index_chunk(args):
+    concept_ids, using = args
+    return update_concepts_in_index(concept_ids, using=using)
+
+
+def concept_id_chunks(start_after, batch_size):
+    """
+    Yields lists of concept ids in order, ``batch_size`` at a time, using the
+    last id of each chunk to fetch the next so no large offsets are queried.
+    """
+    while True:
+        chunk = list(
+            _concept.objects.filter(pk__gt=start_after).order_by('pk').values_list('pk', flat=True)[:batch_size]
+        )
+        if not chunk:
+            return
+        yield chunk
+        start_after = chunk[-1]
+
+
+def remove_stale_documents(using, batch_size):
+    """
+    Removes the documents of items that are no longer in their index's
+    ``index_queryset``, such as items deleted while search updates weren't
+    being made. Returns the number of documents removed.
+    """
+    from haystack import connections as search_connections
+    from haystack.query import SearchQuerySet
+
+    unified_index = search_connections[using].get_unified_index()
+    documents = SearchQuerySet(using=using).all()
+    # Documents are only removed once every page of results has been read, so
+    # removing them doesn't move the pages still to be read.
+    stale = {}
+    for start in range(0, documents.count(), batch_size):
+        pks_by_model = {}
+        for result in documents[start:start + batch_size]:
+            if result.model is not None and issubclass(result.model, _concept):
+                pks_by_model.setdefault(result.model, set()).add(int(result.pk))
+        for model, pks in pks_by_model.items():
+            index = unified_index.get_index(model)
+            current = set(index.index_queryset(using=using).filter(pk__in=pks).values_list('pk', flat=True))
+            stale.setdefault(model, []).extend(
+                '%s.%s.%s' % (model._meta.app_label, model._meta.model_name, pk)
+                for pk in sorted(pks - current)
+            )
+    stale = dict((model, identifiers) for model, identifiers in stale.items() if identifiers)
+    remove_from_index(stale, using=using)
+    return sum(len(identifiers) for identifiers in stale.values())
+
+
+class Command(BaseCommand):
+    help = 'Updates the search index for every item in the registry in chunks, optionally using several worker processes, then removes the documents of items that no longer exist. If given a checkpoint file, progress is saved after each chunk and an interrupted rebuild can be continued with --resume.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=500, dest='batch_size',
+            help='The number of items to index and commit to the search backend at a time.'
+        )
+        parser.add_argument(
+            '--workers', type=int, default=1, dest='workers',
+            help='The number of worker processes to index with. Using more than one requires a search backend that accepts concurrent updates.'
+        )
+        parser.add_argument(
+            '--checkpoint', dest='checkpoint', default=None,
+            help='A file to record the last item indexed in.'
+        )
+        parser.add_argument(
+            '--resume', action='store_true', dest='resume', default=False,
+            help='Continue from the item recorded in the checkpoint file.'
+        )
+        parser.add_argument(
+            '--keep-removed', action='store_true', dest='keep_removed', default=False,
+            help="Don't remove the documents of items that no longer exist from the index."
+        )
+        parser.add_argument(
+            '--using', dest='using', default='default',
+            help='The search connection to update.'
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options.get('batch_size', 500)
+        workers = options.get('workers', 1)
+        checkpoint = options.get('checkpoint')
+        using = options.get('using', 'default')
+        verbosity = int(options.get('verbosity', 1))
+
+        if batch_size < 1 or workers < 1:
+            raise CommandError('The batch size and number of workers must be at least 1')
+        if options.get('resume') and not checkpoint:
+            raise CommandError('A checkpoint file is needed to resume')
+
+        start_after = 0
+        if options.get('resume') and os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                start_after = json.load(f)['last_pk']
+            if verbosity > 0:
+                self.stdout.write('Resuming after item %s' % start_after)
+
+        total = _concept.objects.filter(pk__gt=start_after).count()
+        if verbosity > 0:
+            self.stdout.write('Beginning index rebuild for %s items' % total)
+
+        started = time.time()
+        self.indexed = 0
+
+        def finished(chunk, count):
+            self.indexed += count
+            if checkpoint:
+                with open(checkpoint, 'w') as f:
+                    json.dump({'last_pk': chunk[-1]}, f)
+            if verbosity > 0:
+                self.stdout.write('  indexed %s of %s items' % (self.indexed, total))
+
+        chunks = concept_id_chunks(start_after, batch_size)
+        if workers == 1:
+            for chunk in chunks:
+                finished(chunk, index_chunk((chunk, using)))
+        else:
+            # Close the parent's connections so none are shared with workers.
+            connections.close_all()
+            pool = multiprocessing.Pool(workers, init_worker, (using,))
+            try:
+                # Only a few chunks are handed out ahead of the workers, and
+                # results are collected in order, so the checkpoint never
+                # passes a chunk that hasn't been indexed yet.
+                pending = deque()
+                for chunk in chunks:
+                    pending.append((chunk, pool.apply_async(index_chunk, ((chunk, using),))))
+                    if len(pending) >= workers * 2:
+                        chunk, result = pending.popleft()
+                        finished(chunk, result.get())
+                while pending:
+                    chunk, result = pending.popleft()
+                    finished(chunk, result.get())
+                pool.close()
+            except BaseException:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+
+        if checkpoint and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        if not options.get('keep_removed'):
+            removed = remove_stale_documents(using, batch_size)
+            if verbosity > 0:
+                self.stdout.write('Removed %s items that no longer exist from the index' % removed)
+        if verbosity > 0:
+            self.stdout.write('Successfully indexed %s items in %.2f seconds' % (self.indexed, time.time() - started))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from aristotle_mdr.models import VisibilityGrant, _concept
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the visibility grants used to filter visible items for every item in the registry. This is useful after loading data with signals disabled, or if the grants are suspected to be out of date.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=500, dest='batch_size',
+            help='The number of items to rebuild grants for at a time.'
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options.get('batch_size', 500)
+        concept_ids = list(_concept.objects.order_by('pk').values_list('pk', flat=True))
+        self.stdout.write('Beginning rebuild of visibility grants for %s items' % len(concept_ids))
+
+        # Grants for items that no longer exist are left behind if items are
+        # removed without sending signals.
+        VisibilityGrant.objects.exclude(concept__in=_concept.objects.all()).delete()
+        added = 0
+        for start in range(0, len(concept_ids), batch_size):
+            added += VisibilityGrant.objects.rebuild(concept_ids[start:start + batch_size])[0]
+
+        self.stdout.write('Successfully rebuilt visibility grants for %s items (%s grants added)' % (len(concept_ids), added))
@@ -1,13 +1,43 @@
 from django.core.management.base import BaseCommand, CommandError
 from aristotle_mdr.models import RegistrationAuthority, _concept
+from aristotle_mdr.tasks import recache_items
+
+import time
+
+
+def recache_with_progress(command, items, options):
+    """
+    Recaches the given items, reporting progress and timing to the command.
+    """
+    verbosity = int(options.get('verbosity', 1))
+    dry_run = options.get('dry_run', False)
+
+    def progress(checked, total):
+        if verbosity > 0:
+            command.stdout.write('  checked %s of %s items' % (checked, total))
+
+    started = time.time()
+    changed, total = recache_items(items, dry_run=dry_run, progress=progress)
+
+    if verbosity > 0:
+        if dry_run:
+            message = '%s of %s items would change (dry run, nothing was saved) in %.2f seconds'
+        else:
+            message = '%s of %s items changed in %.2f seconds'
+        command.stdout.write(message % (changed, total, time.time() - started))
 
 
 class Command(BaseCommand):
-    args = '<workgroup_id workgroup_id ...>'
-    help = 'Recomputes and caches the public and locked statuses for the given workgroup(s). This is useful if the registration authorities associated with a workgroup change.'
+    help = 'Recomputes and caches the public and locked statuses for the given registration authorities. This is useful if the public or locked states of a registration authority change.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('ra', nargs='*', type=int, help='The ids of the registration authorities to update.')
+        parser.add_argument(
+            '--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Report how many items would change without saving anything.'
+        )
 
     def handle(self, *args, **options):
-        from haystack import connections
         for ra_id in options['ra']:
             try:
                 ra = RegistrationAuthority.objects.get(pk=int(ra_id))
@@ -15,8 +45,6 @@ class Command(BaseCommand):
                 raise CommandError('Registration Authority "%s" does not exist' % ra_id)
             self.stdout.write('Beginning update for items in Registration Authority "%s" (id:%s)' % (ra.name, ra_id))
 
-            for item in _concept.objects.filter(statuses__registrationAuthority=ra):
-                item.recache_states()
-                connections['default'].get_unified_index().get_index(item.item.__class__).update_object(item.item)
+            recache_with_progress(self, _concept.objects.filter(statuses__registrationAuthority=ra), options)
 
             self.stdout.write('Successfully updated items in Registration Authority "%s" (id:%s)' % (ra.name, ra_id))
@@ -1,13 +1,19 @@
 from django.core.management.base import BaseCommand, CommandError
 from aristotle_mdr.models import Workgroup
+from aristotle_mdr.management.commands.recache_registration_authority_item_visibility import recache_with_progress
 
 
 class Command(BaseCommand):
-    args = '<workgroup_id workgroup_id ...>'
     help = 'Recomputes and caches the public andlocked statuses for the given workgroup(s). This is useful if the registration authorities associated with a workgroup change.'
 
+    def add_arguments(self, parser):
+        parser.add_argument('wg', nargs='*', type=int, help='The ids of the workgroups to update.')
+        parser.add_argument(
+            '--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Report how many items would change without saving anything.'
+        )
+
     def handle(self, *args, **options):
-        from haystack import connections
         for wg_id in options['wg']:
             try:
                 wg = Workgroup.objects.get(pk=int(wg_id))
@@ -15,8 +21,6 @@ class Command(BaseCommand):
                 raise CommandError('Workgroup "%s" does not exist' % wg_id)
             self.stdout.write('Beginning update for items in Workgroup "%s" (id:%s)' % (wg.name, wg_id))
 
-            for item in wg.items.all():
-                item.recache_states()
-                connections['default'].get_unified_index().get_index(item.item.__class__).update_object(item.item)
+            recache_with_progress(self, wg.items.all(), options)
 
             self.stdout.write('Successfully updated items in Workgroup "%s" (id:%s)' % (wg.name, wg_id))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+from aristotle_mdr import tasks
+
+import time
+
+
+class Command(BaseCommand):
+    help = 'Runs deferred tasks, such as recaching item visibility, from the database queue. Use this with the "process" DEFERRED_TASK_MODE, several of these can be run at once.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once', action='store_true', dest='once', default=False,
+            help='Run the tasks that are waiting and then exit, instead of waiting for more.'
+        )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        while True:
+            count = tasks.run_pending()
+            if count and verbosity > 0:
+                self.stdout.write('Ran %s deferred tasks' % count)
+            if options.get('once'):
+                break
+            connection.close()
+            time.sleep(tasks.POLL_SECONDS)
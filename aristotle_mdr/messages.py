@@ -2,10 +2,16 @@ from __future__ import unicode_literals
 from __future__ import print_function
 from __future__ import absolute_import
 
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
 from django.core.urlresolvers import reverse
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
+from notifications.models import Notification
 from notifications.signals import notify
 
+from aristotle_mdr import tasks
 from aristotle_mdr.utils import url_slugify_concept, url_slugify_workgroup
 
 
@@ -30,3 +36,142 @@ def new_comment_created(comment):
 def new_post_created(post, recipient):
     op_name = post.author.get_full_name() or post.author
     notify.send(post.author, recipient=recipient, verb="made a new post", target=post, action_object=post.workgroup)
+
+
+def notify_many(actor, recipient_ids, verb, target=None, action_object=None):
+    """
+    Sends the same notification to every user with an id in
+    ``recipient_ids``, creating the notifications 500 at a time with
+    ``bulk_create`` rather than one ``notify.send`` for each user.
+    """
+    timestamp = timezone.now()
+    optional = {}
+    for name, obj in [('target', target), ('action_object', action_object)]:
+        if obj is not None:
+            optional['%s_content_type' % name] = ContentType.objects.get_for_model(obj)
+            optional['%s_object_id' % name] = obj.pk
+    Notification.objects.bulk_create([
+        Notification(
+            recipient_id=recipient_id,
+            actor_content_type=ContentType.objects.get_for_model(actor),
+            actor_object_id=actor.pk,
+            verb=verb,
+            timestamp=timestamp,
+            **optional
+        )
+        for recipient_id in sorted(set(recipient_ids))
+    ], batch_size=500)
+
+
+def concept_changed(concept_id):
+    """
+    Notifies everyone who has favourited an item, and the viewers of its
+    workgroup, that it has changed, and comments on any
+    discussions about it. This is queued by ``concept_saved`` as a deferred
+    task for each item, so many saves in a short time only notify once.
+    """
+    from aristotle_mdr.models import _concept, DiscussionComment, resolve_subclasses
+    items = resolve_subclasses(_concept.objects.filter(pk=concept_id))
+    if not items:
+        return  # The item was deleted before we got to it.
+    item = items[0]
+
+    notify_many(
+        item, item.favourited_by.values_list('user_id', flat=True),
+        "A favourited item has been changed:", target=item
+    )
+    notify_many(
+        item, item.workgroup.viewers.values_list('pk', flat=True),
+        "was modified in the workgroup", target=item.workgroup
+    )
+    try:
+        # This will fail during first load, and if admins delete aristotle.
+        system = User.objects.get(username="aristotle")
+    except User.DoesNotExist:
+        return
+    for post in item.relatedDiscussions.all():
+        DiscussionComment.objects.create(
+            post=post,
+            body='The item "{name}" (id:{iid}) has been changed.\n\n\
+                <a href="{url}">View it on the main site.</a>.'.format(
+                name=item.name,
+                iid=item.id,
+                url=reverse("aristotle:item", args=[item.id])
+            ),
+            author=system,
+        )
+
+
+def get_setting(name, default):
+    return getattr(settings, 'ARISTOTLE_SETTINGS', {}).get(name, default)
+
+
+def queue_post_notifications(post):
+    """
+    Queues a deferred task to tell the members of a workgroup about a new
+    discussion post. Workgroups with at least ``DISCUSSION_DIGEST_MEMBERS``
+    members are sent a digest of all their new posts every
+    ``DISCUSSION_DIGEST_SECONDS`` instead of a notification for each post.
+    """
+    digest_members = get_setting('DISCUSSION_DIGEST_MEMBERS', 0)
+    if digest_members and len(post.workgroup.member_ids()) >= digest_members:
+        # The first post since the last digest queues one, and later posts
+        # extend it until it starts, so each post is only counted once.
+        key = 'discussion_digest_%s' % post.workgroup_id
+        if not tasks.update_pending(key, last_post_id=post.pk):
+            tasks.defer(
+                'aristotle_mdr.messages.discussion_digest',
+                key=key,
+                delay=get_setting('DISCUSSION_DIGEST_SECONDS', 3600),
+                workgroup_id=post.workgroup_id, first_post_id=post.pk, last_post_id=post.pk
+            )
+    else:
+        tasks.defer(
+            'aristotle_mdr.messages.post_created',
+            key='post_created_notifications_%s' % post.pk,
+            post_id=post.pk
+        )
+
+
+def post_created(post_id):
+    """
+    Notifies every member of a workgroup, except the author, of a new post.
+    """
+    from aristotle_mdr.models import DiscussionPost
+    post = DiscussionPost.objects.filter(pk=post_id).select_related('workgroup').first()
+    if post is None:
+        return  # The post was deleted before we got to it.
+    notify_many(
+        post.author, post.workgroup.member_ids() - set([post.author_id]),
+        "made a new post", target=post, action_object=post.workgroup
+    )
+
+
+def discussion_digest(workgroup_id, first_post_id, last_post_id=None):
+    """
+    Sends each member of a workgroup one notification of the number of posts
+    made in it from ``first_post_id`` to ``last_post_id``, not counting their
+    own posts.
+    """
+    from aristotle_mdr.models import DiscussionPost, Workgroup
+    workgroup = Workgroup.objects.filter(pk=workgroup_id).first()
+    if workgroup is None:
+        return
+    posts = DiscussionPost.objects.filter(workgroup=workgroup, pk__gte=first_post_id)
+    if last_post_id is not None:
+        # Posts made after the digest started are in the next one.
+        posts = posts.filter(pk__lte=last_post_id)
+    authors = list(posts.values_list('author_id', flat=True))
+    if not authors:
+        return
+    recipients_by_count = {}
+    for user_id in workgroup.member_ids():
+        count = len(authors) - authors.count(user_id)
+        if count:
+            recipients_by_count.setdefault(count, []).append(user_id)
+    for count, recipient_ids in recipients_by_count.items():
+        notify_many(
+            workgroup, recipient_ids,
+            "has %s new discussion post%s" % (count, "s" if count > 1 else ""),
+            target=workgroup
+        )
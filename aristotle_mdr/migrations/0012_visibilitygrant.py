@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def build_visibility_grants(apps, schema_editor):
+    # Mirrors VisibilityGrantManager.rebuild, as custom managers aren't
+    # available on the historical models.
+    _concept = apps.get_model('aristotle_mdr', '_concept')
+    Workgroup = apps.get_model('aristotle_mdr', 'Workgroup')
+    Status = apps.get_model('aristotle_mdr', 'Status')
+    VisibilityGrant = apps.get_model('aristotle_mdr', 'VisibilityGrant')
+
+    workgroup_ras = {}
+    for wg_id, ra_id in Workgroup.registrationAuthorities.through.objects.values_list(
+            'workgroup_id', 'registrationauthority_id'):
+        workgroup_ras.setdefault(wg_id, set()).add(ra_id)
+    registered_in = {}
+    for concept_id, ra_id in Status.objects.values_list(
+            'concept_id', 'registrationAuthority_id').distinct():
+        registered_in.setdefault(concept_id, set()).add(ra_id)
+
+    grants = []
+    for pk, wg_id, ready in _concept.objects.values_list('pk', 'workgroup_id', 'readyToReview').iterator():
+        grants.append(VisibilityGrant(concept_id=pk, workgroup_id=wg_id))
+        ra_ids = set(registered_in.get(pk, []))
+        if ready:
+            ra_ids.update(workgroup_ras.get(wg_id, []))
+        for ra_id in ra_ids:
+            grants.append(VisibilityGrant(concept_id=pk, registrationAuthority_id=ra_id))
+    VisibilityGrant.objects.bulk_create(grants, batch_size=500)
+
+
+def remove_visibility_grants(apps, schema_editor):
+    VisibilityGrant = apps.get_model('aristotle_mdr', 'VisibilityGrant')
+    VisibilityGrant.objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aristotle_mdr', '0011_update_ckeditor_remove_d19_errors'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VisibilityGrant',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('concept', models.ForeignKey(related_name='visibility_grants', on_delete=django.db.models.deletion.DO_NOTHING, db_constraint=False, to='aristotle_mdr._concept')),
+                ('registrationAuthority', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, blank=True, to='aristotle_mdr.RegistrationAuthority', null=True)),
+                ('workgroup', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, blank=True, to='aristotle_mdr.Workgroup', null=True)),
+            ],
+        ),
+        migrations.RunPython(build_visibility_grants, remove_visibility_grants),
+    ]
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def store_concrete_types(apps, schema_editor):
+    _concept = apps.get_model('aristotle_mdr', '_concept')
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+
+    subclasses = [
+        model for model in apps.get_models()
+        if issubclass(model, _concept) and model is not _concept
+    ]
+    # Work down the inheritance tree, so items of a subclass of a subclass
+    # end up with the most specific type.
+    subclasses.sort(key=lambda model: len(model._meta.get_parent_list()))
+    for model in subclasses:
+        ct, created = ContentType.objects.get_or_create(
+            app_label=model._meta.app_label, model=model._meta.model_name
+        )
+        _concept.objects.filter(pk__in=model.objects.values('pk')).update(_concrete_type=ct)
+    # Items of models that aren't available to migrations yet are left
+    # without a type here, and are given it once every app has been migrated
+    # by aristotle_mdr.models.store_missing_concrete_types.
+
+
+def clear_concrete_types(apps, schema_editor):
+    _concept = apps.get_model('aristotle_mdr', '_concept')
+    _concept.objects.update(_concrete_type=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('aristotle_mdr', '0013_deferredtask'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='_concept',
+            name='_concrete_type',
+            field=models.ForeignKey(related_name='+', blank=True, editable=False, to='contenttypes.ContentType', null=True),
+        ),
+        migrations.RunPython(store_concrete_types, clear_concrete_types),
+    ]
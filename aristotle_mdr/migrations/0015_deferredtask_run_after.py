@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aristotle_mdr', '0014_concept_concrete_type'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='deferredtask',
+            name='run_after',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def set_pending_keys(apps, schema_editor):
+    # Tasks queued twice before the key was enforced are left without a
+    # pending key, and still run.
+    DeferredTask = apps.get_model('aristotle_mdr', 'DeferredTask')
+    seen = set()
+    for task in DeferredTask.objects.filter(started__isnull=True).order_by('created', 'pk'):
+        if task.key not in seen:
+            seen.add(task.key)
+            DeferredTask.objects.filter(pk=task.pk).update(pending_key=task.key)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aristotle_mdr', '0015_deferredtask_run_after'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='deferredtask',
+            name='pending_key',
+            field=models.CharField(max_length=256, unique=True, null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='deferredtask',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(set_pending_keys, migrations.RunPython.noop),
+    ]
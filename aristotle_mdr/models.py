@@ -2,11 +2,13 @@ from __future__ import unicode_literals
 from __future__ import print_function
 from __future__ import absolute_import
 
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
 from django.core.urlresolvers import reverse
-from django.db import models, transaction
-from django.db.models import Q
-from django.db.models.signals import post_save, m2m_changed, post_delete
+from django.db import connections, models, transaction
+from django.db.models import Prefetch, Q
+from django.db.models.signals import class_prepared, post_save, m2m_changed, post_delete, pre_delete
 from django.dispatch import receiver
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
@@ -17,10 +19,13 @@ from model_utils import Choices, FieldTracker
 
 import reversion  # import revisions
 
+from contextlib import contextmanager
 import datetime
+import threading
 from ckeditor_uploader.fields import RichTextUploadingField as RichTextField
 from aristotle_mdr import perms
 from aristotle_mdr import messages
+from aristotle_mdr import tasks
 from aristotle_mdr.utils import url_slugify_concept, url_slugify_workgroup, url_slugify_registration_authoritity
 from aristotle_mdr import comparators
 
@@ -271,37 +276,25 @@ class RegistrationAuthority(registryGroup):
             'name': item.name,
             'iid': item.id
         }
-        revision_message = revision_message + kwargs.get('changeDetails', "")
-        seen_items = {'success': [], 'failed': []}
-
-        with transaction.atomic(), reversion.revisions.create_revision():
-            reversion.revisions.set_user(user)
-            reversion.revisions.set_comment(revision_message)
-
-            for child_item in [item] + item.registry_cascade_items:
-                registered = self._register(
-                    child_item, state, user, *args, **kwargs
-                )
-                if registered:
-                    seen_items['success'] = seen_items['success'] + [child_item]
-                else:
-                    seen_items['failed'] = seen_items['failed'] + [child_item]
-        print(seen_items)
-        return seen_items
+        kwargs['revision_comment'] = revision_message + kwargs.get('changeDetails', "")
+        kwargs['cascade'] = True
+        return self.register_many([item], state, user, *args, **kwargs)
 
     def register(self, item, state, user, *args, **kwargs):
-        revision_message = kwargs.get('changeDetails', "")
-        with transaction.atomic(), reversion.revisions.create_revision():
-            reversion.revisions.set_user(user)
-            reversion.revisions.set_comment(revision_message)
-            registered = self._register(item, state, user, *args, **kwargs)
-
-        if registered:
-            return {'success': [item], 'failed': []}
-        else:
-            return {'success': [], 'failed': [item]}
+        return self.register_many([item], state, user, *args, **kwargs)
 
-    def _register(self, item, state, user, *args, **kwargs):
+    def register_many(self, items, state, user, *args, **kwargs):
+        """
+        Registers many items in this authority at once. Returns a dictionary
+        of the items that were registered (``success``) and the items the user
+        isn't allowed to change the status of (``failed``).
+
+        Permissions are checked for all of the items together, the statuses
+        are added with ``bulk_create``, the cached public and locked states of
+        the items are recomputed together and one revision is saved for all
+        of them, in a single transaction. If ``cascade`` is ``True``, the
+        ``registry_cascade_items`` of each item are registered as well.
+        """
         changeDetails = kwargs.get('changeDetails', "")
         # If registrationDate is None (like from a form), override it with
         # todays date.
@@ -309,19 +302,52 @@ class RegistrationAuthority(registryGroup):
             or timezone.now().date()
         until_date = kwargs.get('until_date', None)
 
-        if not perms.user_can_change_status(user, item):
-            # Return a failure as this item isn't allowed
-            return False
-
-        Status.objects.create(
-            concept=item,
-            registrationAuthority=self,
-            registrationDate=registrationDate,
-            state=state,
-            changeDetails=changeDetails,
-            until_date=until_date
-        )
-        return True
+        originals = dict((item.pk, item) for item in items)
+        items = resolve_subclasses(items)
+        if kwargs.get('cascade', False):
+            items = sum([[item] + [i for i in item.registry_cascade_items if i is not None] for item in items], [])
+        seen = set()
+        items = [item for item in items if not (item.pk in seen or seen.add(item.pk))]
+
+        can_change = perms.user_can_change_status_many(user, items)
+        success = [item for item in items if can_change[item.pk]]
+        failed = [item for item in items if not can_change[item.pk]]
+        if not success:
+            return {'success': success, 'failed': failed}
+
+        ids = [item.pk for item in success]
+        with transaction.atomic():
+            Status.objects.bulk_create([
+                Status(
+                    concept=item,
+                    registrationAuthority=self,
+                    registrationDate=registrationDate,
+                    state=state,
+                    changeDetails=changeDetails,
+                    until_date=until_date
+                )
+                for item in success
+            ], batch_size=500)
+            recache_concepts(ids)
+            states = {}
+            for start in range(0, len(ids), 500):
+                states.update(
+                    (pk, (is_public, is_locked, modified)) for pk, is_public, is_locked, modified in
+                    _concept.objects.filter(pk__in=ids[start:start + 500]).values_list(
+                        'pk', '_is_public', '_is_locked', 'modified'
+                    )
+                )
+            for item in success:
+                for obj in [item, originals.get(item.pk)]:
+                    if obj is not None:
+                        obj._is_public, obj._is_locked, obj.modified = states[item.pk]
+            revision_manager = reversion.revisions.default_revision_manager
+            versioned = [item for item in success if revision_manager.is_registered(item.__class__)]
+            if versioned:
+                revision_manager.save_revision(
+                    versioned, user=user, comment=kwargs.get('revision_comment', changeDetails)
+                )
+        return {'success': success, 'failed': failed}
 
     def giveRoleToUser(self, role, user):
         if role == 'registrar':
@@ -341,12 +367,13 @@ def update_registration_authority_states(sender, instance, created, **kwargs):
     if not created:
         if instance.tracker.has_changed('public_state') \
            or instance.tracker.has_changed('locked_state'):
-            message = (
-                "Registration '{ra}' changed its public or locked status "
-                "level, items registered by this authority may have stale "
-                "visiblity states and need to be manually updated."
-            ).format(ra=instance.name)
-            logger.critical(message)
+            # Items registered by this authority may now have stale visibility
+            # states, so recache them in the background.
+            tasks.defer(
+                'aristotle_mdr.tasks.recache_registration_authority',
+                key='recache_registration_authority_%s' % instance.pk,
+                registration_authority_id=instance.pk
+            )
 
 
 WORKGROUP_OWNERSHIP = Choices(
@@ -423,18 +450,25 @@ class Workgroup(registryGroup):
 
     @property
     def members(self):
-        return self.viewers.all() \
-            | self.submitters.all() \
-            | self.stewards.all() \
-            | self.managers.all()
+        return User.objects.filter(pk__in=self.member_ids())
+
+    def member_ids(self):
+        """
+        Returns the set of ids of the users who hold any role in this
+        workgroup. See ``perms.get_workgroup_member_ids``.
+        """
+        return perms.get_workgroup_member_ids(self)
+
+    def has_member(self, user):
+        return user.pk in self.member_ids()
 
     def can_view(self, user):
-        return self.members.filter(pk=user.pk).exists()
+        return self.pk in perms.get_user_roles(user).workgroups
 
     @property
     def classedItems(self):
         # Convenience class as we can't call functions in templates
-        return self.items.select_subclasses()
+        return resolve_subclasses(self.items.all())
 
     def giveRoleToUser(self, role, user):
         if role == "manager":
@@ -465,44 +499,113 @@ class Workgroup(registryGroup):
         self.managers.remove(user)
 
 
+def recache_workgroup_states(workgroup_id):
+    # Recaching every item in a workgroup is slow, so this is done in the
+    # background, and only once however many changes are made before it runs.
+    tasks.defer(
+        'aristotle_mdr.tasks.recache_workgroup',
+        key='recache_workgroup_%s' % workgroup_id,
+        workgroup_id=workgroup_id
+    )
+
+
 @receiver(post_save, sender=Workgroup)
 def update_ownership(sender, instance, created, **kwargs):
-    # only log if its an edit, not a newly created workgroup
+    perms.workgroup_changed(instance.pk)
+    # only recache if its an edit, not a newly created workgroup
     if not created and instance.tracker.has_changed('ownership'):
-        message = (
-            "Workgroup '{wg}' changed ownership, "
-            "cached public states for items in this workgroup are now "
-            "stale and need to be manually updated."
-        ).format(wg=instance.name)
-        logger.critical(message)
-# This would be like the below, but again, a better solution is needed.
-
-
-def update_registation_authorities(sender, instance, action, **kwargs):
-    # this will be slow, but necessary... perhaps this will encourage people
-    # to not change or add registration authorities to workgroups willy-nilly.
-    if action in ['post_add', 'post_remove', 'post_clear']:
-        created = instance.created >= timezone.now() - \
-            datetime.timedelta(seconds=VERY_RECENTLY_SECONDS)
-        # Don't fire this off if the object was created very recently within
-        # about the last 15 seconds.
-        if not created:
-            message = (
-                "Workgroup '{wg}' has altered registration authorities, "
-                "cached public states for items in this workgroup are now "
-                "stale and need to be manually updated."
-            ).format(wg=instance.name)
-            logger.critical(message)
-    # In practice it seems the below is far too slow, so a better alternative
-    # is needed.
-    #    for item in instance.items.all():
-    #        item.recache_states()
+        recache_workgroup_states(instance.pk)
+
+
+def update_registation_authorities(sender, instance, action, reverse, pk_set, **kwargs):
+    # Which registrars can see items that are ready to review depends on the
+    # authorities of the workgroup, so cached permissions need invalidating,
+    # and which authorities can make items public or locked depends on them
+    # too, so the cached states of the items need recaching.
+    if action == 'pre_clear' and reverse:
+        instance._cleared_workgroups = list(instance.workgroups.values_list('pk', flat=True))
+        return
+    if action not in ['post_add', 'post_remove', 'post_clear']:
+        return
+    if not reverse:
+        workgroup_ids = [instance.pk]
+    elif action == 'post_clear':
+        workgroup_ids = instance.__dict__.pop('_cleared_workgroups', [])
+    else:
+        workgroup_ids = pk_set
+    items = _concept.objects.filter(workgroup__in=workgroup_ids)
+    VisibilityGrant.objects.rebuild(items.values_list('pk', flat=True))
+    for workgroup_id in workgroup_ids:
+        perms.workgroup_changed(workgroup_id)
+    # New workgroups have nothing to recache.
+    for workgroup_id in set(items.values_list('workgroup_id', flat=True)):
+        recache_workgroup_states(workgroup_id)
 m2m_changed.connect(
     update_registation_authorities,
     sender=Workgroup.registrationAuthorities.through
 )
 
 
+def update_user_roles(sender, instance, action, reverse, pk_set, **kwargs):
+    # Any user who gains or loses a role needs their cached roles reloaded.
+    if action == 'pre_clear' and not reverse:
+        # The members are gone by the time 'post_clear' is sent, so note them
+        # down now.
+        instance._cleared_role_users = list(sender.objects.filter(
+            **{instance._meta.model_name: instance}
+        ).values_list('user_id', flat=True))
+        return
+    if action not in ['post_add', 'post_remove', 'post_clear']:
+        return
+    if reverse:
+        user_ids = [instance.pk]
+    elif action == 'post_clear':
+        user_ids = instance.__dict__.pop('_cleared_role_users', [])
+    else:
+        user_ids = pk_set
+    for user_id in user_ids:
+        perms.user_roles_changed(user_id)
+for role in [Workgroup.viewers, Workgroup.submitters, Workgroup.stewards,
+             Workgroup.managers, RegistrationAuthority.registrars,
+             RegistrationAuthority.managers]:
+    m2m_changed.connect(update_user_roles, sender=role.through)
+
+
+def update_workgroup_members(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear' and reverse:
+        # The workgroups are gone by the time 'post_clear' is sent, so note
+        # them down now.
+        instance._cleared_role_workgroups = list(sender.objects.filter(
+            user=instance
+        ).values_list('workgroup_id', flat=True))
+        return
+    if action not in ['post_add', 'post_remove', 'post_clear']:
+        return
+    if not reverse:
+        workgroup_ids = [instance.pk]
+    elif action == 'post_clear':
+        workgroup_ids = instance.__dict__.pop('_cleared_role_workgroups', [])
+    else:
+        workgroup_ids = pk_set
+    for workgroup_id in workgroup_ids:
+        perms.workgroup_members_changed(workgroup_id)
+for role in [Workgroup.viewers, Workgroup.submitters, Workgroup.stewards, Workgroup.managers]:
+    m2m_changed.connect(update_workgroup_members, sender=role.through)
+
+
+@receiver(pre_delete, sender=User)
+def remove_deleted_member(sender, instance, **kwargs):
+    # Deleting a user removes their roles without sending m2m_changed.
+    for role in [Workgroup.viewers, Workgroup.submitters, Workgroup.stewards, Workgroup.managers]:
+        for workgroup_id in role.through.objects.filter(user=instance).values_list('workgroup_id', flat=True):
+            perms.workgroup_members_changed(workgroup_id)
+
+
+@receiver(post_delete, sender=Workgroup)
+def forget_workgroup_members(sender, instance, **kwargs):
+    perms.workgroup_members_changed(instance.pk)
+
+
 class discussionAbstract(TimeStampedModel):
     body = models.TextField()
     author = models.ForeignKey(User)
@@ -564,19 +667,18 @@ class ConceptQuerySet(InheritanceQuerySet):
             return self.all()
         if user.is_anonymous():
             return self.public()
+        roles = perms.get_user_roles(user)
         q = Q(_is_public=True)
-        if user.profile.workgroups:
-            # User can see everything in their workgroups.
-            q |= Q(workgroup__in=user.profile.workgroups)
-            # q |= Q(workgroup__user__profile=user)
-        if user.profile.is_registrar:
-            authorities = user.profile.registrarAuthorities.all()
-            # User can see everything that is "readyToReview" or registered in
-            # their workgroup.
-            q |= Q(workgroup__registrationAuthorities__in=authorities,
-                   readyToReview=True)
-            q |= Q(workgroup__registrationAuthorities__in=authorities,
-                   statuses__registrationAuthority__in=authorities)
+        # User can see everything in their workgroups, and everything that is
+        # "readyToReview" or registered in their authorities, as recorded in
+        # the visibility grants.
+        principals = Q()
+        if roles.workgroups:
+            principals |= Q(workgroup__in=roles.workgroups)
+        if roles.registrar_in:
+            principals |= Q(registrationAuthority__in=roles.registrar_in)
+        if principals:
+            q |= Q(pk__in=VisibilityGrant.objects.filter(principals).values('concept_id'))
         return self.filter(q)
 
     def editable(self, user):
@@ -596,16 +698,108 @@ class ConceptQuerySet(InheritanceQuerySet):
             return self.all()
         if user.is_anonymous():
             return self.none()
+        roles = perms.get_user_roles(user)
         q = Q()
-        if user.submitter_in.exists() or user.steward_in.exists():
-            if user.submitter_in.exists():
-                q |= Q(_is_locked=False, workgroup__in=user.submitter_in.all())
-            if user.steward_in.exists():
-                q |= Q(workgroup__in=user.steward_in.all())
+        if roles.submitter_in or roles.steward_in:
+            if roles.submitter_in:
+                q |= Q(_is_locked=False, workgroup__in=roles.submitter_in)
+            if roles.steward_in:
+                q |= Q(workgroup__in=roles.steward_in)
             return self.filter(q)
         else:
             return self.none()
 
+    def recache_states(self, dry_run=False):
+        """
+        Recomputes the cached public and locked states of every item in the
+        queryset, following the same logic as ``_concept.check_is_public`` and
+        ``_concept.check_is_locked``. This uses a fixed number of aggregate
+        queries no matter how many items there are, and only writes rows whose
+        states have changed using ``update()``, so unlike
+        ``_concept.recache_states`` no save signals or revisions are created.
+
+        Returns a list of the ids of the items whose states changed, or would
+        change if ``dry_run`` is ``True``.
+        """
+        when = timezone.now()
+        concepts = list(_concept.objects.filter(pk__in=self.values('pk')).values_list(
+            'pk', 'workgroup_id', '_is_public', '_is_locked'
+        ))
+        if not concepts:
+            return []
+        wg_ids = set(wg_id for pk, wg_id, public, locked in concepts)
+        ownership = dict(Workgroup.objects.filter(pk__in=wg_ids).values_list('pk', 'ownership'))
+        workgroup_ras = {}
+        for wg_id, ra_id in Workgroup.registrationAuthorities.through.objects.filter(
+                workgroup_id__in=wg_ids).values_list('workgroup_id', 'registrationauthority_id'):
+            workgroup_ras.setdefault(wg_id, set()).add(ra_id)
+        ra_states = dict(
+            (pk, (public_state, locked_state))
+            for pk, public_state, locked_state in RegistrationAuthority.objects.values_list(
+                'pk', 'public_state', 'locked_state'
+            )
+        )
+
+        current_states = {}
+        statuses = Status.objects.filter(concept__in=self.values('pk')).current(when).values_list(
+            'concept_id', 'registrationAuthority_id', 'state'
+        )
+        for concept_id, ra_id, state in statuses:
+            current_states.setdefault(concept_id, {})[ra_id] = state
+
+        changes = {}
+        for pk, wg_id, was_public, was_locked in concepts:
+            states = current_states.get(pk, {}).items()
+            if ownership[wg_id] == WORKGROUP_OWNERSHIP.authority:
+                states = [(ra_id, state) for ra_id, state in states if ra_id in workgroup_ras.get(wg_id, [])]
+            is_public = any(state >= ra_states[ra_id][0] for ra_id, state in states)
+            is_locked = any(state >= ra_states[ra_id][1] for ra_id, state in states)
+            if (is_public, is_locked) != (was_public, was_locked):
+                changes.setdefault((is_public, is_locked), []).append(pk)
+
+        changed = sum(changes.values(), [])
+        if dry_run:
+            return changed
+        now = timezone.now()
+        for (is_public, is_locked), pks in changes.items():
+            for start in range(0, len(pks), 500):
+                _concept.objects.filter(pk__in=pks[start:start + 500]).update(
+                    _is_public=is_public, _is_locked=is_locked, modified=now
+                )
+        for pk in changed:
+            perms.concept_changed(pk)
+        return changed
+
+    def get_subclass(self, *args, **kwargs):
+        """
+        Returns the single matching item as an instance of its concrete
+        subclass, using the stored content type rather than joining every
+        subclass table.
+        """
+        return self.get(*args, **kwargs).item
+
+    def resolve_subclasses(self):
+        """
+        Returns a list of the items in the queryset as instances of their
+        concrete subclasses, in the same order. See ``resolve_subclasses``.
+        """
+        return resolve_subclasses(self)
+
+    def with_current_statuses(self, when=None):
+        """
+        Prefetches the current statuses of every item in the queryset on the
+        date ``when`` (today by default), in one extra query for the whole
+        queryset. ``current_status_list`` on the returned items then returns
+        these instead of querying the database again.
+        """
+        return self.prefetch_related(Prefetch(
+            'statuses',
+            queryset=Status.objects.current(when).select_related('registrationAuthority').order_by(
+                "registrationAuthority", "-registrationDate", "-created"
+            ),
+            to_attr='_prefetched_current_statuses'
+        ))
+
     def public(self):
         """
         Returns a list of public items from the queryset.
@@ -621,6 +815,69 @@ class ConceptQuerySet(InheritanceQuerySet):
         return self.filter(_is_public=True)
 
 
+def resolve_subclasses(concepts):
+    """
+    Takes a list or queryset of concepts, and returns a list of the same items
+    as instances of their concrete subclasses, in the same order.
+
+    Unlike ``select_subclasses`` this doesn't join every subclass table.
+    The items are grouped by their stored content type, and each type is
+    fetched with one query that only joins the tables that type needs.
+    Items that don't have a content type stored yet are looked up with
+    ``select_subclasses`` and have it stored for next time.
+    """
+    concepts = list(concepts)
+    ids_by_type = {}
+    for concept in concepts:
+        ids_by_type.setdefault(concept._concrete_type_id, []).append(concept.pk)
+
+    resolved = {}
+    untyped = ids_by_type.pop(None, [])
+    for ct_id, ids in ids_by_type.items():
+        model = ContentType.objects.get_for_id(ct_id).model_class()
+        if model is None or model is _concept:
+            # The app the type belongs to has been removed, or the type was
+            # stored wrongly for a bare _concept.
+            untyped.extend(ids)
+            continue
+        resolved.update((item.pk, item) for item in model.objects.filter(pk__in=ids))
+    if untyped:
+        for item in _concept.objects.filter(pk__in=untyped).select_subclasses():
+            resolved[item.pk] = item
+            item.store_concrete_type()
+    # Items that have been deleted since the list was fetched are left out.
+    return [resolved[concept.pk] for concept in concepts if concept.pk in resolved]
+
+
+def store_missing_concrete_types(batch_size=500, using='default'):
+    """
+    Stores the content type of every item that doesn't have one yet, such as
+    items of models that weren't available when the type was first recorded
+    by migration ``0014``. Each batch of items is looked up through the
+    subclass tables, and each type is stored with one update. Returns the
+    number of items that had a type stored.
+    """
+    concepts = _concept.objects.using(using)
+    # Types stored wrongly for a bare _concept are looked up again too.
+    bare_type = ContentType.objects.db_manager(using).get_for_model(_concept)
+    untyped = Q(_concrete_type__isnull=True) | Q(_concrete_type=bare_type)
+    stored = 0
+    last_pk = 0
+    while True:
+        batch = list(concepts.filter(untyped, pk__gt=last_pk).order_by('pk').select_subclasses()[:batch_size])
+        if not batch:
+            return stored
+        last_pk = batch[-1].pk
+        ids_by_model = {}
+        for item in batch:
+            # Items without a row in any subclass table stay untyped.
+            if type(item) is not _concept:
+                ids_by_model.setdefault(type(item), []).append(item.pk)
+        for model, ids in ids_by_model.items():
+            ct = ContentType.objects.db_manager(using).get_for_model(model)
+            stored += concepts.filter(pk__in=ids).update(_concrete_type=ct)
+
+
 class ConceptManager(InheritanceManager):
     """
     The ``ConceptManager`` is the default object manager for ``concept`` and
@@ -659,6 +916,11 @@ class _concept(baseAristotleObject):
     # To be usable these must be updated when statuses are changed
     _is_public = models.BooleanField(default=False)
     _is_locked = models.BooleanField(default=False)
+    # The concrete subclass of the item, so it can be fetched without joining
+    # every subclass table.
+    _concrete_type = models.ForeignKey(
+        ContentType, null=True, blank=True, editable=False, related_name='+'
+    )
 
     tracker = FieldTracker()
 
@@ -677,53 +939,83 @@ class _concept(baseAristotleObject):
         return len(changed.keys()) > 0
 
     def can_edit(self, user):
+        roles = perms.get_user_roles(user)
         if self.is_public():
-            return self.workgroup.stewards.filter(pk=user.pk).exists()
+            return self.workgroup_id in roles.steward_in
         elif self.is_locked():
-            return self.workgroup.stewards.filter(pk=user.pk).exists()
-        elif self.is_registered:
-            return self.workgroup.submitters.filter(pk=user.pk).exists() \
-                or self.workgroup.stewards.filter(pk=user.pk).exists()
+            return self.workgroup_id in roles.steward_in
         else:
-            return self.workgroup.submitters.filter(pk=user.pk).exists() \
-                or self.workgroup.stewards.filter(pk=user.pk).exists()
+            return self.workgroup_id in roles.editable_workgroups
 
     def can_view(self, user):
         if self.is_public():
             return True
         elif user.is_anonymous():
             return False
+        roles = perms.get_user_roles(user)
         # If the user can view objects in this workgroup
-        if self.workgroup.members.filter(pk=user.pk).exists():
+        if self.workgroup_id in roles.workgroups:
             return True
         # If the item is registered and the user is a registrar view view
         # permissions in that authority.
-        if self.is_registered:
-            for s in self.statuses.all():
-                ra = s.registrationAuthority
-                if ra.registrars.filter(pk=user.pk).exists():
-                    return True
+        if roles.registrar_in and self.statuses.filter(
+                registrationAuthority__in=roles.registrar_in).exists():
+            return True
         if self.readyToReview:
             if self.workgroup.ownership == WORKGROUP_OWNERSHIP.authority:
-                for ra in self.workgroup.registrationAuthorities.all():
-                    if ra.registrars.filter(pk=user.pk).exists():
-                        return True
+                if roles.registrar_in and self.workgroup.registrationAuthorities.filter(
+                        pk__in=roles.registrar_in).exists():
+                    return True
             else:
                 if self.workgroup.registrationAuthorities.count() > 0:
-                    for ra in self.workgroup.registrationAuthorities.all():
-                        if ra.registrars.filter(pk=user.pk).exists():
-                            return True
+                    if roles.registrar_in and self.workgroup.registrationAuthorities.filter(
+                            pk__in=roles.registrar_in).exists():
+                        return True
                 else:
                     return True
         return False
 
+    def save(self, *args, **kwargs):
+        if self._concrete_type_id is None:
+            if type(self) is not _concept:
+                self._concrete_type = ContentType.objects.get_for_model(self)
+            elif self.pk is not None:
+                # A bare _concept, such as one saved when its statuses are
+                # recached, only knows its real type by looking it up.
+                item = _concept.objects.filter(pk=self.pk).select_subclasses().first()
+                if item is not None and type(item) is not _concept:
+                    self._concrete_type = ContentType.objects.get_for_model(item)
+        super(_concept, self).save(*args, **kwargs)
+
+    def store_concrete_type(self):
+        """
+        Stores the content type of this item, which must be an instance of its
+        concrete subclass, for items saved before it was recorded. Nothing is
+        stored for a bare ``_concept``, as its subclass isn't known.
+        """
+        if type(self) is _concept:
+            return
+        self._concrete_type = ContentType.objects.get_for_model(self)
+        _concept.objects.filter(pk=self.pk).update(_concrete_type=self._concrete_type)
+
     @property
     def item(self):
         """
-        Performs a lookup using ``model_utils.managers.InheritanceManager`` to
-        find the subclassed item.
+        Returns the item as an instance of its concrete subclass, using the
+        stored content type to query only the tables that subclass needs.
+        If no type is stored yet, falls back to a lookup using
+        ``model_utils.managers.InheritanceManager``.
         """
-        return _concept.objects.get_subclass(pk=self.pk)
+        model = None
+        if self._concrete_type_id is not None:
+            model = ContentType.objects.get_for_id(self._concrete_type_id).model_class()
+        if model is None or model is _concept:
+            item = _concept.objects.select_subclasses().get(pk=self.pk)
+            item.store_concrete_type()
+            return item
+        if type(self) is model:
+            return self
+        return model.objects.get(pk=self.pk)
 
     @property
     def concept(self):
@@ -775,7 +1067,7 @@ class _concept(baseAristotleObject):
             STATES.retired == status.state for status in self.statuses.all()
         ) and self.statuses.count() > 0
 
-    def check_is_public(self, when=timezone.now()):
+    def check_is_public(self, when=None):
         """
             A concept is public if any registration authority of the workgroup
             has advanced it to a public state in that RA.
@@ -800,7 +1092,7 @@ class _concept(baseAristotleObject):
     is_public.boolean = True
     is_public.short_description = 'Public'
 
-    def check_is_locked(self, when=timezone.now()):
+    def check_is_locked(self, when=None):
         """
         A concept is locked if any registration authority of the workgroup
         has advanced it to a locked state in that RA.
@@ -828,35 +1120,34 @@ class _concept(baseAristotleObject):
         self._is_locked = self.check_is_locked()
         self.save()
 
-    def current_statuses(self, qs=None, when=timezone.now()):
+    def current_statuses(self, qs=None, when=None):
+        """
+        Returns the current status of this item in each registration
+        authority on the date ``when``, which defaults to today. If ``qs`` is
+        given, only the current statuses within that queryset of this items
+        statuses are returned.
+
+        This always queries the database. Use ``current_status_list`` to
+        make use of statuses prefetched with
+        ``ConceptQuerySet.with_current_statuses``.
+        """
         if qs is None:
             qs = self.statuses.all()
-        if hasattr(when, 'date'):
-            when = when.date()
-        registered_before_now = Q(registrationDate__lte=when)
-        registation_still_valid = (
-            Q(until_date__gte=when) |
-            Q(until_date__isnull=True)
+        return qs.current(when).select_related('registrationAuthority').order_by(
+            "registrationAuthority", "-registrationDate", "-created"
         )
 
-        states = qs.filter(
-            registered_before_now & registation_still_valid
-        ).order_by("registrationAuthority", "-registrationDate", "-created")
-
-        from django.db import connection
-        if connection.vendor == 'postgresql':
-            states = states.distinct('registrationAuthority')
-        else:
-            current_ids = []
-            seen_ras = []
-            for s in states:
-                ra = s.registrationAuthority
-                if ra not in seen_ras:
-                    current_ids.append(s.pk)
-                    seen_ras.append(ra)
-            # We hit again so we can return this as a queryset
-            states = states.filter(pk__in=current_ids)
-        return states
+    @property
+    def current_status_list(self):
+        """
+        A list of the current statuses of this item today. If the item was
+        fetched with ``ConceptQuerySet.with_current_statuses`` the prefetched
+        statuses are used, otherwise they are looked up with
+        ``current_statuses()``.
+        """
+        if hasattr(self, '_prefetched_current_statuses'):
+            return self._prefetched_current_statuses
+        return list(self.current_statuses())
 
     def get_download_items(self):
         """
@@ -868,6 +1159,9 @@ class _concept(baseAristotleObject):
         When overriding, each entry in the list must be a two item tuple, with
         the first entry being the python class of the item or items being
         included, and the second being the queryset of items to include.
+
+        Cached PDF downloads are rendered again when any of these items
+        change, but not when other related items shown in the download do.
         """
         return []
 
@@ -919,6 +1213,49 @@ class concept(_concept):
         return self
 
 
+class StatusQuerySet(models.QuerySet):
+    def current(self, when=None):
+        """
+        Returns the statuses in the queryset that are current on the date
+        ``when``, which defaults to today. A status is current if it is valid
+        on that date, and no other valid status for the same item and
+        registration authority is more recent.
+
+        This uses a correlated ``NOT EXISTS`` subquery, so it takes one query
+        on every database backend.
+        """
+        if when is None:
+            when = timezone.now()
+        if hasattr(when, 'date'):
+            when = when.date()
+        qn = connections[self.db].ops.quote_name
+
+        def column(table, field):
+            return "%s.%s" % (table, qn(self.model._meta.get_field(field).column))
+
+        outer = qn(self.model._meta.db_table)
+        newer = qn('newer_status')
+        newer_exists = (
+            "NOT EXISTS (SELECT 1 FROM {table} {newer} WHERE"
+            " {n_concept} = {concept} AND {n_ra} = {ra}"
+            " AND {n_date} <= %s AND ({n_until} >= %s OR {n_until} IS NULL)"
+            " AND ({n_date} > {date} OR ({n_date} = {date} AND"
+            " ({n_created} > {created} OR ({n_created} = {created} AND {n_pk} > {pk})))))"
+        ).format(
+            table=outer, newer=newer,
+            n_concept=column(newer, 'concept'), concept=column(outer, 'concept'),
+            n_ra=column(newer, 'registrationAuthority'), ra=column(outer, 'registrationAuthority'),
+            n_date=column(newer, 'registrationDate'), date=column(outer, 'registrationDate'),
+            n_until=column(newer, 'until_date'),
+            n_created=column(newer, 'created'), created=column(outer, 'created'),
+            n_pk=column(newer, 'id'), pk=column(outer, 'id'),
+        )
+        return self.filter(
+            Q(until_date__gte=when) | Q(until_date__isnull=True),
+            registrationDate__lte=when,
+        ).extra(where=[newer_exists], params=[when, when])
+
+
 class Status(TimeStampedModel):
     concept = models.ForeignKey(_concept, related_name="statuses")
     registrationAuthority = models.ForeignKey(RegistrationAuthority)
@@ -934,6 +1271,8 @@ class Status(TimeStampedModel):
     )
     tracker = FieldTracker()
 
+    objects = StatusQuerySet.as_manager()
+
     class Meta:
         verbose_name_plural = "Statuses"
 
@@ -951,12 +1290,222 @@ class Status(TimeStampedModel):
         )
 
 
+_deferred_recache = threading.local()
+
+
+def recache_concepts(concept_ids):
+    """
+    Recomputes the cached public and locked states and the visibility grants
+    of the concepts with the given ids together, 500 at a time, with
+    ``ConceptQuerySet.recache_states`` and ``VisibilityGrantManager.rebuild``.
+    The cached permissions of each concept are invalidated, and every concept
+    is marked as modified, as its statuses have changed even when its states
+    haven't.
+    """
+    concept_ids = list(concept_ids)
+    now = timezone.now()
+    for start in range(0, len(concept_ids), 500):
+        chunk = concept_ids[start:start + 500]
+        _concept.objects.filter(pk__in=chunk).recache_states()
+        _concept.objects.filter(pk__in=chunk).update(modified=now)
+        VisibilityGrant.objects.rebuild(chunk)
+    for pk in concept_ids:
+        # New statuses can let registrars see an item even when its public
+        # and locked states haven't changed.
+        perms.concept_changed(pk)
+
+
+@contextmanager
+def deferred_recache():
+    """
+    Stops saving or deleting a status from recaching the states of its item
+    straight away. Instead the ids of the items are collected, and when the
+    outermost ``deferred_recache`` block finishes they are all recached at
+    once with ``recache_concepts`` and updated in the search index. This
+    should be used inside any transaction around the changes, as nothing is
+    recached if the block raises an exception::
+
+        with transaction.atomic(), deferred_recache():
+            for status in statuses:
+                status.save()
+    """
+    if getattr(_deferred_recache, 'concept_ids', None) is not None:
+        # An outer block will do the recache.
+        yield
+        return
+    _deferred_recache.concept_ids = set()
+    try:
+        yield
+        concept_ids = sorted(_deferred_recache.concept_ids)
+    finally:
+        _deferred_recache.concept_ids = None
+    if not concept_ids:
+        return
+    recache_concepts(concept_ids)
+    from haystack import signal_processor
+    if hasattr(signal_processor, 'handle_concept_revision'):
+        signal_processor.handle_concept_revision(
+            resolve_subclasses(_concept.objects.filter(pk__in=concept_ids))
+        )
+
+
 def recache_concept_states(sender, instance, *args, **kwargs):
+    if getattr(_deferred_recache, 'concept_ids', None) is not None:
+        _deferred_recache.concept_ids.add(instance.concept_id)
+        return
     instance.concept.recache_states()
 post_save.connect(recache_concept_states, sender=Status)
 post_delete.connect(recache_concept_states, sender=Status)
 
 
+class DeferredTask(TimeStampedModel):
+    """
+    A task waiting to be run in the background by ``aristotle_mdr.tasks``.
+    Tasks with the same ``key`` that haven't started yet are only queued once,
+    which the database enforces by setting ``pending_key`` to the key until
+    the task starts.
+    """
+    task = models.CharField(max_length=256)
+    key = models.CharField(max_length=256, db_index=True)
+    pending_key = models.CharField(max_length=256, blank=True, null=True, unique=True)
+    arguments = models.TextField(default="{}")
+    started = models.DateTimeField(blank=True, null=True)
+    run_after = models.DateTimeField(blank=True, null=True)
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+
+    def __unicode__(self):
+        return self.key
+
+
+class VisibilityGrantManager(models.Manager):
+    def rebuild(self, concept_ids):
+        """
+        Brings the grants for the concepts with the given ids up to date with
+        their workgroups, authorities and statuses, using a fixed number of
+        queries. Returns a tuple of the number of grants added and removed.
+        """
+        concept_ids = list(concept_ids)
+        if not concept_ids:
+            return 0, 0
+        concepts = list(_concept.objects.filter(pk__in=concept_ids).values_list(
+            'pk', 'workgroup_id', 'readyToReview'
+        ))
+        workgroup_ras = {}
+        for wg_id, ra_id in Workgroup.registrationAuthorities.through.objects.filter(
+                workgroup_id__in=set(wg_id for pk, wg_id, ready in concepts)
+        ).values_list('workgroup_id', 'registrationauthority_id'):
+            workgroup_ras.setdefault(wg_id, set()).add(ra_id)
+        registered_in = {}
+        for concept_id, ra_id in Status.objects.filter(concept__in=concept_ids).values_list(
+                'concept_id', 'registrationAuthority_id').distinct():
+            registered_in.setdefault(concept_id, set()).add(ra_id)
+
+        wanted = set()
+        for pk, wg_id, ready in concepts:
+            wanted.add((pk, wg_id, None))
+            # Registrars can see items registered in their authority, and
+            # items that are ready for review in workgroups their authority
+            # is associated with.
+            ra_ids = set(registered_in.get(pk, []))
+            if ready:
+                ra_ids.update(workgroup_ras.get(wg_id, []))
+            for ra_id in ra_ids:
+                wanted.add((pk, None, ra_id))
+
+        stale = []
+        for grant in self.filter(concept__in=concept_ids).values_list(
+                'pk', 'concept_id', 'workgroup_id', 'registrationAuthority_id'):
+            if grant[1:] in wanted:
+                wanted.remove(grant[1:])
+            else:
+                stale.append(grant[0])
+        if stale:
+            self.filter(pk__in=stale).delete()
+        self.bulk_create([
+            self.model(concept_id=pk, workgroup_id=wg_id, registrationAuthority_id=ra_id)
+            for pk, wg_id, ra_id in wanted
+        ])
+        return len(wanted), len(stale)
+
+
+class VisibilityGrant(models.Model):
+    """
+    A denormalised record that members of a workgroup, or registrars of a
+    registration authority, can view a concept. These are kept up to date by
+    signals when concepts, statuses and workgroups change, so that
+    ``ConceptQuerySet.visible`` can check permissions without joining through
+    workgroups and statuses. They can be rebuilt from scratch with the
+    ``rebuild_visibility_grants`` management command.
+    """
+    # Statuses are deleted before the items or authorities they belong to, and
+    # the resulting recache can add grants after Django has collected what
+    # to cascade. So these aren't database constraints and grants are removed
+    # in post_delete instead.
+    concept = models.ForeignKey(
+        _concept, related_name="visibility_grants",
+        on_delete=models.DO_NOTHING, db_constraint=False
+    )
+    workgroup = models.ForeignKey(
+        Workgroup, blank=True, null=True,
+        on_delete=models.DO_NOTHING, db_constraint=False
+    )
+    registrationAuthority = models.ForeignKey(
+        RegistrationAuthority, blank=True, null=True,
+        on_delete=models.DO_NOTHING, db_constraint=False
+    )
+
+    objects = VisibilityGrantManager()
+
+
+@receiver(post_save)
+def update_visibility_grants(sender, instance, **kwargs):
+    if not issubclass(sender, _concept):
+        return
+    VisibilityGrant.objects.rebuild([instance.pk])
+
+
+# Deleting any concept deletes its base _concept row too, so only that needs
+# handling. These only listen to the models they need, as receivers for every
+# model stop Django from deleting anything without fetching it first.
+@receiver(post_delete, sender=_concept)
+@receiver(post_delete, sender=Workgroup)
+@receiver(post_delete, sender=RegistrationAuthority)
+def remove_visibility_grants(sender, instance, **kwargs):
+    if sender is _concept:
+        VisibilityGrant.objects.filter(concept_id=instance.pk).delete()
+    elif sender == Workgroup:
+        VisibilityGrant.objects.filter(workgroup_id=instance.pk).delete()
+    elif sender == RegistrationAuthority:
+        VisibilityGrant.objects.filter(registrationAuthority_id=instance.pk).delete()
+
+
+def concept_models():
+    """
+    Returns ``_concept`` and every class that inherits from it that has been
+    defined so far.
+    """
+    models = [_concept]
+    for model in models:
+        models.extend(sub for sub in model.__subclasses__() if sub not in models)
+    return models
+
+
+def connect_to_concept_models(signal, receiver):
+    """
+    Connects ``receiver`` to ``signal`` for ``_concept`` and every model that
+    inherits from it, including models defined later, instead of for every
+    model in the project.
+    """
+    for model in concept_models():
+        signal.connect(receiver, sender=model)
+
+    def connect_new_model(sender, **kwargs):
+        if issubclass(sender, _concept):
+            signal.connect(receiver, sender=sender)
+    class_prepared.connect(connect_new_model, weak=False)
+
+
 class ObjectClass(concept):
     """
     Set of ideas, abstractions or things in the real world that are
@@ -1244,12 +1793,9 @@ class PossumProfile(models.Model):
         if self.user.is_superuser:
             return Workgroup.objects.all()
         else:
-            return (
-                self.user.viewer_in.all() |
-                self.user.submitter_in.all() |
-                self.user.steward_in.all() |
-                self.user.workgroup_manager_in.all()
-            ).distinct()
+            return Workgroup.objects.filter(
+                pk__in=perms.get_user_roles(self.user).workgroups
+            )
 
     @property
     def myWorkgroups(self):
@@ -1260,10 +1806,10 @@ class PossumProfile(models.Model):
         if self.user.is_superuser:
             return Workgroup.objects.all()
         else:
-            return (
-                self.user.submitter_in.all() |
-                self.user.steward_in.all()
-            ).distinct().filter(archived=False)
+            return Workgroup.objects.filter(
+                pk__in=perms.get_user_roles(self.user).editable_workgroups,
+                archived=False
+            )
 
     @property
     def is_registrar(self):
@@ -1281,7 +1827,9 @@ class PossumProfile(models.Model):
         if self.user.is_superuser:
             return RegistrationAuthority.objects.all()
         else:
-            return self.user.registrar_in.all()
+            return RegistrationAuthority.objects.filter(
+                pk__in=perms.get_user_roles(self.user).registrar_in
+            )
 
     def is_workgroup_manager(self, wg=None):
         return perms.user_is_workgroup_manager(self.user, wg)
@@ -1299,6 +1847,9 @@ class PossumProfile(models.Model):
 def create_user_profile(sender, instance, created, **kwargs):
     if created:
         profile, created = PossumProfile.objects.get_or_create(user=instance)
+        # Make sure a new user never picks up roles cached for an old user
+        # with the same id.
+        perms.user_roles_changed(instance.pk)
 post_save.connect(create_user_profile, sender=User)
 
 
@@ -1386,6 +1937,9 @@ def defaultData():
 def concept_saved(sender, instance, created, **kwargs):
     if not issubclass(sender, _concept):
         return
+    # Any change to an item, including its cached public and locked states,
+    # can change who is allowed to view or edit it.
+    perms.concept_changed(instance.pk)
     if not instance.non_cached_fields_changed:
         # If the only thing that has changed is a cached public/locked status
         # then don't notify.
@@ -1393,29 +1947,21 @@ def concept_saved(sender, instance, created, **kwargs):
     if kwargs.get('raw'):
         # Don't run during loaddata
         return
-    for p in instance.favourited_by.all():
-        messages.favourite_updated(recipient=p.user, obj=instance)
-    for user in instance.workgroup.viewers.all():
-        if created:
-            messages.workgroup_item_new(recipient=user, obj=instance)
-        else:
-            messages.workgroup_item_updated(recipient=user, obj=instance)
-    try:
-        # This will fail during first load, and if admins delete aristotle.
-        system = User.objects.get(username="aristotle")
-        for post in instance.relatedDiscussions.all():
-            DiscussionComment.objects.create(
-                post=post,
-                body='The item "{name}" (id:{iid}) has been changed.\n\n\
-                    <a href="{url}">View it on the main site.</a>.'.format(
-                    name=instance.name,
-                    iid=instance.id,
-                    url=reverse("aristotle:item", args=[instance.id])
-                ),
-                author=system,
-            )
-    except:
-        pass
+    # Notifying everyone can take thousands of inserts, so it is done by a
+    # deferred task after the save has been committed. Saves made before it
+    # runs are covered by the same task.
+    tasks.defer(
+        'aristotle_mdr.messages.concept_changed',
+        key='concept_changed_notifications_%s' % instance.pk,
+        delay=getattr(settings, 'ARISTOTLE_SETTINGS', {}).get('NOTIFICATION_DELAY_SECONDS', 30),
+        concept_id=instance.pk
+    )
+
+
+@receiver(post_delete, sender=_concept)
+def concept_deleted(sender, instance, **kwargs):
+    # Deleting any concept deletes its base _concept row too.
+    perms.concept_changed(instance.pk)
 
 
 @receiver(post_save, sender=DiscussionComment)
@@ -1440,9 +1986,7 @@ def new_post_created(sender, **kwargs):
         return
     if not kwargs['created']:
         return  # We don't need to notify a topic poster of an edit.
-    for user in post.workgroup.members.all():
-        if user != post.author:
-            messages.new_post_created(post, user)
+    messages.queue_post_notifications(post)
 
 
 # Loads example data, this is never used in formal testing.
@@ -2,8 +2,258 @@ from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.cache import cache
 
-VIEW_CACHE_SECONDS=60
-EDIT_CACHE_SECONDS=60
+from collections import OrderedDict
+import hashlib
+import threading
+import time
+
+VIEW_CACHE_SECONDS=60 * 60 * 6
+EDIT_CACHE_SECONDS=60 * 60 * 6
+ROLES_CACHE_SECONDS=60 * 60 * 24
+UNSTAMPED_CACHE_SECONDS=60
+
+
+def _get_generation(key):
+    generation = cache.get(key)
+    if generation is None:
+        # Start from the current time so a generation that has been evicted
+        # from the cache never reuses an old number.
+        generation = int(time.time() * 1000)
+        cache.add(key, generation, None)
+    return generation
+
+
+def _bump_generation(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, int(time.time() * 1000), None)
+
+
+class PublicItemCache(object):
+    """
+    A least recently used set of items that anonymous users are known to be
+    able to view, kept in the memory of each process. Entries expire after
+    ``timeout`` seconds as other processes can't invalidate them, and the
+    ``hits`` and ``misses`` counters can be read from ``stats()`` to tune the
+    size on read-heavy public registries.
+    """
+    def __init__(self, size=1000, timeout=60):
+        self.size = size
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            expires = self._items.pop(key, None)
+            if expires is not None and expires > time.time():
+                self._items[key] = expires
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def add(self, key):
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = time.time() + self.timeout
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._items)}
+
+public_items = PublicItemCache(
+    size=getattr(settings, 'ARISTOTLE_SETTINGS', {}).get('PUBLIC_ITEM_CACHE_SIZE', 1000),
+    timeout=getattr(settings, 'ARISTOTLE_SETTINGS', {}).get('PUBLIC_ITEM_CACHE_SECONDS', 60),
+)
+
+
+def _item_key(item):
+    return '%s.%s|%s' % (item._meta.app_label, item._meta.model_name, item.pk)
+
+
+class RoleSnapshot(object):
+    """
+    The workgroups and registration authorities a user holds each role in,
+    stored as frozensets of ids. This is loaded once and cached against a
+    version number that is bumped whenever the users roles change, so
+    permission checks can use set lookups instead of querying the membership
+    ``ManyToManyFields`` over and over.
+    """
+    def __init__(self, version=None, viewer_in=(), submitter_in=(), steward_in=(),
+                 workgroup_manager_in=(), registrar_in=(), registrationauthority_manager_in=()):
+        self.version = version
+        self.viewer_in = frozenset(viewer_in)
+        self.submitter_in = frozenset(submitter_in)
+        self.steward_in = frozenset(steward_in)
+        self.workgroup_manager_in = frozenset(workgroup_manager_in)
+        self.registrar_in = frozenset(registrar_in)
+        self.registrationauthority_manager_in = frozenset(registrationauthority_manager_in)
+
+    @classmethod
+    def load(cls, user, version=None):
+        return cls(
+            version=version,
+            viewer_in=user.viewer_in.values_list('pk', flat=True),
+            submitter_in=user.submitter_in.values_list('pk', flat=True),
+            steward_in=user.steward_in.values_list('pk', flat=True),
+            workgroup_manager_in=user.workgroup_manager_in.values_list('pk', flat=True),
+            registrar_in=user.registrar_in.values_list('pk', flat=True),
+            registrationauthority_manager_in=user.registrationauthority_manager_in.values_list('pk', flat=True),
+        )
+
+    @property
+    def workgroups(self):
+        """All workgroups the user is a member of, in any role."""
+        return self.viewer_in | self.submitter_in | self.steward_in | self.workgroup_manager_in
+
+    @property
+    def editable_workgroups(self):
+        return self.submitter_in | self.steward_in
+
+
+def get_user_roles(user):
+    """
+    Returns the ``RoleSnapshot`` for a user. The snapshot is kept on the user
+    object for the rest of the request and in the cache across requests, and
+    is reloaded whenever the version of the users roles has changed.
+    """
+    if user.is_anonymous():
+        return RoleSnapshot()
+    version = _get_generation('user_roles_version_%s' % user.pk)
+    roles = getattr(user, '_aristotle_roles', None)
+    if roles is not None and roles.version == version:
+        return roles
+    key = 'user_roles_%s|%s' % (user.pk, version)
+    roles = cache.get(key)
+    if roles is None:
+        roles = RoleSnapshot.load(user, version)
+        cache.set(key, roles, ROLES_CACHE_SECONDS)
+    user._aristotle_roles = roles
+    return roles
+
+
+def viewer_class(user, item):
+    """
+    Returns a short string for how a user sees an item, so parts of item pages
+    can be cached once and shared by everyone who sees the item the same way.
+
+    This is the user's kind of access to the item (anonymous, user, viewer,
+    registrar, editor or superuser) and a fingerprint of all the roles they
+    hold, as those decide which related items they can see.
+    """
+    if user.is_anonymous():
+        return 'anonymous'
+    staff = '-staff' if user.is_staff else ''
+    if user.is_superuser:
+        return 'superuser' + staff
+    roles = get_user_roles(user)
+    if user_can_edit(user, item):
+        role = 'editor'
+    elif roles.registrar_in:
+        role = 'registrar'
+    elif item.workgroup_id in roles.workgroups:
+        role = 'viewer'
+    else:
+        role = 'user'
+    fingerprint = hashlib.sha1(repr([
+        sorted(ids) for ids in [
+            roles.viewer_in, roles.submitter_in, roles.steward_in, roles.workgroup_manager_in,
+            roles.registrar_in, roles.registrationauthority_manager_in,
+        ]
+    ]).encode('utf-8')).hexdigest()
+    return '%s%s|%s' % (role, staff, fingerprint)
+
+
+def user_roles_changed(user_id):
+    """Invalidate the cached ``RoleSnapshot`` and permissions of a user."""
+    _bump_generation('user_roles_version_%s' % user_id)
+
+
+def get_workgroup_member_ids(workgroup):
+    """
+    Returns the set of ids of the users who hold any role in a workgroup,
+    read from each role table and kept in the cache until the members change.
+    """
+    key = 'workgroup_members_%s' % workgroup.pk
+    member_ids = cache.get(key)
+    if member_ids is None:
+        member_ids = set()
+        for role in [workgroup.viewers, workgroup.submitters, workgroup.stewards, workgroup.managers]:
+            member_ids.update(role.through.objects.filter(workgroup=workgroup).values_list('user_id', flat=True))
+        cache.set(key, member_ids, ROLES_CACHE_SECONDS)
+    return member_ids
+
+
+def workgroup_members_changed(workgroup_id):
+    """Invalidate the cached member ids of a workgroup."""
+    cache.delete('workgroup_members_%s' % workgroup_id)
+
+
+def concept_changed(concept_id):
+    """Invalidate the cached permissions of all users for a concept."""
+    _bump_generation('concept_generation_%s' % concept_id)
+    # Components take their visibility from the concept they belong to, so
+    # anything in this process may now be stale.
+    public_items.clear()
+
+
+def workgroup_changed(workgroup_id):
+    """Invalidate the cached permissions of all users for items in a workgroup."""
+    _bump_generation('workgroup_generation_%s' % workgroup_id)
+
+
+def _generation_keys(user, item):
+    # The generations a cached permission check for this user and item
+    # depends on. Bumping any of them makes the cached answer unreachable.
+    keys = []
+    if not user.is_anonymous():
+        keys.append('user_roles_version_%s' % user.pk)
+    if _is_concept_like(item):
+        keys.append('concept_generation_%s' % item.id)
+        keys.append('workgroup_generation_%s' % item.workgroup_id)
+    return keys
+
+
+def _cache_seconds(item, seconds):
+    # Only concepts have generations that are bumped when who can see them
+    # changes, so checks of anything else are only cached briefly.
+    if _is_concept_like(item):
+        return seconds
+    return UNSTAMPED_CACHE_SECONDS
+
+
+def get_permission_stamp(user, concept_id, workgroup_id):
+    """
+    Returns a string that changes whenever the user's roles change, or who may
+    view or edit the concept changes, for use in cache keys and validators.
+    """
+    keys = ['concept_generation_%s' % concept_id, 'workgroup_generation_%s' % workgroup_id]
+    if not user.is_anonymous():
+        keys.append('user_roles_version_%s' % user.pk)
+    return _stamp(keys, _get_generations(keys))
+
+
+def _get_generations(keys):
+    generations = cache.get_many(set(keys))
+    for key in keys:
+        if key not in generations:
+            generations[key] = _get_generation(key)
+    return generations
+
+
+def _stamp(keys, generations):
+    return '.'.join(str(generations[key]) for key in keys)
 
 
 def user_can_alter_comment(user, comment):
@@ -22,24 +272,27 @@ def user_can_view(user, item):
         return user == item                 # A user can edit their own details
 
     if user.is_anonymous():
+        # Anonymous users can only ever see public items, and concepts know
+        # if they are public without needing the cache.
+        if _is_concept_like(item):
+            return item._is_public
+        if _item_key(item) in public_items:
+            return True
         user_key = "anonymous"
     else:
         user_key = str(user.id)
 
-    # If the item was modified in the last 15 seconds, don't use cache
-    if hasattr(item, "was_modified_very_recently") and item.was_modified_very_recently():
-        can_use_cache = False
-    else:
-        can_use_cache = True
-
-    cached_can_view = cache.get('user_can_view_%s|%s' % (user_key, str(item.id)))
-    if can_use_cache and cached_can_view is not None:
-        return cached_can_view
+    generation_keys = _generation_keys(user, item)
+    stamp = _stamp(generation_keys, _get_generations(generation_keys))
 
-    _can_view = False
+    key = 'user_can_view_%s|%s|%s' % (user_key, _item_key(item), stamp)
+    _can_view = cache.get(key)
+    if _can_view is None:
+        _can_view = item.can_view(user)
+        cache.set(key, _can_view, _cache_seconds(item, VIEW_CACHE_SECONDS))
 
-    _can_view = item.can_view(user)
-    cache.set('user_can_view_%s|%s' % (str(user.id), str(item.id)), _can_view, VIEW_CACHE_SECONDS)
+    if user.is_anonymous() and _can_view:
+        public_items.add(_item_key(item))
     return _can_view
 
 
@@ -55,14 +308,12 @@ def user_can_edit(user, item):
     if item.__class__ == User:              # -- Sometimes duck-typing fails --
         return user == item
 
-    if hasattr(item, "was_modified_very_recently") and item.was_modified_very_recently():
-        # If the item was modified in the last 15 seconds, don't use cache
-        can_use_cache = False
-    else:
-        can_use_cache = True
+    generation_keys = _generation_keys(user, item)
+    stamp = _stamp(generation_keys, _get_generations(generation_keys))
 
-    cached_can_edit = cache.get('user_can_edit_%s|%s' % (str(user.id), str(item.id)))
-    if can_use_cache and cached_can_edit is not None:
+    key = 'user_can_edit_%s|%s|%s' % (str(user.id), _item_key(item), stamp)
+    cached_can_edit = cache.get(key)
+    if cached_can_edit is not None:
         return cached_can_edit
 
     _can_edit = False
@@ -71,37 +322,192 @@ def user_can_edit(user, item):
         _can_edit = False
     else:
         _can_edit = item.can_edit(user)
-    cache.set('user_can_edit_%s|%s' % (str(user.id), str(item.id)), _can_edit, VIEW_CACHE_SECONDS)
+    cache.set(key, _can_edit, _cache_seconds(item, EDIT_CACHE_SECONDS))
 
     return _can_edit
 
 
+def _is_concept_like(item):
+    # Only items that carry the cached visibility fields can be checked in bulk,
+    # everything else falls back to the item-by-item checks.
+    return all(
+        hasattr(item, attr)
+        for attr in ['_is_public', '_is_locked', 'workgroup_id', 'readyToReview']
+    )
+
+
+def _concepts_viewable_by(user, items):
+    """
+    Set-based equivalent of ``_concept.can_view`` for a list of concepts.
+    Returns the set of ids of the given items that the user can view, using a
+    fixed number of queries no matter how many items are passed in.
+    """
+    from aristotle_mdr.models import Status, Workgroup, WORKGROUP_OWNERSHIP
+
+    viewable = set(item.id for item in items if item._is_public)
+    items = [item for item in items if item.id not in viewable]
+    if not items or user.is_anonymous():
+        return viewable
+
+    roles = get_user_roles(user)
+    viewable.update(item.id for item in items if item.workgroup_id in roles.workgroups)
+    items = [item for item in items if item.id not in viewable]
+    if not items:
+        return viewable
+
+    # Registrars can view anything registered in their authority.
+    if roles.registrar_in:
+        viewable.update(
+            Status.objects.filter(
+                concept__in=[item.id for item in items],
+                registrationAuthority__in=roles.registrar_in
+            ).values_list('concept_id', flat=True)
+        )
+    items = [item for item in items if item.id not in viewable and item.readyToReview]
+    if not items:
+        return viewable
+
+    # Registrars can view items flagged as "ready to review" in workgroups
+    # their authorities are associated with.
+    wg_ids = set(item.workgroup_id for item in items)
+    workgroup_ras = dict((wg_id, set()) for wg_id in wg_ids)
+    for wg_id, ra_id in Workgroup.registrationAuthorities.through.objects.filter(
+            workgroup_id__in=wg_ids).values_list('workgroup_id', 'registrationauthority_id'):
+        workgroup_ras[wg_id].add(ra_id)
+    ownership = dict(Workgroup.objects.filter(pk__in=wg_ids).values_list('pk', 'ownership'))
+    for item in items:
+        ras = workgroup_ras[item.workgroup_id]
+        if ras & roles.registrar_in:
+            viewable.add(item.id)
+        elif not ras and ownership[item.workgroup_id] == WORKGROUP_OWNERSHIP.registry:
+            viewable.add(item.id)
+    return viewable
+
+
+def user_can_view_many(user, items):
+    """
+    Can the user view each of the items?
+
+    A bulk version of ``user_can_view`` for list pages. Returns a dictionary
+    mapping the id of each item to whether the user can view it. Cached results
+    are fetched in a single ``cache.get_many`` and all cache misses are
+    resolved with a fixed number of queries, instead of a round trip per item.
+    """
+    items = list(items)
+    if user.is_superuser:
+        return dict((item.id, True) for item in items)
+
+    if user.is_anonymous():
+        if all(_is_concept_like(item) for item in items):
+            return dict((item.id, item._is_public) for item in items)
+        user_key = "anonymous"
+    else:
+        user_key = str(user.id)
+
+    generation_keys = dict((item.id, _generation_keys(user, item)) for item in items)
+    generations = _get_generations(sum(generation_keys.values(), []))
+    keys = dict(
+        ('user_can_view_%s|%s|%s' % (user_key, _item_key(item), _stamp(generation_keys[item.id], generations)), item)
+        for item in items
+    )
+    cached = cache.get_many(keys.keys())
+
+    results = {}
+    bulk_misses = []
+    for key, item in keys.items():
+        if cached.get(key) is not None:
+            results[item.id] = cached[key]
+        elif _is_concept_like(item):
+            bulk_misses.append(item)
+        else:
+            results[item.id] = user_can_view(user, item)
+
+    if bulk_misses:
+        viewable = _concepts_viewable_by(user, bulk_misses)
+        to_cache = {}
+        for item in bulk_misses:
+            results[item.id] = item.id in viewable
+            key = 'user_can_view_%s|%s|%s' % (user_key, _item_key(item), _stamp(generation_keys[item.id], generations))
+            to_cache[key] = results[item.id]
+        cache.set_many(to_cache, VIEW_CACHE_SECONDS)
+    return results
+
+
+def user_can_edit_many(user, items):
+    """
+    Can the user edit each of the items?
+
+    A bulk version of ``user_can_edit`` that follows the same pattern as
+    ``user_can_view_many``, returning a dictionary of item ids to booleans.
+    """
+    items = list(items)
+    if user.is_superuser:
+        return dict((item.id, True) for item in items)
+    if user.is_anonymous():
+        return dict((item.id, False) for item in items)
+
+    generation_keys = dict((item.id, _generation_keys(user, item)) for item in items)
+    generations = _get_generations(sum(generation_keys.values(), []))
+    keys = dict(
+        ('user_can_edit_%s|%s|%s' % (str(user.id), _item_key(item), _stamp(generation_keys[item.id], generations)), item)
+        for item in items
+    )
+    cached = cache.get_many(keys.keys())
+
+    results = {}
+    bulk_misses = []
+    for key, item in keys.items():
+        if cached.get(key) is not None:
+            results[item.id] = cached[key]
+        elif _is_concept_like(item):
+            bulk_misses.append(item)
+        else:
+            results[item.id] = user_can_edit(user, item)
+
+    if bulk_misses:
+        can_view = user_can_view_many(user, bulk_misses)
+        steward_in = get_user_roles(user).steward_in
+        submitter_in = get_user_roles(user).submitter_in
+        to_cache = {}
+        for item in bulk_misses:
+            if not can_view[item.id]:
+                _can_edit = False
+            elif item._is_public or item._is_locked:
+                _can_edit = item.workgroup_id in steward_in
+            else:
+                _can_edit = item.workgroup_id in steward_in or item.workgroup_id in submitter_in
+            results[item.id] = _can_edit
+            key = 'user_can_edit_%s|%s|%s' % (str(user.id), _item_key(item), _stamp(generation_keys[item.id], generations))
+            to_cache[key] = _can_edit
+        cache.set_many(to_cache, EDIT_CACHE_SECONDS)
+    return results
+
+
 def user_is_editor(user, workgroup=None):
     if user.is_superuser:
         return True
     elif workgroup is None:
-        return user.submitter_in.count() > 0 or user.steward_in.count() > 0
+        return len(get_user_roles(user).editable_workgroups) > 0
     else:
-        return user.submitter_in.filter(workgroup=workgroup).exists() or \
-            user.steward_in.filter(workgroup=workgroup).exists()
+        return workgroup.pk in get_user_roles(user).editable_workgroups
 
 
 def user_is_registrar(user, ra=None):
     if user.is_superuser:
         return True
     elif ra is None:
-        return user.registrar_in.count() > 0
+        return len(get_user_roles(user).registrar_in) > 0
     else:
-        return user in ra.registrars.all()
+        return ra.pk in get_user_roles(user).registrar_in
 
 
 def user_is_workgroup_manager(user, workgroup=None):
     if user.is_superuser:
         return True
     elif workgroup is None:
-        return user.workgroup_manager_in.count() > 0
+        return len(get_user_roles(user).workgroup_manager_in) > 0
     else:
-        return user in workgroup.managers.all()
+        return workgroup.pk in get_user_roles(user).workgroup_manager_in
 
 
 def user_can_change_status(user, item):
@@ -116,21 +522,54 @@ def user_can_change_status(user, item):
     # TODO: restrict to only those registration authorities of that items based
     # on the items workgroup, unless the item is visible to the user.
     from aristotle_mdr.models import WORKGROUP_OWNERSHIP
-    if item.readyToReview and user.registrar_in.count() > 0:
+    registrar_in = get_user_roles(user).registrar_in
+    if item.readyToReview and registrar_in:
         if item.workgroup.ownership == WORKGROUP_OWNERSHIP.authority:
-            return any(
-                (user in ra.registrars.all()
-                    for ra in item.workgroup.registrationAuthorities.all())
-            )
+            return item.workgroup.registrationAuthorities.filter(pk__in=registrar_in).exists()
         else:
             return True
     return False
 
 
+def user_can_change_status_many(user, items):
+    """
+    Can the user change the status of each of the items?
+
+    A bulk version of ``user_can_change_status``, returning a dictionary of
+    item ids to booleans and using a fixed number of queries for the whole
+    list.
+    """
+    from aristotle_mdr.models import Workgroup, WORKGROUP_OWNERSHIP
+    items = list(items)
+    can_view = user_can_view_many(user, items)
+    if user.is_superuser:
+        return can_view
+
+    results = dict((item.id, False) for item in items)
+    registrar_in = get_user_roles(user).registrar_in
+    items = [item for item in items if can_view[item.id] and item.readyToReview]
+    if not registrar_in or not items:
+        return results
+
+    wg_ids = set(item.workgroup_id for item in items)
+    ownership = dict(Workgroup.objects.filter(pk__in=wg_ids).values_list('pk', 'ownership'))
+    registrar_workgroups = set(
+        Workgroup.registrationAuthorities.through.objects.filter(
+            workgroup_id__in=wg_ids, registrationauthority_id__in=registrar_in
+        ).values_list('workgroup_id', flat=True)
+    )
+    for item in items:
+        if ownership[item.workgroup_id] == WORKGROUP_OWNERSHIP.authority:
+            results[item.id] = item.workgroup_id in registrar_workgroups
+        else:
+            results[item.id] = True
+    return results
+
+
 def user_in_workgroup(user, wg):
     if user.is_superuser:
         return True
-    return user in wg.members
+    return wg.pk in get_user_roles(user).workgroups
 
 
 def user_can_move_any_workgroup(user):
@@ -143,7 +582,7 @@ def user_can_move_any_workgroup(user):
         return True
     if 'manager' in workgroup_change_access and user.profile.is_workgroup_manager():
         return True
-    if 'submitter' in workgroup_change_access and user.submitter_in.exists():
+    if 'submitter' in workgroup_change_access and get_user_roles(user).submitter_in:
         return True
 
     return False
@@ -156,9 +595,9 @@ def user_can_add_or_remove_workgroup(user, workgroup):
         return True
     if 'admin' in workgroup_change_access and user.is_staff:
         return True
-    if 'manager' in workgroup_change_access and user in workgroup.managers.all():
+    if 'manager' in workgroup_change_access and workgroup.pk in get_user_roles(user).workgroup_manager_in:
         return True
-    if 'submitter' in workgroup_change_access and user in workgroup.submitters.all():
+    if 'submitter' in workgroup_change_access and workgroup.pk in get_user_roles(user).submitter_in:
         return True
     return False
 
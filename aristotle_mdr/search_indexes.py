@@ -82,31 +82,61 @@ class conceptIndex(baseObjectIndex):
 
     template_name = "search/searchItem.html"
 
-    def prepare_registrationAuthorities(self, obj):
-        ras = [str(s.registrationAuthority.id) for s in obj.current_statuses().all()]
+    def index_queryset(self, using=None):
+        qs = super(conceptIndex, self).index_queryset(using)
+        return qs.select_related('workgroup').prefetch_related(
+            'statuses', 'workgroup__registrationAuthorities'
+        ).with_current_statuses()
+
+    def prepare(self, obj):
+        # Work out everything the fields need from the current statuses once
+        # for each document, rather than once for each field.
+        obj._index_context = self.get_index_context(obj)
+        try:
+            return super(conceptIndex, self).prepare(obj)
+        finally:
+            del obj._index_context
+
+    def get_index_context(self, obj):
+        context = getattr(obj, '_index_context', None)
+        if context is not None:
+            return context
+        from django.contrib.contenttypes.models import ContentType
+        statuses = [
+            (s.registrationAuthority_id, int(s.state))
+            for s in obj.current_status_list
+        ]
+        ras = [str(ra_id) for ra_id, state in statuses]
         if not ras and obj.readyToReview:
             # We fake a registration authority only if an item is "ready to review".
             # This allows registrars to search for flagged items in their authority.
             # But this item won't get a state.
             ras = [str(r.id) for r in obj.workgroup.registrationAuthorities.all()]
-        return ras
+        return {
+            'statuses': statuses,
+            'registration_authorities': ras,
+            'content_type': ContentType.objects.get_for_model(obj),
+        }
+
+    def prepare_registrationAuthorities(self, obj):
+        return self.get_index_context(obj)['registration_authorities']
 
     def prepare_is_public(self, obj):
         return obj.is_public()
 
     def prepare_workgroup(self, obj):
-        return int(obj.workgroup.id)
+        return int(obj.workgroup_id)
 
     def prepare_statuses(self, obj):
         # We don't remove duplicates as it should mean the more standard it is the higher it will rank
-        states = [int(s.state) for s in obj.current_statuses().all()]
+        states = [state for ra_id, state in self.get_index_context(obj)['statuses']]
         if not states:
             states = ['-99']  # This is an unregistered item
         return states
 
     def prepare_highest_state(self, obj):
         # Include -99, so "unregistered" items get a value
-        state = max([int(s.state) for s in obj.current_statuses().all()] + [-99])
+        state = max([state for ra_id, state in self.get_index_context(obj)['statuses']] + [-99])
         """
         We don't want retired or superseded ranking higher than standards during search
         as these are no longer "fit for purpose" so we'll place them below other
@@ -121,15 +151,13 @@ class conceptIndex(baseObjectIndex):
     def prepare_ra_statuses(self, obj):
         # This allows us to check a registration authority and a state simultaneously
         states = [
-            "%s___%s" % (str(s.registrationAuthority.id), str(s.state)) for s in obj.current_statuses().all()
+            "%s___%s" % (str(ra_id), str(state)) for ra_id, state in self.get_index_context(obj)['statuses']
         ]
         return states
 
     def prepare_facet_model_ct(self, obj):
         # We need to use the content type, as if we use text it gets stemmed wierdly
-        from django.contrib.contenttypes.models import ContentType
-        ct = ContentType.objects.get_for_model(obj)
-        return ct.pk
+        return self.get_index_context(obj)['content_type'].pk
 
     def prepare_restriction(self, obj):
         if obj._is_public:
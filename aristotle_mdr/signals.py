@@ -1,6 +1,13 @@
-from django.db.models.signals import post_save, post_delete, pre_delete
+from django.conf import settings
+from django.core.signals import request_finished, request_started
+from django.db import connection
+from django.db.models.signals import post_save, post_delete
 from reversion.signals import post_revision_commit
 import haystack.signals as signals  # .RealtimeSignalProcessor as RealtimeSignalProcessor
+from haystack.utils import get_identifier
+
+import threading
+import uuid
 # Don't import aristotle_mdr.models directly, only pull in whats required,
 #  otherwise Haystack gets into a circular dependancy.
 
@@ -9,26 +16,93 @@ import haystack.signals as signals  # .RealtimeSignalProcessor as RealtimeSignal
 #    pass
 
 
+def get_index_update_mode():
+    return getattr(settings, 'ARISTOTLE_SETTINGS', {}).get('SEARCH_INDEX_UPDATES', 'realtime')
+
+
 class AristotleSignalProcessor(signals.BaseSignalProcessor):
     def setup(self):
-        from aristotle_mdr.models import _concept, Workgroup
+        from aristotle_mdr.models import _concept, Workgroup, connect_to_concept_models
         # post_save.connect(self.handle_concept_save, sender=_concept)
         post_revision_commit.connect(self.handle_concept_revision)
-        pre_delete.connect(self.handle_concept_delete, sender=_concept)
+        # Only listening to concepts leaves Django free to delete other
+        # models without fetching them first.
+        connect_to_concept_models(post_delete, self.handle_concept_deleted)
+        request_started.connect(self.handle_request_started)
+        request_finished.connect(self.handle_request_finished)
+        self.queue = threading.local()
         super(AristotleSignalProcessor, self).setup()
 
     def teardown(self):  # pragma: no cover
-        from aristotle_mdr.models import _concept
+        from aristotle_mdr.models import _concept, concept_models
         # post_save.disconnect(self.handle_concept_save, sender=_concept)
         post_revision_commit.disconnect(self.handle_concept_revision)
-        pre_delete.disconnect(self.handle_concept_delete, sender=_concept)
+        for model in concept_models():
+            post_delete.disconnect(self.handle_concept_deleted, sender=model)
+        request_started.disconnect(self.handle_request_started)
+        request_finished.disconnect(self.handle_request_finished)
         super(AristotleSignalProcessor, self).teardown()
 
     def handle_concept_revision(self, instances, **kwargs):
         from aristotle_mdr.models import _concept
-        for instance in instances:
-            if isinstance(instance, _concept) and type(instance) is not _concept:
+        concepts = [
+            instance for instance in instances
+            if isinstance(instance, _concept) and type(instance) is not _concept
+        ]
+        mode = get_index_update_mode()
+        if mode == 'realtime' or (mode == 'queued' and not self.in_request()):
+            # Outside of a request, such as in management commands and
+            # deferred tasks, there is no end of the request to wait for.
+            for instance in concepts:
                 self.handle_save(instance.__class__, instance)
+            return
+        for instance in concepts:
+            self.queued_items().add(
+                ('%s.%s' % (instance._meta.app_label, instance._meta.model_name), instance.pk)
+            )
+        if not connection.in_atomic_block or not self.in_request():
+            # Outside of a transaction the revision is already committed.
+            # Outside of a request the deferred task is queued straight away,
+            # as part of any transaction, so it is only run if that commits.
+            self.flush()
+
+    def queued_items(self):
+        if not hasattr(self.queue, 'items'):
+            self.queue.items = set()
+        return self.queue.items
+
+    def in_request(self):
+        return getattr(self.queue, 'in_request', False)
+
+    def handle_request_started(self, **kwargs):
+        self.queue.in_request = True
+
+    def handle_request_finished(self, **kwargs):
+        # Any transaction around the request has been committed by now.
+        self.queue.in_request = False
+        self.flush()
+        self.flush_removals()
+
+    def flush(self):
+        """
+        Updates the search index for the items queued in this thread, with one
+        backend update for each type of item. In ``'deferred'`` mode this is
+        handed to a deferred task instead, so the response isn't held up.
+        """
+        items = sorted(self.queued_items())
+        self.queue.items = set()
+        if not items:
+            return
+        for using in self.connection_router.for_write():
+            if get_index_update_mode() == 'deferred':
+                from aristotle_mdr.tasks import defer
+                defer(
+                    'aristotle_mdr.signals.update_queued_items_in_index',
+                    key='update_search_index_%s' % uuid.uuid4().hex,
+                    items=items, using=using
+                )
+            else:
+                update_queued_items_in_index(items, using=using)
 
     """
     # Keeping this just in case, but its unlikely to be used again after the
@@ -38,7 +112,122 @@ class AristotleSignalProcessor(signals.BaseSignalProcessor):
         obj = instance.item
         self.handle_save(obj.__class__,obj, **kwargs)
     """
-    def handle_concept_delete(self, sender, instance, **kwargs):
-        # Delete index *before* the object, as we need to query it to check the actual subclass.
-        obj = instance.item
-        self.handle_delete(obj.__class__, obj, **kwargs)
+    def handle_concept_deleted(self, sender, instance, **kwargs):
+        # Deleting a concept sends post_delete for each model it inherits from,
+        # so the concrete model is known from the sender and no query is
+        # needed to find the subclass. The bare _concept isn't indexed.
+        from aristotle_mdr.models import _concept
+        if not isinstance(instance, _concept) or sender is _concept:
+            return
+        if not self.in_request():
+            # As with saves, outside of a request there is no end of the
+            # request to wait for.
+            for using in self.connection_router.for_write():
+                remove_from_index({sender: [get_identifier(instance)]}, using=using)
+            return
+        self.queued_removals().setdefault(sender, {})[instance.pk] = get_identifier(instance)
+
+    def queued_removals(self):
+        if not hasattr(self.queue, 'removals'):
+            self.queue.removals = {}
+        return self.queue.removals
+
+    def flush_removals(self):
+        """
+        Removes the items deleted during this request from the search index,
+        with one backend commit for all of them. Items that are still in the
+        database were deleted in a transaction that was rolled back, so they
+        are left in the index.
+        """
+        removals = self.queued_removals()
+        self.queue.removals = {}
+        identifiers_by_model = {}
+        for model, identifiers in removals.items():
+            remaining = set(model._base_manager.filter(pk__in=identifiers.keys()).values_list('pk', flat=True))
+            gone = [identifier for pk, identifier in identifiers.items() if pk not in remaining]
+            if gone:
+                identifiers_by_model[model] = gone
+        if not identifiers_by_model:
+            return
+        for using in self.connection_router.for_write():
+            remove_from_index(identifiers_by_model, using=using)
+
+
+def update_concepts_in_index(concept_ids, using='default'):
+    """
+    Updates the search index for the concepts with the given ids, with one
+    backend update for each type of item, rather than one per item.
+    Items are fetched through each index's ``index_queryset`` so that what
+    the index needs is prefetched. Returns the number of items indexed.
+    """
+    from aristotle_mdr.models import _concept
+    from django.contrib.contenttypes.models import ContentType
+
+    ids_by_model = {}
+    untyped = []
+    for pk, ct_id in _concept.objects.filter(pk__in=concept_ids).values_list('pk', '_concrete_type'):
+        model = ContentType.objects.get_for_id(ct_id).model_class() if ct_id else None
+        if model is None or model is _concept:
+            untyped.append(pk)
+        else:
+            ids_by_model.setdefault(model, []).append(pk)
+    if untyped:
+        for item in _concept.objects.filter(pk__in=untyped).resolve_subclasses():
+            ids_by_model.setdefault(item.__class__, []).append(item.pk)
+    return update_models_in_index(ids_by_model, using=using)
+
+
+def update_queued_items_in_index(items, using='default'):
+    """
+    Updates the search index for a list of ``[model label, pk]`` pairs, as
+    queued by ``AristotleSignalProcessor``.
+    """
+    from django.apps import apps
+
+    ids_by_model = {}
+    for label, pk in items:
+        ids_by_model.setdefault(apps.get_model(label), []).append(pk)
+    return update_models_in_index(ids_by_model, using=using)
+
+
+def remove_from_index(identifiers_by_model, using='default'):
+    """
+    Removes documents from the search index, given their identifiers for each
+    model. Haystack backends have no bulk remove, so each model's documents
+    are removed without committing and the index is committed once at the end.
+    """
+    from haystack import connections
+    from haystack.exceptions import NotHandled
+
+    unified_index = connections[using].get_unified_index()
+    for model, identifiers in identifiers_by_model.items():
+        try:
+            backend = unified_index.get_index(model)._get_backend(using)
+        except NotHandled:
+            continue
+        for identifier in identifiers[:-1]:
+            backend.remove(identifier, commit=False)
+        backend.remove(identifiers[-1])
+
+
+def update_models_in_index(ids_by_model, using='default'):
+    """
+    Updates the search index for the items of each model with the given ids,
+    with one backend update for each model. Items that no longer exist are
+    skipped. Returns the number of items indexed.
+    """
+    from haystack import connections
+    from haystack.exceptions import NotHandled
+
+    unified_index = connections[using].get_unified_index()
+    count = 0
+    for model, ids in ids_by_model.items():
+        try:
+            index = unified_index.get_index(model)
+        except NotHandled:
+            continue
+        items = list(index.index_queryset(using=using).filter(pk__in=ids))
+        if items:
+            index._get_backend(using).update(index, items)
+            count += len(items)
+    return count
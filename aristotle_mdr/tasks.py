@@ -0,0 +1,226 @@
+"""
+A small deferred task queue for work that is too slow to do during a request,
+such as recaching the states of every item in a workgroup.
+
+Tasks are stored in the ``DeferredTask`` table, so no external broker is
+needed. How they are run is set by the ``DEFERRED_TASK_MODE`` option in
+``ARISTOTLE_SETTINGS``:
+
+``'thread'`` (the default)
+    A background thread in each process runs tasks shortly after the
+    transaction that queued them commits.
+``'process'``
+    Tasks are only stored, and are run by one or more separate
+    ``run_deferred_tasks`` management command processes.
+``'inline'``
+    Tasks are run immediately when they are queued, which is useful for
+    testing.
+
+Tasks that fail are retried up to ``DEFERRED_TASK_RETRIES`` times, waiting
+longer before each retry.
+"""
+import datetime
+import json
+import logging
+import sys
+import threading
+import traceback
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+POLL_SECONDS = 5
+RECACHE_BATCH_SIZE = 500
+RETRY_SECONDS = 60
+
+
+def get_mode():
+    return getattr(settings, 'ARISTOTLE_SETTINGS', {}).get('DEFERRED_TASK_MODE', 'thread')
+
+
+def get_retries():
+    return getattr(settings, 'ARISTOTLE_SETTINGS', {}).get('DEFERRED_TASK_RETRIES', 3)
+
+
+def defer(task, key=None, delay=None, **kwargs):
+    """
+    Queues ``task``, the dotted path to a function, to be called later with
+    the given keyword arguments, which must be JSON serialisable.
+
+    If a task with the same ``key`` is already waiting to run it isn't queued
+    again, so repeated changes to the same object only cause one run. If
+    ``delay`` is given, the task isn't run until that many seconds have
+    passed, so any changes made meanwhile are handled by the same run.
+    """
+    from aristotle_mdr.models import DeferredTask
+    if get_mode() == 'inline':
+        import_string(task)(**kwargs)
+        return
+    key = key or task
+    if DeferredTask.objects.filter(pending_key=key).exists():
+        return
+    run_after = None
+    if delay:
+        run_after = timezone.now() + datetime.timedelta(seconds=delay)
+    try:
+        with transaction.atomic():
+            DeferredTask.objects.create(
+                task=task, key=key, pending_key=key, arguments=json.dumps(kwargs), run_after=run_after
+            )
+    except IntegrityError:
+        # Queued by someone else since the check above.
+        return
+    if get_mode() == 'thread':
+        _wake_worker()
+
+
+def update_pending(key, **kwargs):
+    """
+    Updates the given keyword arguments of the task with ``key`` if it is
+    still waiting to run. Returns ``False`` if there is no such task, such as
+    when it has already started, in which case a new task should be queued.
+    """
+    from aristotle_mdr.models import DeferredTask
+    with transaction.atomic():
+        task = DeferredTask.objects.select_for_update().filter(pending_key=key).first()
+        if task is None:
+            return False
+        arguments = json.loads(task.arguments)
+        arguments.update(kwargs)
+        # The task may have been claimed by a worker that doesn't lock rows.
+        return bool(DeferredTask.objects.filter(pk=task.pk, pending_key=key).update(arguments=json.dumps(arguments)))
+
+
+def run_pending(limit=None):
+    """
+    Runs waiting tasks that are due, oldest first, until there are none left
+    or ``limit`` tasks have been run. Returns the number of tasks that were
+    run.
+
+    Tasks are claimed before running, so any number of threads or processes
+    can call this at once. Finished tasks are deleted. Failed tasks keep their
+    traceback in ``error`` and are queued again to run after a wait that
+    doubles each time, until they have been retried ``DEFERRED_TASK_RETRIES``
+    times, after which they are kept but not run again.
+    """
+    from aristotle_mdr.models import DeferredTask
+    count = 0
+    while limit is None or count < limit:
+        task = DeferredTask.objects.filter(
+            Q(run_after__isnull=True) | Q(run_after__lte=timezone.now()),
+            started__isnull=True
+        ).order_by('created', 'pk').first()
+        if task is None:
+            break
+        claimed = DeferredTask.objects.filter(
+            pk=task.pk, started__isnull=True
+        ).update(started=timezone.now(), pending_key=None, attempts=F('attempts') + 1)
+        if not claimed:
+            # Another worker got to it first.
+            continue
+        try:
+            import_string(task.task)(**json.loads(task.arguments))
+        except Exception:
+            _failed(task, sys.exc_info())
+        else:
+            task.delete()
+        count += 1
+    return count
+
+
+def _failed(task, exc_info):
+    from aristotle_mdr.models import DeferredTask
+    attempts = task.attempts + 1
+    DeferredTask.objects.filter(pk=task.pk).update(error=''.join(traceback.format_exception(*exc_info)))
+    if attempts > get_retries():
+        logger.error(
+            "Deferred task '%s' failed %s times and won't be retried" % (task.key, attempts),
+            exc_info=exc_info
+        )
+        return
+    run_after = timezone.now() + datetime.timedelta(seconds=RETRY_SECONDS * 2 ** (attempts - 1))
+    try:
+        with transaction.atomic():
+            DeferredTask.objects.filter(pk=task.pk).update(started=None, pending_key=task.key, run_after=run_after)
+    except IntegrityError:
+        # The task has been queued again since it started, so that run
+        # takes the place of a retry.
+        logger.error("Deferred task '%s' failed, and will be run again as it is queued" % task.key, exc_info=exc_info)
+        return
+    logger.warning("Deferred task '%s' failed and will be retried" % task.key, exc_info=exc_info)
+
+
+class Worker(threading.Thread):
+    """
+    A daemon thread that runs pending tasks whenever it is woken, and checks
+    for tasks queued by other processes every ``POLL_SECONDS``.
+    """
+    def __init__(self):
+        super(Worker, self).__init__(name="aristotle-deferred-tasks")
+        self.daemon = True
+        self.event = threading.Event()
+
+    def run(self):
+        while True:
+            self.event.wait(POLL_SECONDS)
+            self.event.clear()
+            try:
+                run_pending()
+            except Exception:
+                logger.exception("Running deferred tasks failed")
+            finally:
+                connection.close()
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def _wake_worker():
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = Worker()
+            _worker.start()
+    # The task may not be committed yet, in which case the worker picks it up
+    # on its next poll.
+    _worker.event.set()
+
+
+def recache_items(items, dry_run=False, progress=None):
+    """
+    Recaches the states of the given items in batches with
+    ``ConceptQuerySet.recache_states`` and updates them in the search index.
+    If given, ``progress`` is called after each batch with the number of items
+    checked so far and the total. Returns the number of items that changed and
+    the total number of items.
+    """
+    from aristotle_mdr.models import _concept
+    from aristotle_mdr.signals import update_concepts_in_index
+
+    concept_ids = list(items.order_by('pk').values_list('pk', flat=True).distinct())
+    changed = 0
+    for start in range(0, len(concept_ids), RECACHE_BATCH_SIZE):
+        batch = concept_ids[start:start + RECACHE_BATCH_SIZE]
+        changed += len(_concept.objects.filter(pk__in=batch).recache_states(dry_run=dry_run))
+        if not dry_run:
+            # What is indexed depends on more than the cached states, such
+            # as the authorities of the workgroup, so reindex every item.
+            update_concepts_in_index(batch)
+        if progress is not None:
+            progress(start + len(batch), len(concept_ids))
+    return changed, len(concept_ids)
+
+
+def recache_workgroup(workgroup_id):
+    from aristotle_mdr.models import _concept
+    recache_items(_concept.objects.filter(workgroup_id=workgroup_id))
+
+
+def recache_registration_authority(registration_authority_id):
+    from aristotle_mdr.models import _concept
+    recache_items(_concept.objects.filter(statuses__registrationAuthority_id=registration_authority_id))
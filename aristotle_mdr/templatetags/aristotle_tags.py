@@ -100,6 +100,24 @@ def can_view(item, user):
     return perms.user_can_view(user, item)
 
 
+@register.filter
+def can_view_many(items, user):
+    """
+    A filter that acts as a wrapper around ``aristotle_mdr.perms.user_can_view_many``
+    for list pages. Returns the set of ids of the items the user can view,
+    checking a whole page of items at once instead of one at a time.
+
+    For example::
+
+      {% with viewable=page|can_view_many:request.user %}
+        {% for item in page %}
+          {% if item.id in viewable %}{{ item }}{% endif %}
+        {% endfor %}
+      {% endwith %}
+    """
+    return set(iid for iid, allowed in perms.user_can_view_many(user, items).items() if allowed)
+
+
 @register.filter
 def can_view_iter(qs, user):
     """
@@ -291,17 +309,15 @@ def downloadMenu(item):
 
         {% downloadMenu item %}
     """
-    from django.conf import settings
     from django.template.loader import get_template
     from django.template import Context
-    downloadOpts = getattr(settings, 'ARISTOTLE_DOWNLOADS', "")
+    from aristotle_mdr.downloads import get_registry
     from aristotle_mdr.utils import get_download_template_path_for_item
     downloadsForItem = []
-    for d in downloadOpts:
-        downloadType = d[0]
+    for downloader in get_registry().values():
         try:
-            get_template(get_download_template_path_for_item(item, downloadType))
-            downloadsForItem.append(d)
+            get_template(get_download_template_path_for_item(item, downloader.download_type))
+            downloadsForItem.append(downloader.option)
         except template.TemplateDoesNotExist:
             pass  # This is ok.
         except:
@@ -394,3 +410,60 @@ def owned_by_ra(item, ra_id):
     ra = MDR.RegistrationAuthority.objects.get(pk=ra_id)
 
     return ra in item.workgroup.registrationAuthorities.all()
+
+
+class ItemFragmentNode(template.Node):
+    def __init__(self, nodelist, item, fragment_name):
+        self.nodelist = nodelist
+        self.item = item
+        self.fragment_name = fragment_name
+
+    def render(self, context):
+        import hashlib
+        from django.conf import settings
+        from django.core.cache import cache
+        from django.utils.translation import get_language
+        from aristotle_mdr.utils import get_item_version
+
+        item = self.item.resolve(context)
+        request = context.get('request')
+        seconds = getattr(settings, 'ARISTOTLE_SETTINGS', {}).get('ITEM_FRAGMENT_CACHE_SECONDS', 300)
+        if request is None or not seconds:
+            return self.nodelist.render(context)
+
+        key = 'item_fragment_%s_%s_%s' % (self.fragment_name, item.pk, hashlib.sha1('|'.join([
+            get_item_version(item),
+            perms.viewer_class(request.user, item),
+            get_language() or '',
+        ]).encode('utf-8')).hexdigest())
+        content = cache.get(key)
+        if content is None:
+            content = self.nodelist.render(context)
+            cache.set(key, content, seconds)
+        return content
+
+
+@register.tag
+def cache_item_fragment(parser, token):
+    """
+    Caches part of an item page, to be shared by everyone who sees the item
+    the same way. The cached part is rendered again whenever the item or its
+    statuses change, and otherwise is kept for ``ITEM_FRAGMENT_CACHE_SECONDS``.
+
+    Anything that differs between users who hold the same roles, such as
+    whether the item is one of the user's favourites, must be kept outside
+    the fragment. For example::
+
+        {% cache_item_fragment item 'body' %}
+            {{ item.definition }}
+        {% end_cache_item_fragment %}
+    """
+    bits = token.split_contents()
+    if len(bits) != 3:
+        raise template.TemplateSyntaxError("'%s' takes an item and the name of the fragment" % bits[0])
+    nodelist = parser.parse(('end_cache_item_fragment',))
+    parser.delete_first_token()
+    fragment_name = bits[2]
+    if fragment_name[0] in '"\'' and fragment_name[0] == fragment_name[-1]:
+        fragment_name = fragment_name[1:-1]
+    return ItemFragmentNode(nodelist, parser.compile_filter(bits[1]), fragment_name)
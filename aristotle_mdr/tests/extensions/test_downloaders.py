@@ -36,3 +36,44 @@ class TextDownloader(utils.LoggedInViewPages, TestCase):
         with self.assertRaises(TemplateSyntaxError):
             # This template is broken on purpose and will throw an error
             response = self.client.get(reverse('aristotle:download', args=['txt', dec.id]))
+
+
+class DownloadValidators(utils.LoggedInViewPages, TestCase):
+    def test_download_validators_change_with_download_items(self):
+        from django.http import HttpResponse
+        from django.test import RequestFactory
+        from aristotle_mdr.utils import item_conditional_get
+        from extension_test.models import Question, Questionnaire
+
+        @item_conditional_get(download_items=True)
+        def view(request, iid):
+            return HttpResponse("Downloaded")
+
+        questionnaire = Questionnaire.objects.create(name="QNR", definition="Questionnaire", workgroup=self.wg1)
+        question = Question.objects.create(name="Q1", definition="Question", workgroup=self.wg1)
+
+        def get(**headers):
+            request = RequestFactory().get('/download/pdf/%s/' % questionnaire.pk, **headers)
+            request.user = self.viewer
+            return view(request, iid=questionnaire.pk)
+
+        etag = get()['ETag']
+        self.assertEqual(get(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        questionnaire.questions.add(question)
+        response = get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        etag = response['ETag']
+
+        question.definition = "Changed question"
+        question.save()
+        response = get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        etag = response['ETag']
+
+        questionnaire.questions.remove(question)
+        response = get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
@@ -137,4 +137,137 @@ class BulkWorkgroupActionsPage(utils.LoggedInViewPages, TestCase):
         self.assertEqual(len(response.redirect_chain), 1)
         self.assertEqual(response.redirect_chain[0][1], 302)
 
+    def test_bulk_status_change_saves_one_revision_with_the_given_details(self):
+        from reversion.models import Revision
+        self.login_registrar()
+        for item in [self.item1, self.item2]:
+            item.readyToReview = True
+            item.save()
+        revisions = Revision.objects.count()
+
+        response = self.client.post(
+            reverse('aristotle:bulk_action'),
+            {
+                'bulkaction': 'change_state',
+                'state': self.ra.public_state,
+                'items': [self.item1.id, self.item2.id],
+                'registrationDate': "2014-10-27",
+                'cascadeRegistration': 0,
+                'registrationAuthorities': [self.ra.id],
+                'changeDetails': "Registered together",
+                'confirmed': 'confirmed',
+            }
+        )
+        self.assertEqual(Revision.objects.count(), revisions + 1)
+        revision = Revision.objects.latest('pk')
+        self.assertEqual(revision.user, self.registrar)
+        self.assertEqual(
+            set(v.object_id_int for v in revision.version_set.all() if v.object_id_int in [self.item1.pk, self.item2.pk]),
+            set([self.item1.pk, self.item2.pk])
+        )
+        for item in [self.item1, self.item2]:
+            status = models.Status.objects.get(concept=item)
+            self.assertEqual(str(status.registrationDate), "2014-10-27")
+            self.assertEqual(status.changeDetails, "Registered together")
+            self.assertTrue(models.ObjectClass.objects.get(pk=item.pk)._is_public)
+
+    def test_bulk_status_change_with_cascade(self):
+        self.login_registrar()
+        dec = models.DataElementConcept.objects.create(
+            name="DEC", workgroup=self.wg1, readyToReview=True, objectClass=self.item1
+        )
+        self.item1.readyToReview = True
+        self.item1.save()
+        response = self.client.post(
+            reverse('aristotle:bulk_action'),
+            {
+                'bulkaction': 'change_state',
+                'state': 1,
+                'items': [dec.id],
+                'registrationDate': "2014-10-27",
+                'cascadeRegistration': 1,
+                'registrationAuthorities': [self.ra.id],
+                'confirmed': 'confirmed',
+            }
+        )
+        self.assertTrue(dec.is_registered)
+        self.assertTrue(self.item1.is_registered)
+
+    def test_register_many(self):
+        items = [models.ObjectClass.objects.create(name="OC %s" % i, workgroup=self.wg1, readyToReview=True) for i in range(20)]
+        result = self.ra.register_many(
+            items + [self.item4], self.ra.public_state, self.registrar, registrationDate="2014-10-27"
+        )
+        self.assertEqual(len(result['success']), 20)
+        self.assertEqual(result['failed'], [self.item4])
+        self.assertEqual(models.Status.objects.filter(concept__in=items).count(), 20)
+        self.assertEqual(models.ObjectClass.objects.filter(pk__in=[i.pk for i in items], _is_public=True).count(), 20)
+        # The items passed in are kept up to date too.
+        self.assertTrue(all(item._is_public for item in items))
+        from django.contrib.auth.models import AnonymousUser
+        self.assertTrue(all(perms.user_can_view(AnonymousUser(), item) for item in items))
+
+    def test_register_many_marks_items_modified(self):
+        item = models.ObjectClass.objects.create(name="OC", workgroup=self.wg1, readyToReview=True)
+        modified = models.ObjectClass.objects.get(pk=item.pk).modified
+        # Incomplete doesn't change whether the item is public or locked.
+        self.ra.register_many([item], models.STATES.incomplete, self.registrar)
+        self.assertTrue(models.ObjectClass.objects.get(pk=item.pk).modified > modified)
+        self.assertEqual(item.modified, models.ObjectClass.objects.get(pk=item.pk).modified)
+
+    def test_register_many_skips_revisions_for_unversioned_types(self):
+        import reversion
+        self.item1.readyToReview = True
+        self.item1.save()
+        manager = reversion.revisions.default_revision_manager
+        is_registered = manager.is_registered
+        manager.is_registered = lambda model: model is not models.ObjectClass and is_registered(model)
+        try:
+            result = self.ra.register_many([self.item1], self.ra.public_state, self.registrar)
+        finally:
+            del manager.is_registered
+        self.assertEqual(result['success'], [self.item1])
+        self.assertTrue(models.ObjectClass.objects.get(pk=self.item1.pk)._is_public)
+
+    def test_deferred_recache(self):
+        items = [models.ObjectClass.objects.create(name="OC %s" % i, workgroup=self.wg1) for i in range(5)]
+        with models.deferred_recache():
+            with models.deferred_recache():
+                for item in items:
+                    models.Status.objects.create(
+                        concept=item, registrationAuthority=self.ra,
+                        registrationDate="2014-10-27", state=self.ra.public_state
+                    )
+            # Nothing is recached until the outermost block finishes.
+            self.assertEqual(models.ObjectClass.objects.filter(pk__in=[i.pk for i in items], _is_public=True).count(), 0)
+        self.assertEqual(models.ObjectClass.objects.filter(pk__in=[i.pk for i in items], _is_public=True).count(), 5)
+        self.assertTrue(all(perms.user_can_view(self.registrar, item) for item in items))
+
+        # Statuses saved outside a block are recached straight away.
+        models.Status.objects.filter(concept=items[0]).delete()
+        self.assertFalse(models.ObjectClass.objects.get(pk=items[0].pk)._is_public)
+
+    def test_loaddata_recaches_loaded_statuses(self):
+        import json
+        import os
+        import tempfile
+        from django.core.management import call_command
+
+        fixture = [{
+            "model": "aristotle_mdr.status", "pk": None,
+            "fields": {
+                "concept": self.item1.pk, "registrationAuthority": self.ra.pk,
+                "registrationDate": "2014-10-27", "state": self.ra.public_state,
+                "changeDetails": "", "created": "2014-10-27T00:00:00Z", "modified": "2014-10-27T00:00:00Z",
+            }
+        }]
+        fd, path = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(fixture, f)
+        try:
+            call_command('loaddata', path, verbosity=0)
+        finally:
+            os.remove(path)
+        self.assertTrue(models.ObjectClass.objects.get(pk=self.item1.pk)._is_public)
+
     # TODO: bulk action *and* cascade, where a user doesn't have permission for child elements.
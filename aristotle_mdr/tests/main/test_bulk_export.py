@@ -0,0 +1,94 @@
+from django.test import TestCase
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.utils.six import StringIO
+
+import aristotle_mdr.tests.utils as utils
+from aristotle_mdr import models
+
+import csv
+import datetime
+import json
+
+from django.test.utils import setup_test_environment
+setup_test_environment()
+
+
+class BulkExportTests(utils.LoggedInViewPages, TestCase):
+    def setUp(self):
+        super(BulkExportTests, self).setUp()
+        self.public_oc = models.ObjectClass.objects.create(name="Public OC", definition="Exported", workgroup=self.wg1)
+        models.Status.objects.create(
+            concept=self.public_oc,
+            registrationAuthority=self.ra,
+            registrationDate=datetime.date(2000, 1, 1),
+            state=self.ra.public_state
+        )
+        self.public_oc = models.ObjectClass.objects.get(pk=self.public_oc.pk)
+        self.private_oc = models.ObjectClass.objects.create(name="Private OC", definition="Exported", workgroup=self.wg1)
+        self.private_prop = models.Property.objects.create(name="Private Property", definition="Exported", workgroup=self.wg1)
+
+    def get_json_rows(self, response):
+        self.assertEqual(response.status_code, 200)
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        return dict((row['id'], row) for row in rows)
+
+    def test_anonymous_users_only_export_public_items(self):
+        self.logout()
+        rows = self.get_json_rows(self.client.get(reverse('aristotle:bulk_export', args=['json'])))
+        self.assertTrue(self.public_oc.pk in rows)
+        self.assertFalse(self.private_oc.pk in rows)
+        self.assertFalse(self.private_prop.pk in rows)
+
+        row = rows[self.public_oc.pk]
+        self.assertEqual(row['type'], 'aristotle_mdr.objectclass')
+        self.assertEqual(row['workgroup'], self.wg1.name)
+        self.assertEqual(row['statuses'][0]['registration_authority'], self.ra.name)
+
+    def test_viewers_export_items_in_their_workgroups_by_type(self):
+        self.login_viewer()
+        rows = self.get_json_rows(self.client.get(reverse('aristotle:bulk_export', args=['json'])))
+        self.assertTrue(self.private_oc.pk in rows)
+        self.assertTrue(self.private_prop.pk in rows)
+
+        rows = self.get_json_rows(self.client.get(
+            reverse('aristotle:bulk_export', args=['json']) + '?type=aristotle_mdr.property'
+        ))
+        self.assertEqual(list(rows.keys()), [self.private_prop.pk])
+
+        response = self.client.get(reverse('aristotle:bulk_export', args=['json']) + '?type=auth.user')
+        self.assertEqual(response.status_code, 400)
+
+    def test_items_without_a_stored_type_are_exported(self):
+        from aristotle_mdr import exporter
+        models._concept.objects.filter(pk__in=[self.private_oc.pk, self.private_prop.pk]).update(_concrete_type=None)
+
+        items = exporter.filter_types(models._concept.objects.all(), ['aristotle_mdr.objectclass'])
+        self.assertEqual(sorted(items.values_list('pk', flat=True)), [self.public_oc.pk, self.private_oc.pk])
+
+        rows = dict((row['id'], row) for row in exporter.export_rows(models._concept.objects.all()))
+        self.assertEqual(rows[self.private_oc.pk]['type'], 'aristotle_mdr.objectclass')
+        self.assertEqual(rows[self.private_prop.pk]['type'], 'aristotle_mdr.property')
+
+    def test_csv_export(self):
+        self.login_viewer()
+        response = self.client.get(reverse('aristotle:bulk_export', args=['csv']) + '?type=aristotle_mdr.objectclass')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        rows = list(csv.DictReader(StringIO(b''.join(response.streaming_content))))
+        self.assertEqual(sorted(int(row['id']) for row in rows), [self.public_oc.pk, self.private_oc.pk])
+        public_row = [row for row in rows if int(row['id']) == self.public_oc.pk][0]
+        self.assertEqual(public_row['statuses'], '%s: %s' % (self.ra.name, models.STATES[self.ra.public_state]))
+
+    def test_export_command_reads_in_chunks(self):
+        out = StringIO()
+        call_command('export_concepts', export_format='json', types=['aristotle_mdr.objectclass'], public_only=True, chunk_size=1, stdout=out)
+        rows = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([row['id'] for row in rows], [self.public_oc.pk])
+
+        out = StringIO()
+        call_command('export_concepts', types=['aristotle_mdr.objectclass', 'aristotle_mdr.property'], chunk_size=2, stdout=out)
+        ids = [int(row['id']) for row in csv.DictReader(StringIO(out.getvalue()))]
+        self.assertEqual(ids, sorted(ids))
+        for item in [self.public_oc, self.private_oc, self.private_prop]:
+            self.assertTrue(item.pk in ids)
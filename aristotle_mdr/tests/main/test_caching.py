@@ -67,3 +67,141 @@ class CachingForRawPermissions(TestCase):
         )
         self.assertTrue(perms.user_can_view(self.submitter, self.item))
         self.assertTrue(perms.user_can_view(self.viewer, self.item))
+
+
+class ItemFragmentCaching(utils.LoggedInViewPages, TestCase):
+    def setUp(self):
+        super(ItemFragmentCaching, self).setUp()
+        self.item = models.ObjectClass.objects.create(name="Cached OC", definition="Original definition", workgroup=self.wg1)
+        models.Status.objects.create(
+            concept=self.item,
+            registrationAuthority=self.ra,
+            registrationDate=datetime.date(2000, 1, 1),
+            state=self.ra.public_state
+        )
+        self.item = models.ObjectClass.objects.get(pk=self.item.pk)
+
+    def test_public_item_body_is_shared_until_the_item_changes(self):
+        self.logout()
+        response = self.client.get(self.item.get_absolute_url())
+        self.assertContains(response, "Original definition")
+
+        # A change that doesn't go through save() isn't seen while cached...
+        models.ObjectClass.objects.filter(pk=self.item.pk).update(definition="Sneaky definition")
+        response = self.client.get(self.item.get_absolute_url())
+        self.assertContains(response, "Original definition")
+
+        # ... but saving the item renders it again for everyone.
+        item = models.ObjectClass.objects.get(pk=self.item.pk)
+        item.definition = "Changed definition"
+        item.save()
+        response = self.client.get(item.get_absolute_url())
+        self.assertContains(response, "Changed definition")
+        self.assertNotContains(response, "Original definition")
+
+    def test_item_body_depends_on_how_the_user_sees_it(self):
+        self.item = models.ObjectClass.objects.create(name="Draft OC", definition="Draft", workgroup=self.wg1)
+        supersede_url = reverse('aristotle:supersede', args=[self.item.pk])
+        self.login_editor()
+        response = self.client.get(self.item.get_absolute_url())
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, supersede_url)
+
+        self.logout()
+        self.login_viewer()
+        response = self.client.get(self.item.get_absolute_url())
+        self.assertEqual(response.status_code, 200)
+        self.assertNotContains(response, supersede_url)
+
+        self.assertNotEqual(
+            perms.viewer_class(self.editor, self.item),
+            perms.viewer_class(self.viewer, self.item)
+        )
+        other_viewer = User.objects.create_user('other_viewer', '', 'viewer')
+        self.wg1.giveRoleToUser('viewer', other_viewer)
+        self.assertEqual(
+            perms.viewer_class(other_viewer, self.item),
+            perms.viewer_class(self.viewer, self.item)
+        )
+
+
+class ConditionalGetTests(utils.LoggedInViewPages, TestCase):
+    def setUp(self):
+        super(ConditionalGetTests, self).setUp()
+        self.item = models.ObjectClass.objects.create(name="Harvested OC", definition="Harvested", workgroup=self.wg1)
+        models.Status.objects.create(
+            concept=self.item,
+            registrationAuthority=self.ra,
+            registrationDate=datetime.date(2000, 1, 1),
+            state=self.ra.public_state
+        )
+        self.item = models.ObjectClass.objects.get(pk=self.item.pk)
+
+    def assertNotModified(self, url, **headers):
+        response = self.client.get(url, **headers)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        return response
+
+    def test_anonymous_item_pages_are_not_sent_again(self):
+        self.logout()
+        for url in [self.item.get_absolute_url(), reverse('aristotle:registrationHistory', args=[self.item.pk])]:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            etag, last_modified = response['ETag'], response['Last-Modified']
+
+            self.assertNotModified(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertNotModified(url, HTTP_IF_NONE_MATCH=etag, HTTP_IF_MODIFIED_SINCE=last_modified)
+            # The modified time alone doesn't cover everything the page depends on.
+            response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+            self.assertEqual(response.status_code, 200)
+            response = self.client.get(url, HTTP_IF_NONE_MATCH='"something else"')
+            self.assertEqual(response.status_code, 200)
+
+        url = self.item.get_absolute_url()
+        response = self.client.get(url)
+        etag = response['ETag']
+        item = models.ObjectClass.objects.get(pk=self.item.pk)
+        item.definition = "Changed"
+        item.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "Changed")
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_logged_in_item_pages_are_always_sent(self):
+        self.login_viewer()
+        response = self.client.get(self.item.get_absolute_url())
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('ETag'))
+
+    def test_downloads_depend_on_the_users_permissions(self):
+        self.login_viewer()
+        url = reverse('aristotle:download', args=['pdf', self.item.pk])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertNotModified(url, HTTP_IF_NONE_MATCH=etag)
+
+        last_modified = response['Last-Modified']
+        perms.user_roles_changed(self.viewer.pk)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 200)
+
+    def test_private_items_are_never_answered_from_the_clients_copy(self):
+        private = models.ObjectClass.objects.create(name="Private OC", definition="Private", workgroup=self.wg1)
+        self.logout()
+        for url in [private.get_absolute_url(), reverse('aristotle:registrationHistory', args=[private.pk])]:
+            response = self.client.get(url, HTTP_IF_MODIFIED_SINCE='Fri, 01 Jan 2100 00:00:00 GMT')
+            self.assertEqual(response.status_code, 302)
+            self.assertFalse(response.has_header('ETag'))
+
+        self.login_registrar()
+        url = reverse('aristotle:download', args=['pdf', private.pk])
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE='Fri, 01 Jan 2100 00:00:00 GMT')
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(response.has_header('ETag'))
+
@@ -0,0 +1,128 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.test.utils import override_settings, setup_test_environment
+from django.utils import timezone
+from notifications.models import Notification
+
+import datetime
+
+import aristotle_mdr.models as models
+from aristotle_mdr import tasks
+
+setup_test_environment()
+
+queued_settings = dict(settings.ARISTOTLE_SETTINGS, DEFERRED_TASK_MODE='process')
+calls = []
+
+
+def record_call(**kwargs):
+    calls.append(kwargs)
+
+
+def fail(**kwargs):
+    raise ValueError("This task always fails")
+
+
+@override_settings(ARISTOTLE_SETTINGS=queued_settings)
+class DeferredTaskQueueTest(TestCase):
+    def setUp(self):
+        del calls[:]
+
+    def test_tasks_are_queued_once_per_key(self):
+        tasks.defer('aristotle_mdr.tests.main.test_deferred_tasks.record_call', key='wg_1', value=1)
+        tasks.defer('aristotle_mdr.tests.main.test_deferred_tasks.record_call', key='wg_1', value=1)
+        tasks.defer('aristotle_mdr.tests.main.test_deferred_tasks.record_call', key='wg_2', value=2)
+        self.assertEqual(models.DeferredTask.objects.count(), 2)
+        self.assertEqual(calls, [])
+
+        self.assertEqual(tasks.run_pending(), 2)
+        self.assertEqual(calls, [{'value': 1}, {'value': 2}])
+        self.assertEqual(models.DeferredTask.objects.count(), 0)
+
+    def test_failed_tasks_are_retried_then_kept(self):
+        tasks.defer('aristotle_mdr.tests.main.test_deferred_tasks.fail')
+        for attempt in range(1, tasks.get_retries() + 1):
+            self.assertEqual(tasks.run_pending(), 1)
+            task = models.DeferredTask.objects.get()
+            self.assertEqual(task.attempts, attempt)
+            self.assertTrue(task.started is None)
+            self.assertTrue(task.run_after > timezone.now())
+            self.assertTrue('This task always fails' in task.error)
+            # Retries wait until they are due
+            self.assertEqual(tasks.run_pending(), 0)
+            models.DeferredTask.objects.update(run_after=timezone.now() - datetime.timedelta(seconds=1))
+
+        self.assertEqual(tasks.run_pending(), 1)
+        task = models.DeferredTask.objects.get()
+        self.assertTrue(task.started is not None)
+        self.assertEqual(task.attempts, tasks.get_retries() + 1)
+        # Tasks that have failed too many times aren't retried
+        self.assertEqual(tasks.run_pending(), 0)
+
+    def test_only_one_task_can_wait_for_each_key(self):
+        from django.db import IntegrityError, transaction
+        tasks.defer('aristotle_mdr.tests.main.test_deferred_tasks.record_call', key='wg_1', value=1)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            models.DeferredTask.objects.create(
+                task='aristotle_mdr.tests.main.test_deferred_tasks.record_call', key='wg_1', pending_key='wg_1'
+            )
+
+        # Once a task has started, the same key can be queued again.
+        models.DeferredTask.objects.update(started=timezone.now(), pending_key=None)
+        tasks.defer('aristotle_mdr.tests.main.test_deferred_tasks.record_call', key='wg_1', value=1)
+        self.assertEqual(models.DeferredTask.objects.filter(pending_key='wg_1').count(), 1)
+
+    def test_waiting_tasks_can_be_updated(self):
+        tasks.defer('aristotle_mdr.tests.main.test_deferred_tasks.record_call', key='wg_1', first=1, last=1)
+        self.assertTrue(tasks.update_pending('wg_1', last=2))
+        self.assertFalse(tasks.update_pending('wg_2', last=2))
+        tasks.run_pending()
+        self.assertEqual(calls, [{'first': 1, 'last': 2}])
+        # Once a task has started it can't be changed.
+        self.assertFalse(tasks.update_pending('wg_1', last=3))
+
+    def test_delayed_tasks_wait_until_they_are_due(self):
+        tasks.defer('aristotle_mdr.tests.main.test_deferred_tasks.record_call', key='later', delay=60, value=1)
+        self.assertEqual(tasks.run_pending(), 0)
+        models.DeferredTask.objects.update(run_after=timezone.now() - datetime.timedelta(seconds=1))
+        self.assertEqual(tasks.run_pending(), 1)
+        self.assertEqual(calls, [{'value': 1}])
+
+    def test_item_notifications_are_sent_once_for_many_saves(self):
+        wg = models.Workgroup.objects.create(name="Test WG")
+        viewers = [User.objects.create_user('viewer%s' % i, '', 'viewer') for i in range(3)]
+        for viewer in viewers:
+            wg.giveRoleToUser('viewer', viewer)
+        item = models.ObjectClass.objects.create(name="OC1", workgroup=wg)
+        for i in range(3):
+            item.definition = "Changed %s times" % i
+            item.save()
+        self.assertEqual(models.DeferredTask.objects.count(), 1)
+        self.assertEqual(Notification.objects.count(), 0)
+
+        models.DeferredTask.objects.update(run_after=None)
+        tasks.run_pending()
+        for viewer in viewers:
+            self.assertEqual(viewer.notifications.count(), 1)
+            self.assertEqual(viewer.notifications.get().target, wg)
+
+    def test_workgroup_changes_queue_a_recache(self):
+        ra = models.RegistrationAuthority.objects.create(name="Test RA")
+        wg = models.Workgroup.objects.create(name="Test WG")
+        item = models.ObjectClass.objects.create(name="OC1", workgroup=wg)
+        models.Status.objects.create(
+            concept=item, registrationAuthority=ra, state=ra.public_state,
+            registrationDate=datetime.date(2009, 4, 28)
+        )
+        self.assertFalse(models.ObjectClass.objects.get(pk=item.pk)._is_public)
+
+        wg.registrationAuthorities.add(ra)
+        wg.ownership = models.WORKGROUP_OWNERSHIP.registry
+        wg.save()
+        recaches = models.DeferredTask.objects.filter(task='aristotle_mdr.tasks.recache_workgroup')
+        self.assertEqual(recaches.count(), 1)
+
+        tasks.run_pending()
+        self.assertTrue(models.ObjectClass.objects.get(pk=item.pk)._is_public)
+        self.assertEqual(recaches.count(), 0)
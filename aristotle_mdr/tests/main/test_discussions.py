@@ -68,6 +68,77 @@ class PostingAndCommentingAtObjectLevel(TestCase):
         self.assertTrue(posts[0:3],[post3,post1,post2])
 
 
+class PostNotifications(TestCase):
+    def setUp(self):
+        self.wg1 = models.Workgroup.objects.create(name="Test WG 1")
+        self.viewer1 = User.objects.create_user('vicky','','viewer')
+        self.viewer2 = User.objects.create_user('viewer2','','viewer')
+        self.manager = User.objects.create_user('mandy','','manger')
+        self.wg1.giveRoleToUser('viewer',self.viewer1)
+        self.wg1.giveRoleToUser('viewer',self.viewer2)
+        self.wg1.giveRoleToUser('manager',self.manager)
+        # Someone with two roles is still only notified once.
+        self.wg1.giveRoleToUser('submitter',self.manager)
+
+    def test_members_are_notified_of_new_posts(self):
+        post = models.DiscussionPost.objects.create(author=self.viewer1,workgroup=self.wg1,title="test",body="test")
+        self.assertEqual(self.viewer1.notifications.count(), 0)
+        for user in [self.viewer2, self.manager]:
+            notification = user.notifications.get()
+            self.assertEqual(notification.verb, "made a new post")
+            self.assertEqual(notification.target, post)
+            self.assertEqual(notification.actor, self.viewer1)
+
+    def test_large_workgroups_get_a_digest(self):
+        from django.conf import settings
+        from django.test.utils import override_settings
+        from aristotle_mdr import tasks
+        with override_settings(ARISTOTLE_SETTINGS=dict(settings.ARISTOTLE_SETTINGS, DEFERRED_TASK_MODE='process', DISCUSSION_DIGEST_MEMBERS=3)):
+            for author in [self.viewer1, self.viewer1, self.viewer2]:
+                models.DiscussionPost.objects.create(author=author,workgroup=self.wg1,title="test",body="test")
+            self.assertEqual(models.DeferredTask.objects.count(), 1)
+            models.DeferredTask.objects.update(run_after=None)
+            tasks.run_pending()
+        for user, verb in [
+                (self.viewer1, "has 1 new discussion post"),
+                (self.viewer2, "has 2 new discussion posts"),
+                (self.manager, "has 3 new discussion posts")]:
+            notification = user.notifications.get()
+            self.assertEqual(notification.verb, verb)
+            self.assertEqual(notification.target, self.wg1)
+
+    def test_posts_made_while_a_digest_runs_are_in_the_next_digest(self):
+        from django.conf import settings
+        from django.test.utils import override_settings
+        from aristotle_mdr import messages, tasks
+        original_digest = messages.discussion_digest
+
+        def post_then_send_digest(**kwargs):
+            models.DiscussionPost.objects.create(author=self.viewer2,workgroup=self.wg1,title="test",body="test")
+            original_digest(**kwargs)
+
+        with override_settings(ARISTOTLE_SETTINGS=dict(settings.ARISTOTLE_SETTINGS, DEFERRED_TASK_MODE='process', DISCUSSION_DIGEST_MEMBERS=3)):
+            for author in [self.viewer1, self.viewer1]:
+                models.DiscussionPost.objects.create(author=author,workgroup=self.wg1,title="test",body="test")
+            models.DeferredTask.objects.update(run_after=None)
+            messages.discussion_digest = post_then_send_digest
+            try:
+                tasks.run_pending()
+            finally:
+                messages.discussion_digest = original_digest
+            self.assertEqual(models.DeferredTask.objects.count(), 1)
+            models.DeferredTask.objects.update(run_after=None)
+            tasks.run_pending()
+        self.assertEqual(
+            sorted(self.manager.notifications.values_list('verb', flat=True)),
+            ["has 1 new discussion post", "has 2 new discussion posts"]
+        )
+        self.assertEqual(
+            list(self.viewer2.notifications.values_list('verb', flat=True)),
+            ["has 2 new discussion posts"]
+        )
+
+
 class WorkgroupMembersCanMakePostsAndComments(utils.LoggedInViewPages,TestCase):
     def setUp(self):
         super(WorkgroupMembersCanMakePostsAndComments, self).setUp()
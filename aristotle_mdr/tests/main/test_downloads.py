@@ -0,0 +1,285 @@
+from django.conf import settings
+from django.test import TestCase
+from django.core.urlresolvers import reverse
+from django.test.utils import override_settings
+
+import aristotle_mdr.tests.utils as utils
+from aristotle_mdr import downloader
+from aristotle_mdr import models
+
+import shutil
+import tempfile
+
+from django.test.utils import setup_test_environment
+setup_test_environment()
+
+
+class CachedPDFDownloadTests(utils.LoggedInViewPages, TestCase):
+    def setUp(self):
+        super(CachedPDFDownloadTests, self).setUp()
+        self.item = models.ObjectClass.objects.create(name="Downloaded OC", definition="Downloaded", workgroup=self.wg1)
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def aristotle_settings(self, **kwargs):
+        kwargs.setdefault('DOWNLOAD_CACHE_DIR', self.cache_dir)
+        return override_settings(ARISTOTLE_SETTINGS=dict(settings.ARISTOTLE_SETTINGS, **kwargs))
+
+    def cached_files(self):
+        storage = downloader.get_download_cache()
+        if not storage.exists('pdf/%s' % self.item.pk):
+            return []
+        return storage.listdir('pdf/%s' % self.item.pk)[1]
+
+    def test_pdfs_are_served_from_the_cache(self):
+        self.login_viewer()
+        with self.aristotle_settings():
+            response = self.client.get(reverse('aristotle:download', args=['pdf', self.item.id]))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Type'], 'application/pdf')
+            self.assertEqual(len(self.cached_files()), 1)
+
+            cached = self.cached_files()[0]
+            with open('%s/pdf/%s/%s' % (self.cache_dir, self.item.pk, cached), 'wb') as f:
+                f.write(b'cached pdf')
+            response = self.client.get(reverse('aristotle:download', args=['pdf', self.item.id]))
+            self.assertEqual(response.content, b'cached pdf')
+
+            # Each page size is cached separately.
+            response = self.client.get(reverse('aristotle:download', args=['pdf', self.item.id]) + '?pagesize=A3')
+            self.assertNotEqual(response.content, b'cached pdf')
+            self.assertEqual(len(self.cached_files()), 2)
+
+            # Changing the item means it is rendered again.
+            self.item.definition = "Changed"
+            self.item.save()
+            response = self.client.get(reverse('aristotle:download', args=['pdf', self.item.id]))
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response.content, b'cached pdf')
+            self.assertEqual(len(self.cached_files()), 3)
+
+    def test_new_statuses_change_the_cached_pdf(self):
+        from django.test import RequestFactory
+        request = RequestFactory().get('/')
+        template, context, name = downloader.pdf_download(request, self.item)
+        self.ra.register(self.item, models.STATES.incomplete, self.su)
+        item = models.ObjectClass.objects.get(pk=self.item.pk)
+        self.assertNotEqual(downloader.pdf_download(request, item)[2], name)
+
+    def test_failed_renders_are_only_kept_briefly(self):
+        import os
+        import time
+        with self.aristotle_settings():
+            storage = downloader.get_download_cache()
+            storage.save('pdf/broken.pdf.error.html', downloader.ContentFile(b'<p>broken</p>'))
+            self.assertEqual(downloader.get_render_error(storage, 'pdf/broken.pdf'), '<p>broken</p>')
+            old = time.time() - downloader.ERROR_CACHE_SECONDS - 1
+            os.utime(storage.path('pdf/broken.pdf.error.html'), (old, old))
+            self.assertEqual(downloader.get_render_error(storage, 'pdf/broken.pdf'), None)
+            self.assertFalse(storage.exists('pdf/broken.pdf.error.html'))
+
+    def test_slow_pdfs_are_rendered_in_the_background(self):
+        from aristotle_mdr import tasks
+        self.login_viewer()
+        url = reverse('aristotle:download', args=['pdf', self.item.id])
+        # Tasks are only queued, so the PDF isn't ready until they are run.
+        with self.aristotle_settings(DEFERRED_TASK_MODE='process', PDF_RENDER_WAIT=0):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(response['Refresh'], '5')
+            # Checking back doesn't start the render again.
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(models.DeferredTask.objects.count(), 1)
+            self.assertEqual(self.cached_files(), [])
+
+            self.assertEqual(tasks.run_pending(), 1)
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Type'], 'application/pdf')
+            self.assertEqual(len(self.cached_files()), 1)
+
+    def test_renders_that_raise_errors_are_shown(self):
+        from aristotle_mdr import tasks
+        self.login_viewer()
+        url = reverse('aristotle:download', args=['pdf', self.item.id])
+
+        def broken(html):
+            raise ValueError("Rendering broke")
+        html_to_pdf, downloader.html_to_pdf = downloader.html_to_pdf, broken
+        try:
+            with self.aristotle_settings(DEFERRED_TASK_MODE='process', PDF_RENDER_WAIT=0):
+                self.assertEqual(self.client.get(url).status_code, 202)
+                self.assertEqual(tasks.run_pending(), 1)
+                response = self.client.get(url)
+        finally:
+            downloader.html_to_pdf = html_to_pdf
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'We had some errors')
+        self.assertEqual(models.DeferredTask.objects.count(), 0)
+
+
+class ValueDomainCSVDownloadTests(utils.LoggedInViewPages, TestCase):
+    def setUp(self):
+        super(ValueDomainCSVDownloadTests, self).setUp()
+        self.vd = models.ValueDomain.objects.create(name="Downloaded VD", definition="Downloaded", workgroup=self.wg1)
+        # Values that share a position are kept in the order they were added.
+        for i, order in enumerate([1, 1, 2, 0, 1]):
+            models.PermissibleValue.objects.create(valueDomain=self.vd, value="P%s" % i, meaning="Meaning %s" % i, order=order)
+        models.SupplementaryValue.objects.create(valueDomain=self.vd, value="S", meaning="Missing", order=0)
+
+    def expected_rows(self):
+        return [
+            ['value', 'meaning', 'start date', 'end date', 'role'],
+            ['P3', 'Meaning 3', '', '', 'permissible'],
+            ['P0', 'Meaning 0', '', '', 'permissible'],
+            ['P1', 'Meaning 1', '', '', 'permissible'],
+            ['P4', 'Meaning 4', '', '', 'permissible'],
+            ['P2', 'Meaning 2', '', '', 'permissible'],
+            ['S', 'Missing', '', '', 'supplementary'],
+        ]
+
+    def test_values_are_read_in_chunks_in_order(self):
+        rows = list(downloader.value_rows(self.vd.permissibleValues, chunk_size=2))
+        self.assertEqual([row[0] for row in rows], ['P3', 'P0', 'P1', 'P4', 'P2'])
+
+    def test_csv_download_streams_values(self):
+        import csv
+        from django.utils.six import StringIO
+        self.login_viewer()
+        response = self.client.get(reverse('aristotle:download', args=['csv-vd', self.vd.id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Row-Count'], '6')
+        rows = list(csv.reader(StringIO(b''.join(response.streaming_content))))
+        self.assertEqual(rows, self.expected_rows())
+
+    def test_gzipped_csv_download(self):
+        import csv
+        import gzip
+        from django.utils.six import StringIO
+        self.login_viewer()
+        response = self.client.get(reverse('aristotle:download', args=['csv-vd', self.vd.id]) + '?compress=gzip')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        self.assertTrue(response['Content-Disposition'].endswith('.csv.gz"'))
+        content = gzip.GzipFile(fileobj=StringIO(b''.join(response.streaming_content))).read()
+        self.assertEqual(list(csv.reader(StringIO(content))), self.expected_rows())
+
+
+class BundleDownloadTests(utils.LoggedInViewPages, TestCase):
+    def setUp(self):
+        super(BundleDownloadTests, self).setUp()
+        self.oc = models.ObjectClass.objects.create(name="Bundled OC", definition="Bundled", workgroup=self.wg1)
+        self.vd = models.ValueDomain.objects.create(name="Bundled VD", definition="Bundled", workgroup=self.wg1)
+        models.PermissibleValue.objects.create(valueDomain=self.vd, value="P", meaning="Permissible", order=0)
+        self.hidden = models.ObjectClass.objects.create(name="Hidden OC", definition="Bundled", workgroup=self.wg2)
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def aristotle_settings(self, **kwargs):
+        kwargs.setdefault('DOWNLOAD_CACHE_DIR', self.cache_dir)
+        return override_settings(ARISTOTLE_SETTINGS=dict(settings.ARISTOTLE_SETTINGS, **kwargs))
+
+    def get_bundle(self, download_type, items):
+        import zipfile
+        from django.utils.six import BytesIO
+        response = self.client.get(
+            reverse('aristotle:download_bundle', args=[download_type]) + '?items=%s' % ','.join(str(i.pk) for i in items)
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        return zipfile.ZipFile(BytesIO(b''.join(response.streaming_content)))
+
+    def test_pdf_bundle_reuses_cached_pdfs(self):
+        self.login_viewer()
+        with self.aristotle_settings():
+            self.client.get(reverse('aristotle:download', args=['pdf', self.oc.id]))
+            cached = downloader.get_download_cache().listdir('pdf/%s' % self.oc.pk)[1][0]
+            with open('%s/pdf/%s/%s' % (self.cache_dir, self.oc.pk, cached), 'wb') as f:
+                f.write(b'cached pdf')
+
+            bundle = self.get_bundle('pdf', [self.vd, self.oc, self.hidden])
+            self.assertEqual(bundle.namelist(), [
+                'bundled-vd-%s.pdf' % self.vd.pk,
+                'bundled-oc-%s.pdf' % self.oc.pk,
+            ])
+            self.assertEqual(bundle.read('bundled-oc-%s.pdf' % self.oc.pk), b'cached pdf')
+            self.assertTrue(bundle.read('bundled-vd-%s.pdf' % self.vd.pk).startswith(b'%PDF'))
+
+    def test_pdf_bundle_renders_in_the_background(self):
+        from aristotle_mdr import tasks
+        self.login_viewer()
+        with self.aristotle_settings(DEFERRED_TASK_MODE='process', PDF_BUNDLE_WAIT=0):
+            # PDFs that aren't ready in time are left out.
+            bundle = self.get_bundle('pdf', [self.oc, self.vd])
+            self.assertEqual(bundle.namelist(), [])
+            self.assertEqual(models.DeferredTask.objects.count(), 2)
+
+            self.assertEqual(tasks.run_pending(), 2)
+            bundle = self.get_bundle('pdf', [self.oc, self.vd])
+            self.assertEqual(sorted(bundle.namelist()), [
+                'bundled-oc-%s.pdf' % self.oc.pk,
+                'bundled-vd-%s.pdf' % self.vd.pk,
+            ])
+            self.assertTrue(downloader.get_download_cache().exists('pdf/%s' % self.vd.pk))
+
+    def test_bundle_only_includes_items_with_that_download(self):
+        self.login_viewer()
+        bundle = self.get_bundle('csv-vd', [self.oc, self.vd])
+        self.assertEqual(bundle.namelist(), ['bundled-vd-%s.csv' % self.vd.pk])
+        self.assertTrue(bundle.read('bundled-vd-%s.csv' % self.vd.pk).startswith(b'value,meaning'))
+
+    def test_bad_bundles(self):
+        self.login_viewer()
+        response = self.client.get(reverse('aristotle:download_bundle', args=['pdf']) + '?items=one')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(reverse('aristotle:download_bundle', args=['nothing']) + '?items=1')
+        self.assertEqual(response.status_code, 404)
+
+        self.logout()
+        bundle = self.get_bundle('pdf', [self.oc])
+        self.assertEqual(bundle.namelist(), [])
+
+
+class DownloaderRegistryTests(TestCase):
+    def test_registry_resolves_each_download_type(self):
+        from aristotle_mdr import downloader as mdr_downloader
+        from aristotle_mdr.downloads import get_downloader
+
+        pdf = get_downloader('pdf')
+        self.assertEqual(pdf.download, mdr_downloader.download)
+        self.assertTrue(pdf.cacheable)
+        self.assertFalse(pdf.streaming)
+        self.assertTrue(get_downloader('csv-vd').streaming)
+        self.assertEqual(get_downloader('txt').module_name, 'text_download_test')
+        self.assertEqual(get_downloader('docx'), None)
+
+    def test_last_matching_download_type_is_used(self):
+        from aristotle_mdr.downloads import build_registry
+        registry = build_registry([
+            ('txt', 'Text', 'fa-file-pdf-o', 'aristotle_mdr'),
+            ('txt', 'Text', 'fa-file-pdf-o', 'text_download_test'),
+        ])
+        self.assertEqual(list(registry.keys()), ['txt'])
+        self.assertEqual(registry['txt'].module_name, 'text_download_test')
+
+    def test_bad_download_settings_are_found_at_startup(self):
+        from django.core.exceptions import ImproperlyConfigured
+        from aristotle_mdr import exceptions
+        from aristotle_mdr.downloads import build_registry
+        with self.assertRaises(exceptions.BadDownloadTypeAbbreviation):
+            build_registry([('bad type', 'Text', 'fa-file-pdf-o', 'aristotle_mdr')])
+        with self.assertRaises(exceptions.BadDownloadModuleName):
+            build_registry([('txt', 'Text', 'fa-file-pdf-o', 'aristotle_mdr.downloader')])
+        with self.assertRaises(ImproperlyConfigured):
+            build_registry([('txt', 'Text', 'fa-file-pdf-o', 'no_such_download_module')])
+
+    def test_registry_follows_settings_changes(self):
+        from aristotle_mdr.downloads import get_downloader
+        with override_settings(ARISTOTLE_DOWNLOADS=[('pdf', 'PDF', 'fa-file-pdf-o', 'aristotle_mdr')]):
+            self.assertEqual(get_downloader('txt'), None)
+        self.assertNotEqual(get_downloader('txt'), None)
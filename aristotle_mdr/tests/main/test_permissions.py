@@ -299,3 +299,207 @@ class RegistryCascadeTest(TestCase):
         self.assertEqual(self.vd.current_statuses()[0].state,state)
         self.assertEqual(self.dec.current_statuses()[0].state,state)
         self.assertEqual(self.de.current_statuses()[0].state,state)
+
+class BulkPermissionsTest(TestCase):
+    def setUp(self):
+        self.ra = models.RegistrationAuthority.objects.create(name="Test RA")
+        self.wg1 = models.Workgroup.objects.create(name="Test WG 1")
+        self.wg1.registrationAuthorities.add(self.ra)
+        self.wg2 = models.Workgroup.objects.create(name="Test WG 2", ownership=models.WORKGROUP_OWNERSHIP.registry)
+
+        self.viewer = User.objects.create_user('vicky','','viewer')
+        self.submitter = User.objects.create_user('suzie','','submitter')
+        self.steward = User.objects.create_user('stewie','','steward')
+        self.registrar = User.objects.create_user('reggie','','registrar')
+        self.outsider = User.objects.create_user('oscar','','outsider')
+        self.wg1.viewers.add(self.viewer)
+        self.wg1.submitters.add(self.submitter)
+        self.wg1.stewards.add(self.steward)
+        self.ra.registrars.add(self.registrar)
+        su = User.objects.create_superuser('super','','user')
+
+        self.items = [
+            models.ObjectClass.objects.create(name="OC1", workgroup=self.wg1),
+            models.ObjectClass.objects.create(name="OC2", workgroup=self.wg1, readyToReview=True),
+            models.Property.objects.create(name="P1", workgroup=self.wg2),
+            models.Property.objects.create(name="P2", workgroup=self.wg2, readyToReview=True),
+        ]
+        locked = models.DataElement.objects.create(name="DE1", workgroup=self.wg1, readyToReview=True)
+        self.ra.register(locked, self.ra.locked_state, su)
+        public = models.DataElement.objects.create(name="DE2", workgroup=self.wg1, readyToReview=True)
+        self.ra.register(public, self.ra.public_state, su)
+        self.items += [
+            models.DataElement.objects.get(pk=locked.pk),
+            models.DataElement.objects.get(pk=public.pk),
+        ]
+
+    def test_bulk_permissions_match_single_item_checks(self):
+        from django.contrib.auth.models import AnonymousUser
+        users = [self.viewer, self.submitter, self.steward, self.registrar, self.outsider, AnonymousUser()]
+        for user in users:
+            can_view = perms.user_can_view_many(user, self.items)
+            can_edit = perms.user_can_edit_many(user, self.items)
+            for item in self.items:
+                self.assertEqual(can_view[item.id], item.can_view(user))
+                self.assertEqual(can_view[item.id], perms.user_can_view(user, item))
+                self.assertEqual(can_edit[item.id], perms.user_can_edit(user, item))
+
+    def test_bulk_permissions_use_fixed_queries(self):
+        from django.core.cache import cache
+        cache.clear()
+        items = list(models._concept.objects.filter(pk__in=[i.pk for i in self.items]))
+        perms.get_user_roles(self.registrar)
+        with self.assertNumQueries(3):
+            perms.user_can_view_many(self.registrar, items)
+        with self.assertNumQueries(0):
+            perms.user_can_view_many(self.registrar, items)
+
+
+class RoleSnapshotTest(TestCase):
+    def setUp(self):
+        self.wg = models.Workgroup.objects.create(name="Test WG")
+        self.ra = models.RegistrationAuthority.objects.create(name="Test RA")
+        self.user = User.objects.create_user('user','','user')
+
+    def test_roles_are_loaded_once(self):
+        perms.get_user_roles(self.user)
+        with self.assertNumQueries(0):
+            self.assertFalse(perms.user_is_editor(self.user))
+            self.assertFalse(perms.user_is_registrar(self.user))
+            self.assertFalse(perms.user_is_workgroup_manager(self.user))
+            self.assertFalse(perms.user_in_workgroup(self.user, self.wg))
+
+    def test_roles_update_when_memberships_change(self):
+        self.assertFalse(perms.user_in_workgroup(self.user, self.wg))
+        self.wg.giveRoleToUser('steward', self.user)
+        self.assertTrue(perms.user_in_workgroup(self.user, self.wg))
+        self.assertTrue(perms.user_is_editor(self.user, self.wg))
+        self.assertTrue(self.wg in self.user.profile.editable_workgroups)
+
+        self.ra.giveRoleToUser('registrar', self.user)
+        self.assertTrue(perms.user_is_registrar(self.user, self.ra))
+        self.assertTrue(self.ra in self.user.profile.registrarAuthorities)
+
+        # Changing roles from the users side of the relation
+        self.user.steward_in.clear()
+        self.assertFalse(perms.user_in_workgroup(self.user, self.wg))
+        self.user.workgroup_manager_in.add(self.wg)
+        self.assertTrue(perms.user_is_workgroup_manager(self.user, self.wg))
+
+        self.wg.managers.clear()
+        self.ra.registrars.clear()
+        self.assertFalse(perms.user_is_workgroup_manager(self.user, self.wg))
+        self.assertFalse(perms.user_is_registrar(self.user, self.ra))
+
+    def test_workgroup_members_are_cached(self):
+        self.wg.giveRoleToUser('viewer', self.user)
+        self.wg.giveRoleToUser('steward', self.user)
+        self.assertEqual(list(self.wg.members), [self.user])
+        with self.assertNumQueries(0):
+            self.assertTrue(self.wg.has_member(self.user))
+            self.assertEqual(self.wg.member_ids(), set([self.user.pk]))
+
+        other = User.objects.create_user('other','','user')
+        other.submitter_in.add(self.wg)
+        self.assertTrue(self.wg.has_member(other))
+        self.wg.viewers.clear()
+        self.wg.stewards.remove(self.user)
+        self.assertFalse(self.wg.has_member(self.user))
+        other.submitter_in.clear()
+        self.assertEqual(self.wg.member_ids(), set())
+
+        other.viewer_in.add(self.wg)
+        self.assertTrue(self.wg.has_member(other))
+        other.delete()
+        self.assertEqual(self.wg.member_ids(), set())
+
+
+class PermissionCacheInvalidationTest(TestCase):
+    def setUp(self):
+        self.ra = models.RegistrationAuthority.objects.create(name="Test RA")
+        self.wg = models.Workgroup.objects.create(name="Test WG")
+        self.su = User.objects.create_superuser('super','','user')
+        self.registrar = User.objects.create_user('reggie','','registrar')
+        self.ra.registrars.add(self.registrar)
+        self.item = models.ObjectClass.objects.create(name="OC1", workgroup=self.wg, readyToReview=True)
+
+    def test_cached_permissions_are_kept_apart_for_each_model(self):
+        from django.contrib.auth.models import AnonymousUser
+        ra = models.RegistrationAuthority.objects.create(name="Same id RA", pk=9999)
+        wg = models.Workgroup.objects.create(name="Same id WG", pk=9999)
+        for user in [AnonymousUser(), self.registrar]:
+            self.assertTrue(perms.user_can_view(user, ra))
+            self.assertFalse(perms.user_can_view(user, wg))
+        self.assertFalse(perms.user_can_edit(self.registrar, wg))
+
+    def test_cached_permissions_change_with_workgroup(self):
+        self.assertFalse(perms.user_can_view(self.registrar, self.item))
+        self.wg.registrationAuthorities.add(self.ra)
+        self.assertTrue(perms.user_can_view(self.registrar, self.item))
+        self.ra.workgroups.clear()
+        self.assertFalse(perms.user_can_view(self.registrar, self.item))
+        self.wg.ownership = models.WORKGROUP_OWNERSHIP.registry
+        self.wg.save()
+        self.assertTrue(perms.user_can_view(self.registrar, self.item))
+
+    def test_cached_permissions_change_with_roles_and_statuses(self):
+        self.wg.registrationAuthorities.add(self.ra)
+        self.wg.submitters.add(self.registrar)
+        self.assertTrue(perms.user_can_edit(self.registrar, self.item))
+        self.ra.register(self.item, self.ra.locked_state, self.su, registrationDate=datetime.date(2009, 4, 28))
+        self.item = models.ObjectClass.objects.get(pk=self.item.pk)
+        self.assertFalse(perms.user_can_edit(self.registrar, self.item))
+        self.wg.stewards.add(self.registrar)
+        self.assertTrue(perms.user_can_edit(self.registrar, self.item))
+
+    def test_cached_permissions_are_reused(self):
+        self.assertFalse(perms.user_can_view(self.registrar, self.item))
+        with self.assertNumQueries(0):
+            self.assertFalse(perms.user_can_view(self.registrar, self.item))
+
+
+class AnonymousPermissionsTest(TestCase):
+    def setUp(self):
+        self.ra = models.RegistrationAuthority.objects.create(name="Test RA")
+        self.wg = models.Workgroup.objects.create(name="Test WG")
+        self.wg.registrationAuthorities.add(self.ra)
+        su = User.objects.create_superuser('super','','user')
+        self.item = models.ObjectClass.objects.create(name="OC1", workgroup=self.wg)
+        self.public = models.ObjectClass.objects.create(name="OC2", workgroup=self.wg)
+        self.ra.register(self.public, self.ra.public_state, su, registrationDate=datetime.date(2009, 4, 28))
+        self.public = models.ObjectClass.objects.get(pk=self.public.pk)
+
+    def test_anonymous_users_use_public_state(self):
+        from django.contrib.auth.models import AnonymousUser
+        anon = AnonymousUser()
+        with self.assertNumQueries(0):
+            self.assertFalse(perms.user_can_view(anon, self.item))
+            self.assertTrue(perms.user_can_view(anon, self.public))
+            self.assertEqual(
+                perms.user_can_view_many(anon, [self.item, self.public]),
+                {self.item.id: False, self.public.id: True}
+            )
+
+    def test_public_item_cache(self):
+        from django.contrib.auth.models import AnonymousUser
+        anon = AnonymousUser()
+        perms.public_items.clear()
+        before = perms.public_items.stats()
+        self.assertTrue(perms.user_can_view(anon, self.ra))
+        self.assertTrue(perms.user_can_view(anon, self.ra))
+        after = perms.public_items.stats()
+        self.assertEqual(after['misses'] - before['misses'], 1)
+        self.assertEqual(after['hits'] - before['hits'], 1)
+        self.assertFalse(perms.user_can_view(anon, self.wg))
+        self.assertFalse(perms.user_can_view(anon, self.wg))
+        self.assertEqual(perms.public_items.stats()['size'], 1)
+
+    def test_public_item_cache_is_bounded(self):
+        lru = perms.PublicItemCache(size=2)
+        lru.add('a')
+        lru.add('b')
+        self.assertTrue('a' in lru)
+        lru.add('c')
+        self.assertFalse('b' in lru)
+        self.assertTrue('a' in lru)
+        self.assertTrue('c' in lru)
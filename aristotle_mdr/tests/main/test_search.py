@@ -1,3 +1,5 @@
+import datetime
+from django.conf import settings
 from django.test import TestCase
 
 import aristotle_mdr.models as models
@@ -162,11 +164,12 @@ class TestSearch(utils.LoggedInViewPages,TestCase):
 
         self.assertTrue(perms.user_can_view(self.registrar,steve_rogers))
 
+        # The workgroup is recached in the background (straight away in tests),
+        # so the index isn't stale.
         response = self.client.get(reverse('aristotle:search')+"?q=captainAmerica")
-        self.assertEqual(len(response.context['page'].object_list),0) # indexes are stale, so no results
-        #self.assertFalse(steve_rogers._is_public)
+        self.assertEqual(len(response.context['page'].object_list),1)
 
-        from django.core import management # Lets recache this workgroup
+        from django.core import management # Recaching manually still works
         management.call_command('recache_workgroup_item_visibility', wg=[self.avengers_wg.pk], verbosity=0)
 
         steve_rogers = models.ObjectClass.objects.get(pk=steve_rogers.pk)
@@ -484,3 +487,244 @@ class TestSearchDescriptions(TestCase):
         self.assertTrue('and' in description)
         self.assertTrue('Item visibility state is Public' in description)
 
+
+
+class TestSearchIndexPreparation(TestCase):
+    def setUp(self):
+        self.ra = models.RegistrationAuthority.objects.create(name="Test RA")
+        self.wg = models.Workgroup.objects.create(name="Test WG")
+        self.wg.registrationAuthorities.add(self.ra)
+        self.item = models.ObjectClass.objects.create(
+            name="Indexed item", definition="Indexed", workgroup=self.wg
+        )
+        models.Status.objects.create(
+            concept=self.item,
+            registrationAuthority=self.ra,
+            registrationDate=datetime.date(2000, 1, 1),
+            state=self.ra.public_state
+        )
+        from haystack import connections
+        self.index = connections['default'].get_unified_index().get_index(models.ObjectClass)
+
+    def test_prepared_fields_use_current_statuses(self):
+        data = self.index.prepare(models.ObjectClass.objects.get(pk=self.item.pk))
+        self.assertEqual(data['statuses'], [self.ra.public_state])
+        self.assertEqual(data['highest_state'], self.ra.public_state)
+        self.assertEqual(data['ra_statuses'], ["%s___%s" % (self.ra.pk, self.ra.public_state)])
+        self.assertEqual(data['registrationAuthorities'], [str(self.ra.pk)])
+        self.assertEqual(data['workgroup'], self.wg.pk)
+        self.assertFalse(hasattr(self.item, '_index_context'))
+
+    def test_index_queryset_prepares_the_same_fields_with_fewer_queries(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        item = models.ObjectClass.objects.get(pk=self.item.pk)
+        with CaptureQueriesContext(connection) as unprefetched:
+            expected = self.index.prepare(item)
+
+        item = self.index.index_queryset().get(pk=self.item.pk)
+        with CaptureQueriesContext(connection) as preparing:
+            data = self.index.prepare(item)
+
+        self.assertEqual(data, expected)
+        self.assertLess(len(preparing), len(unprefetched))
+
+
+class TestRebuildConceptIndex(TestCase):
+    def setUp(self):
+        self.wg = models.Workgroup.objects.create(name="Test WG")
+        self.items = [
+            models.ObjectClass.objects.create(name="Rebuilt item %s" % i, definition="Rebuilt", workgroup=self.wg)
+            for i in range(5)
+        ]
+        call_command('clear_index', interactive=False, verbosity=0)
+
+    def indexed_ids(self):
+        from haystack.query import SearchQuerySet
+        return sorted(int(r.pk) for r in SearchQuerySet().filter(content="Rebuilt"))
+
+    def test_rebuild_indexes_every_item_in_chunks(self):
+        from django.utils.six import StringIO
+        out = StringIO()
+        call_command('rebuild_concept_index', batch_size=2, stdout=out)
+        self.assertEqual(self.indexed_ids(), [i.pk for i in self.items])
+        self.assertIn('Successfully indexed %s items' % models._concept.objects.count(), out.getvalue())
+
+    def test_rebuild_removes_items_that_no_longer_exist(self):
+        from haystack import signal_processor
+        call_command('rebuild_concept_index', verbosity=0)
+        indexed = [i.pk for i in self.items]
+        # Delete an item without the search index hearing about it.
+        signal_processor.teardown()
+        try:
+            self.items[0].delete()
+        finally:
+            signal_processor.setup()
+        self.assertEqual(self.indexed_ids(), indexed)
+
+        call_command('rebuild_concept_index', batch_size=2, keep_removed=True, verbosity=0)
+        self.assertEqual(self.indexed_ids(), indexed)
+        call_command('rebuild_concept_index', batch_size=2, verbosity=0)
+        self.assertEqual(self.indexed_ids(), indexed[1:])
+
+    def test_rebuild_resumes_from_checkpoint(self):
+        import json
+        import os
+        import tempfile
+        handle, checkpoint = tempfile.mkstemp()
+        os.close(handle)
+        with open(checkpoint, 'w') as f:
+            json.dump({'last_pk': self.items[2].pk}, f)
+
+        call_command('rebuild_concept_index', batch_size=2, checkpoint=checkpoint, resume=True, verbosity=0)
+        self.assertEqual(self.indexed_ids(), [i.pk for i in self.items[3:]])
+        self.assertFalse(os.path.exists(checkpoint))
+
+
+class TestQueuedIndexUpdates(TestCase):
+    def setUp(self):
+        self.wg = models.Workgroup.objects.create(name="Test WG")
+        call_command('clear_index', interactive=False, verbosity=0)
+
+    def indexed_ids(self):
+        from haystack.query import SearchQuerySet
+        return sorted(int(r.pk) for r in SearchQuerySet().filter(content="Queued"))
+
+    def save_items(self):
+        items = []
+        for i in range(3):
+            with reversion.create_revision():
+                items.append(models.ObjectClass.objects.create(name="Queued item %s" % i, definition="Queued", workgroup=self.wg))
+        with reversion.create_revision():
+            # Saving an item again doesn't queue it twice.
+            items[0].save()
+        return [i.pk for i in items]
+
+    def test_realtime_updates(self):
+        ids = self.save_items()
+        self.assertEqual(self.indexed_ids(), ids)
+
+    @override_settings(ARISTOTLE_SETTINGS=dict(settings.ARISTOTLE_SETTINGS, SEARCH_INDEX_UPDATES='queued'))
+    def test_queued_updates_wait_for_the_end_of_the_request(self):
+        from django.core.signals import request_finished, request_started
+        from haystack import signal_processor
+        request_started.send(sender=self.__class__)
+        ids = self.save_items()
+        self.assertEqual(self.indexed_ids(), [])
+        self.assertEqual(len(signal_processor.queued_items()), 3)
+
+        request_finished.send(sender=self.__class__)
+        self.assertEqual(self.indexed_ids(), ids)
+        self.assertEqual(len(signal_processor.queued_items()), 0)
+
+    @override_settings(ARISTOTLE_SETTINGS=dict(settings.ARISTOTLE_SETTINGS, SEARCH_INDEX_UPDATES='deferred'))
+    def test_deferred_updates_are_run_as_a_task(self):
+        from django.core.signals import request_finished, request_started
+        request_started.send(sender=self.__class__)
+        ids = self.save_items()
+        with override_settings(ARISTOTLE_SETTINGS=dict(settings.ARISTOTLE_SETTINGS, SEARCH_INDEX_UPDATES='deferred', DEFERRED_TASK_MODE='process')):
+            request_finished.send(sender=self.__class__)
+        self.assertEqual(self.indexed_ids(), [])
+        self.assertEqual(models.DeferredTask.objects.count(), 1)
+
+        from aristotle_mdr.tasks import run_pending
+        run_pending()
+        self.assertEqual(self.indexed_ids(), ids)
+
+    @override_settings(ARISTOTLE_SETTINGS=dict(settings.ARISTOTLE_SETTINGS, SEARCH_INDEX_UPDATES='queued'))
+    def test_queued_updates_outside_a_request_are_not_held(self):
+        from django.db import transaction
+        from haystack import signal_processor
+        with transaction.atomic():
+            ids = self.save_items()
+        self.assertEqual(self.indexed_ids(), ids)
+        self.assertEqual(len(signal_processor.queued_items()), 0)
+
+    @override_settings(ARISTOTLE_SETTINGS=dict(settings.ARISTOTLE_SETTINGS, SEARCH_INDEX_UPDATES='deferred', DEFERRED_TASK_MODE='process'))
+    def test_deferred_updates_outside_a_request_are_queued_straight_away(self):
+        from django.db import transaction
+        from aristotle_mdr.tasks import run_pending
+        with transaction.atomic():
+            ids = self.save_items()
+            self.assertTrue(models.DeferredTask.objects.filter(task='aristotle_mdr.signals.update_queued_items_in_index').exists())
+        run_pending()
+        self.assertEqual(self.indexed_ids(), ids)
+
+
+class TestIndexRemoval(TestCase):
+    def setUp(self):
+        self.wg = models.Workgroup.objects.create(name="Test WG")
+        call_command('clear_index', interactive=False, verbosity=0)
+        self.items = []
+        for i in range(4):
+            with reversion.create_revision():
+                self.items.append(models.ObjectClass.objects.create(name="Removed item %s" % i, definition="Removed", workgroup=self.wg))
+
+    def indexed_ids(self):
+        from haystack.query import SearchQuerySet
+        return sorted(int(r.pk) for r in SearchQuerySet().filter(content="Removed"))
+
+    def test_deleted_items_are_removed_from_the_index(self):
+        self.items[0].delete()
+        self.assertEqual(self.indexed_ids(), [i.pk for i in self.items[1:]])
+
+        # Deleting through the base concept removes the subclassed documents.
+        models._concept.objects.filter(pk=self.items[1].pk).delete()
+        self.assertEqual(self.indexed_ids(), [i.pk for i in self.items[2:]])
+
+    def test_bulk_deletes_dont_look_up_each_subclass(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        with CaptureQueriesContext(connection) as one:
+            models.ObjectClass.objects.filter(pk=self.items[0].pk).delete()
+        with CaptureQueriesContext(connection) as many:
+            models.ObjectClass.objects.filter(pk__in=[i.pk for i in self.items[1:]]).delete()
+
+        def concept_lookups(queries):
+            return [
+                q for q in queries.captured_queries
+                if q['sql'].startswith('SELECT') and 'FROM "aristotle_mdr__concept"' in q['sql']
+            ]
+        self.assertEqual(len(concept_lookups(one)), len(concept_lookups(many)))
+        self.assertEqual(self.indexed_ids(), [])
+
+    def test_other_models_can_still_be_fast_deleted(self):
+        from django.db.models.deletion import Collector
+        collector = Collector(using='default')
+        self.assertTrue(collector.can_fast_delete(models.DeferredTask.objects.all()))
+        self.assertFalse(collector.can_fast_delete(models.ObjectClass.objects.all()))
+
+    def test_failed_deletes_dont_hold_up_later_removals(self):
+        from django.db import transaction
+        from django.db.models.signals import pre_delete
+
+        def fail(sender, instance, **kwargs):
+            if instance.pk == self.items[0].pk:
+                raise ValueError("Delete failed")
+        pre_delete.connect(fail, sender=models.ObjectClass)
+        try:
+            with self.assertRaises(ValueError), transaction.atomic():
+                models.ObjectClass.objects.filter(pk__in=[self.items[0].pk, self.items[1].pk]).delete()
+        finally:
+            pre_delete.disconnect(fail, sender=models.ObjectClass)
+        self.assertEqual(self.indexed_ids(), [i.pk for i in self.items])
+
+        self.items[1].delete()
+        self.assertEqual(self.indexed_ids(), [self.items[0].pk] + [i.pk for i in self.items[2:]])
+
+    def test_deletes_in_a_request_are_removed_once_they_are_committed(self):
+        from django.core.signals import request_finished, request_started
+        from django.db import transaction
+        ids = [i.pk for i in self.items]
+        request_started.send(sender=self.__class__)
+        try:
+            models.ObjectClass.objects.filter(pk__in=[self.items[0].pk, self.items[1].pk]).delete()
+            self.assertEqual(self.indexed_ids(), ids)
+            with self.assertRaises(ValueError), transaction.atomic():
+                self.items[2].delete()
+                raise ValueError("Rolled back")
+        finally:
+            request_finished.send(sender=self.__class__)
+        self.assertEqual(self.indexed_ids(), ids[2:])
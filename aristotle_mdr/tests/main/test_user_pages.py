@@ -45,6 +45,18 @@ class UserHomePages(utils.LoggedInViewPages, TestCase):
         self.viewer = User.objects.get(pk=self.viewer.pk)
         self.assertEqual(self.viewer.email,new_email)
 
+    def test_favourites_list_checks_permissions_for_the_whole_page(self):
+        self.login_editor()
+        visible = models.ObjectClass.objects.create(name="Visible favourite", definition="Visible", workgroup=self.wg1)
+        hidden = models.ObjectClass.objects.create(name="Hidden favourite", definition="Hidden", workgroup=self.wg2)
+        self.editor.profile.favourites.add(visible, hidden)
+
+        response = self.client.get(reverse('aristotle:userFavourites'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['viewable'], set([visible.pk]))
+        self.assertContains(response, visible.name)
+        self.assertNotContains(response, hidden.name)
+
     def test_viewer_can_access_homepages(self):
         self.login_viewer()
         self.check_generic_pages()
@@ -2,8 +2,11 @@ from __future__ import print_function
 from django.contrib.auth.models import User
 from django.test import TestCase, TransactionTestCase
 from django.test.utils import setup_test_environment
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
+import datetime
+
 from model_utils import Choices
 
 import aristotle_mdr.models as models
@@ -194,3 +197,251 @@ class CustomConceptQuerySetTest_RegistrationOwned_Slow(CustomConceptQuerySetTest
 
 class CustomConceptQuerySetTest_RegistryOwned_Slow(CustomConceptQuerySetTest_Slow, TransactionTestCase):
     workgroup_owner_type = models.WORKGROUP_OWNERSHIP.authority
+
+
+class VisibilityGrantTest(TestCase):
+    def setUp(self):
+        self.ra = models.RegistrationAuthority.objects.create(name="Test RA")
+        self.other_ra = models.RegistrationAuthority.objects.create(name="Other RA")
+        self.wg = models.Workgroup.objects.create(name="Test WG")
+        self.registrar = User.objects.create_user('reggie', '', 'registrar')
+        self.viewer = User.objects.create_user('vicky', '', 'viewer')
+        self.ra.registrars.add(self.registrar)
+        self.wg.viewers.add(self.viewer)
+        self.item = models.ObjectClass.objects.create(name="OC1", workgroup=self.wg)
+        self.ready = models.ObjectClass.objects.create(name="OC2", workgroup=self.wg, readyToReview=True)
+
+    def assertVisibleMatchesPermissions(self):
+        for user in [self.registrar, self.viewer]:
+            visible = set(models.ObjectClass.objects.visible(user))
+            for item in models.ObjectClass.objects.all():
+                self.assertEqual(item in visible, perms.user_can_view(user, item))
+
+    def test_grants_follow_changes(self):
+        self.assertVisibleMatchesPermissions()
+        self.assertEqual(models.ObjectClass.objects.visible(self.registrar).count(), 0)
+
+        self.wg.registrationAuthorities.add(self.ra, self.other_ra)
+        self.assertVisibleMatchesPermissions()
+        self.assertEqual(list(models.ObjectClass.objects.visible(self.registrar)), [self.ready])
+
+        models.Status.objects.create(
+            concept=self.item,
+            registrationAuthority=self.ra,
+            registrationDate=timezone.now().date(),
+            state=self.ra.locked_state
+        )
+        self.assertVisibleMatchesPermissions()
+        self.assertEqual(models.ObjectClass.objects.visible(self.registrar).count(), 2)
+
+        self.ra.workgroups.clear()
+        self.assertVisibleMatchesPermissions()
+        self.assertEqual(list(models.ObjectClass.objects.visible(self.registrar)), [self.item])
+
+        self.ready.delete()
+        self.assertFalse(models.VisibilityGrant.objects.filter(concept_id=self.ready.pk).exists())
+
+    def test_rebuild_command(self):
+        from django.core.management import call_command
+        self.wg.registrationAuthorities.add(self.ra)
+        expected = set(models.VisibilityGrant.objects.values_list('concept', 'workgroup', 'registrationAuthority'))
+        models.VisibilityGrant.objects.all().delete()
+        self.assertEqual(models.ObjectClass.objects.visible(self.viewer).count(), 0)
+
+        call_command('rebuild_visibility_grants', batch_size=1, verbosity=0)
+        self.assertEqual(
+            set(models.VisibilityGrant.objects.values_list('concept', 'workgroup', 'registrationAuthority')),
+            expected
+        )
+        self.assertVisibleMatchesPermissions()
+
+
+class BulkRecacheStatesTest(TestCase):
+    def setUp(self):
+        self.ra = models.RegistrationAuthority.objects.create(name="Test RA")
+        self.other_ra = models.RegistrationAuthority.objects.create(name="Other RA")
+        self.wg = models.Workgroup.objects.create(name="Test WG")
+        self.wg.registrationAuthorities.add(self.ra)
+        self.registry_wg = models.Workgroup.objects.create(name="Test WG", ownership=models.WORKGROUP_OWNERSHIP.registry)
+        self.items = []
+        for wg in [self.wg, self.registry_wg]:
+            for ra in [self.ra, self.other_ra]:
+                for state in [models.STATES.candidate, models.STATES.standard]:
+                    item = models.ObjectClass.objects.create(name="OC", workgroup=wg)
+                    models.Status.objects.create(
+                        concept=item, registrationAuthority=ra, state=state,
+                        registrationDate=datetime.date(2009, 4, 28)
+                    )
+                    self.items.append(item)
+        # An older status that has since been superseded
+        models.Status.objects.create(
+            concept=self.items[0], registrationAuthority=self.ra, state=models.STATES.standard,
+            registrationDate=datetime.date(2008, 4, 28)
+        )
+
+    def assertStatesAreCorrect(self):
+        for item in models._concept.objects.filter(pk__in=[i.pk for i in self.items]):
+            self.assertEqual(item._is_public, item.check_is_public())
+            self.assertEqual(item._is_locked, item.check_is_locked())
+
+    def test_recache_states_in_bulk(self):
+        self.assertStatesAreCorrect()
+        self.assertEqual(models._concept.objects.all().recache_states(), [])
+
+        # Change the authorities states without sending signals.
+        models.RegistrationAuthority.objects.filter(pk=self.ra.pk).update(
+            public_state=models.STATES.standard,
+            locked_state=models.STATES.standard,
+        )
+        items = models._concept.objects.filter(pk__in=[i.pk for i in self.items])
+        would_change = items.recache_states(dry_run=True)
+        self.assertTrue(len(would_change) > 0)
+        self.assertEqual(items.recache_states(dry_run=True), would_change)
+
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        with CaptureQueriesContext(connection) as queries:
+            changed = items.recache_states()
+        # Five queries to work out the states, and at most one update for
+        # each combination of public and locked.
+        self.assertTrue(len(queries) <= 5 + 4)
+        self.assertEqual(sorted(changed), sorted(would_change))
+        self.assertStatesAreCorrect()
+        self.assertEqual(items.recache_states(), [])
+
+
+class CurrentStatusesTest(TestCase):
+    def setUp(self):
+        self.ra = models.RegistrationAuthority.objects.create(name="Test RA")
+        self.other_ra = models.RegistrationAuthority.objects.create(name="Other RA")
+        self.wg = models.Workgroup.objects.create(name="Test WG")
+        self.items = [models.ObjectClass.objects.create(name="OC%s" % i, workgroup=self.wg) for i in range(3)]
+
+        def status(item, ra, state, date, until=None):
+            return models.Status.objects.create(
+                concept=item, registrationAuthority=ra, state=state,
+                registrationDate=date, until_date=until
+            )
+        self.expected = {
+            self.items[0].pk: [
+                status(self.items[0], self.ra, models.STATES.standard, datetime.date(2010, 1, 1)),
+                status(self.items[0], self.other_ra, models.STATES.candidate, datetime.date(2010, 1, 1)),
+            ],
+            self.items[1].pk: [],
+            self.items[2].pk: [],
+        }
+        # Expired statuses are only current before they expire.
+        status(self.items[1], self.ra, models.STATES.retired, datetime.date(2009, 1, 1), until=datetime.date(2010, 1, 1))
+        # Superseded and future statuses aren't current today.
+        status(self.items[0], self.ra, models.STATES.candidate, datetime.date(2009, 1, 1))
+        status(self.items[2], self.ra, models.STATES.candidate, datetime.date(2999, 1, 1))
+        # On the same date, the most recently created status wins.
+        status(self.items[0], self.other_ra, models.STATES.incomplete, datetime.date(2010, 1, 1))
+        self.expected[self.items[0].pk][1] = models.Status.objects.order_by('-pk').first()
+
+    def test_current_statuses(self):
+        for item in self.items:
+            self.assertEqual(
+                sorted(s.pk for s in item.current_statuses()),
+                sorted(s.pk for s in self.expected[item.pk])
+            )
+        self.assertEqual(
+            [s.state for s in self.items[1].current_statuses(when=datetime.date(2009, 6, 1))],
+            [models.STATES.retired]
+        )
+
+    def test_with_current_statuses(self):
+        with self.assertNumQueries(2):
+            items = list(models.ObjectClass.objects.filter(workgroup=self.wg).with_current_statuses())
+            for item in items:
+                self.assertEqual(
+                    sorted(s.pk for s in item.current_status_list),
+                    sorted(s.pk for s in self.expected[item.pk])
+                )
+                for s in item.current_status_list:
+                    self.assertTrue(s.registrationAuthority.name)
+        # Explicitly asking for the current statuses is always a fresh queryset
+        self.assertEqual(
+            sorted(s.pk for s in items[0].current_statuses()),
+            sorted(s.pk for s in self.expected[items[0].pk])
+        )
+        self.assertTrue(isinstance(items[0].current_statuses(), models.StatusQuerySet))
+
+
+class ConcreteTypeTest(TestCase):
+    def setUp(self):
+        from django.contrib.contenttypes.models import ContentType
+        self.wg = models.Workgroup.objects.create(name="Test WG")
+        self.oc = models.ObjectClass.objects.create(name="OC", definition="OC", workgroup=self.wg)
+        self.pr = models.Property.objects.create(name="Prop", definition="Prop", workgroup=self.wg)
+        self.de = models.DataElement.objects.create(name="DE", definition="DE", workgroup=self.wg)
+        self.oc_type = ContentType.objects.get_for_model(models.ObjectClass)
+        # Make sure the content types are cached before counting queries.
+        ContentType.objects.get_for_models(models.Property, models.DataElement)
+
+    def test_concrete_type_is_stored_on_save(self):
+        concept = models._concept.objects.get(pk=self.oc.pk)
+        self.assertEqual(concept._concrete_type, self.oc_type)
+
+    def test_item_only_queries_its_own_type(self):
+        concept = models._concept.objects.get(pk=self.oc.pk)
+        with self.assertNumQueries(1):
+            item = concept.item
+        self.assertEqual(type(item), models.ObjectClass)
+        self.assertEqual(item.pk, self.oc.pk)
+        with self.assertNumQueries(0):
+            self.assertTrue(item.item is item)
+
+    def test_resolve_subclasses_runs_one_query_per_type(self):
+        concepts = models._concept.objects.filter(
+            pk__in=[self.oc.pk, self.pr.pk, self.de.pk]
+        ).order_by('-pk')
+        with self.assertNumQueries(4):
+            items = concepts.resolve_subclasses()
+        self.assertEqual([type(i) for i in items], [models.DataElement, models.Property, models.ObjectClass])
+        self.assertEqual([i.pk for i in items], [self.de.pk, self.pr.pk, self.oc.pk])
+
+    def test_items_without_a_type_fall_back_and_store_it(self):
+        models._concept.objects.filter(pk=self.oc.pk).update(_concrete_type=None)
+        concept = models._concept.objects.get(pk=self.oc.pk)
+        self.assertEqual(type(concept.item), models.ObjectClass)
+        self.assertEqual(models._concept.objects.get(pk=self.oc.pk)._concrete_type, self.oc_type)
+
+        models._concept.objects.filter(pk=self.oc.pk).update(_concrete_type=None)
+        items = models._concept.objects.filter(pk__in=[self.oc.pk, self.pr.pk]).order_by('pk').resolve_subclasses()
+        self.assertEqual([type(i) for i in items], [models.ObjectClass, models.Property])
+        self.assertEqual(models._concept.objects.get(pk=self.oc.pk)._concrete_type, self.oc_type)
+
+    def test_saving_a_bare_concept_stores_its_real_type(self):
+        from django.contrib.contenttypes.models import ContentType
+        models._concept.objects.filter(pk=self.oc.pk).update(_concrete_type=None)
+        # Adding a status saves the item as a bare _concept.
+        ra = models.RegistrationAuthority.objects.create(name="Test RA")
+        models.Status.objects.create(
+            concept=self.oc, registrationAuthority=ra, state=ra.public_state, registrationDate="2014-10-27"
+        )
+        self.assertEqual(models._concept.objects.get(pk=self.oc.pk)._concrete_type, self.oc_type)
+
+        # A type stored wrongly for a bare _concept is looked up again.
+        bare_type = ContentType.objects.get_for_model(models._concept)
+        models._concept.objects.filter(pk=self.oc.pk).update(_concrete_type=bare_type)
+        self.assertEqual(type(models._concept.objects.get(pk=self.oc.pk).item), models.ObjectClass)
+        self.assertEqual(models._concept.objects.get(pk=self.oc.pk)._concrete_type, self.oc_type)
+
+    def test_missing_types_are_stored_after_migrating(self):
+        from django.contrib.contenttypes.models import ContentType
+        from django.core.management import call_command
+        models._concept.objects.filter(pk__in=[self.oc.pk, self.pr.pk]).update(_concrete_type=None)
+        bare_type = ContentType.objects.get_for_model(models._concept)
+        models._concept.objects.filter(pk=self.de.pk).update(_concrete_type=bare_type)
+
+        self.assertEqual(models.store_missing_concrete_types(batch_size=2), 3)
+        types = dict(models._concept.objects.values_list('pk', '_concrete_type'))
+        self.assertEqual(types[self.oc.pk], self.oc_type.pk)
+        self.assertEqual(types[self.pr.pk], ContentType.objects.get_for_model(models.Property).pk)
+        self.assertEqual(types[self.de.pk], ContentType.objects.get_for_model(models.DataElement).pk)
+
+        models._concept.objects.filter(pk=self.oc.pk).update(_concrete_type=None)
+        call_command('migrate', interactive=False, verbosity=0)
+        self.assertEqual(models._concept.objects.get(pk=self.oc.pk)._concrete_type, self.oc_type)
+
@@ -1,5 +1,6 @@
 import os
 import sys
+import tempfile
 from aristotle_mdr.required_settings import *
 
 BASE = os.path.dirname(os.path.dirname(__file__))
@@ -86,6 +87,10 @@ PASSWORD_HASHERS = (
 )
 
 ARISTOTLE_SETTINGS['SEPARATORS']['DataElementConcept'] = '--'
+# The in-memory test database can't be shared with a background thread.
+ARISTOTLE_SETTINGS['DEFERRED_TASK_MODE'] = 'inline'
+# Downloads are rendered by those inline tasks, into a cache that is thrown away.
+ARISTOTLE_SETTINGS['DOWNLOAD_CACHE_DIR'] = tempfile.mkdtemp()
 ARISTOTLE_SETTINGS['CONTENT_EXTENSIONS'] = ARISTOTLE_SETTINGS['CONTENT_EXTENSIONS'] + ['extension_test']
 ARISTOTLE_DOWNLOADS = ARISTOTLE_DOWNLOADS + [
     ('txt', 'Text', 'fa-file-pdf-o', 'text_download_test'),
@@ -59,7 +59,9 @@ urlpatterns = patterns(
     url(r'^create/(?P<app_label>.+)/(?P<model_name>.+)/?$', views.wizards.create_item, name='createItem'),
     url(r'^create/(?P<model_name>.+)/?$', views.wizards.create_item, name='createItem'),
 
+    url(r'^download/bundle/(?P<downloadType>[a-zA-Z0-9\-\.]+)/?$', views.download_bundle, name='download_bundle'),
     url(r'^download/(?P<downloadType>[a-zA-Z0-9\-\.]+)/(?P<iid>\d+)/?$', views.download, name='download'),
+    url(r'^export/(?P<export_format>csv|json)/?$', views.bulk_export, name='bulk_export'),
 
     url(r'^action/supersede/(?P<iid>\d+)$', views.supersede, name='supersede'),
     url(r'^action/deprecate/(?P<iid>\d+)$', views.deprecate, name='deprecate'),
@@ -1,10 +1,17 @@
 from django.core.urlresolvers import reverse
 from django.core.cache import cache
 from django.forms import model_to_dict
+from django.http import HttpResponseNotModified
 from django.template.defaultfilters import slugify
+from django.utils.http import http_date, parse_etags, quote_etag
 from django.utils.text import get_text_list
 from django.utils.encoding import force_text
-from django.utils.translation import ugettext as _
+from django.utils.translation import get_language, ugettext as _
+
+from functools import wraps
+import calendar
+import hashlib
+import inspect
 
 
 def concept_to_dict(obj):
@@ -35,6 +42,54 @@ def concept_to_clone_dict(obj):
     return clone_dict
 
 
+def get_status_changes(concept_id):
+    """
+    Returns when the statuses of an item were last changed, and how many
+    there are, so that removed statuses are noticed too.
+    """
+    from django.db.models import Count, Max
+    from aristotle_mdr.models import Status
+    statuses = Status.objects.filter(concept=concept_id).aggregate(last_modified=Max('modified'), count=Count('pk'))
+    return statuses['last_modified'], statuses['count']
+
+
+def get_item_version(item):
+    """
+    Returns a string that changes whenever an item or any of its statuses
+    change, for use in cache keys.
+    """
+    last_modified, count = get_status_changes(item.pk)
+    return '%s|%s|%s' % (
+        item.modified.isoformat(),
+        last_modified.isoformat() if last_modified else '',
+        count,
+    )
+
+
+def get_download_items_changes(sub_items):
+    """
+    Returns when each set of items included in a download, as returned by
+    ``get_download_items``, was last changed and how many items are in it.
+    """
+    from django.db.models import Count, Max
+    changes = []
+    for model, items in sub_items:
+        items = items.aggregate(last_modified=Max('modified'), count=Count('pk'))
+        changes.append((items['last_modified'], items['count']))
+    return changes
+
+
+def get_download_items_version(sub_items):
+    """
+    Returns a string that changes whenever any of the items included in a
+    download change or are added or removed, for use in cache keys.
+    """
+    return '|'.join(
+        '%s|%s' % (last_modified.isoformat() if last_modified else '', count)
+        for last_modified, count in get_download_items_changes(sub_items)
+    )
+
+
 def get_download_template_path_for_item(item, downloadType, subpath=''):
     app_label = item._meta.app_label
     model_name = item._meta.model_name
@@ -111,6 +166,90 @@ def get_concepts_for_apps(app_labels):
 
 
 # "There are only two hard problems in Computer Science: cache invalidation, naming things and off-by-one errors"
+def item_conditional_get(anonymous_only=False, download_items=False):
+    """
+    Adds ``ETag`` and ``Last-Modified`` headers to successful responses of a
+    view of a single item, and returns ``304 Not Modified`` without calling the
+    view when the client sends the current ``ETag`` in ``If-None-Match``.
+
+    The validators are worked out from the item's modified time, its
+    statuses, the permission generations of the user and item, the user, their
+    language and the requested URL, in a few small queries. ``Last-Modified``
+    only reflects the modified times, so ``If-Modified-Since`` alone is never
+    answered with a ``304``. As with ``Last-Modified`` headers in general, changes to related items aren't noticed until the
+    item itself changes, unless ``download_items`` is set, in which case the
+    items returned by the item's ``get_download_items`` are checked too.
+
+    A ``304`` is only sent if the user may still see the item, using the
+    ``condition`` the view is called with or ``user_can_view``. Otherwise the
+    view is called so it can refuse the request as it always does, and the
+    response doesn't reveal whether the item exists.
+
+    Pages that show things about the logged in user, such as their unread
+    notifications, should set ``anonymous_only`` so only anonymous requests
+    are answered from the client's copy.
+    """
+    def decorator(function):
+        @wraps(function)
+        def apply_conditional_get(request, *args, **kwargs):
+            iid = kwargs.get('iid')
+            if iid is None or request.method not in ('GET', 'HEAD'):
+                return function(request, *args, **kwargs)
+            if anonymous_only and not request.user.is_anonymous():
+                return function(request, *args, **kwargs)
+
+            from aristotle_mdr import perms
+            from aristotle_mdr.models import _concept
+            concepts = _concept.objects.filter(pk=iid)
+            if download_items:
+                concepts = concepts.select_subclasses()
+            concept = concepts.first()
+            if concept is None:
+                return function(request, *args, **kwargs)
+            condition = inspect.getcallargs(function, request, *args, **kwargs).get('condition', perms.user_can_view)
+            if not condition(request.user, concept):
+                return function(request, *args, **kwargs)
+
+            status_modified, status_count = get_status_changes(iid)
+            last_modified = max(filter(None, [concept.modified, status_modified]))
+            validators = [
+                function.__name__,
+                request.get_full_path(),
+                str(request.user.pk or 'anonymous'),
+                get_language() or '',
+                concept.modified.isoformat(),
+                str(status_modified),
+                str(status_count),
+                perms.get_permission_stamp(request.user, iid, concept.workgroup_id),
+            ]
+            if download_items:
+                for items_modified, items_count in get_download_items_changes(concept.get_download_items()):
+                    validators.extend([str(items_modified), str(items_count)])
+                    last_modified = max(filter(None, [last_modified, items_modified]))
+            last_modified = calendar.timegm(last_modified.utctimetuple())
+            etag = hashlib.sha1('|'.join(validators).encode('utf-8')).hexdigest()
+
+            # Only the ETag covers everything the response depends on, so an
+            # If-Modified-Since header on its own never gets a 304.
+            try:
+                not_modified = etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+            except ValueError:
+                not_modified = False
+            if not_modified:
+                response = HttpResponseNotModified()
+            else:
+                response = function(request, *args, **kwargs)
+                # Only successful responses are worth keeping, not pages that
+                # say a download is still being prepared or redirects.
+                if response.status_code != 200:
+                    return response
+            response['ETag'] = quote_etag(etag)
+            response['Last-Modified'] = http_date(last_modified)
+            return response
+        return apply_conditional_get
+    return decorator
+
+
 def cache_per_item_user(ttl=None, prefix=None, cache_post=False):
     '''
     Modified from: https://djangosnippets.org/snippets/2524/
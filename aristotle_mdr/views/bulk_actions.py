@@ -5,6 +5,7 @@ from django.conf import settings
 from django.core.exceptions import PermissionDenied, ImproperlyConfigured
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.core.urlresolvers import reverse
+from django.db import transaction
 from django.http import HttpResponse, Http404, HttpResponseRedirect
 from django.shortcuts import render, redirect, get_object_or_404
 from django.template import RequestContext, TemplateDoesNotExist
@@ -20,6 +21,7 @@ from reversion.revisions import default_revision_manager
 
 from aristotle_mdr.perms import user_can_view, user_can_edit, user_can_change_status
 from aristotle_mdr import perms
+from aristotle_mdr.models import deferred_recache
 from aristotle_mdr.utils import cache_per_item_user, concept_to_dict, construct_change_message, url_slugify_concept
 from aristotle_mdr import forms as MDRForms
 from aristotle_mdr import exceptions as registry_exceptions
@@ -44,7 +46,8 @@ def bulk_action(request):
             # if there is no confirm page or extra details required, do the action and redirect
             form = action_form(request.POST, user=request.user)  # A form bound to the POST data
             if form.is_valid():
-                message = form.make_changes()
+                with transaction.atomic(), deferred_recache():
+                    message = form.make_changes()
                 messages.add_message(request, messages.INFO, message)
             else:
                 messages.add_message(request, messages.ERROR, form.errors)
@@ -62,7 +65,8 @@ def bulk_action(request):
                 form = action_form(request.POST, user=request.user, items=items)  # A form bound to the POST data
                 # there was an error with the form redisplay
                 if form.is_valid():
-                    message = form.make_changes()
+                    with transaction.atomic(), deferred_recache():
+                        message = form.make_changes()
                     messages.add_message(request, messages.INFO, message)
                     return HttpResponseRedirect(url)
             else:
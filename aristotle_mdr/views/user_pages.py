@@ -211,7 +211,7 @@ def edit(request):
 
 @login_required
 def favourites(request):
-    items = request.user.profile.favourites.select_subclasses()
+    items = request.user.profile.favourites.all()
     context = {
         'help': request.GET.get("help", False),
         'favourite': request.GET.get("favourite", False)
@@ -231,8 +231,10 @@ def registrar_tools(request):
 def review_list(request):
     if not request.user.profile.is_registrar:
         raise PermissionDenied
-    items = MDR._concept.objects.visible(request.user).filter(readyToReview=True, statuses=None).select_subclasses()
-    return paginated_list(request, items, "aristotle_mdr/user/userReadyForReview.html", {'items': items})
+    items = MDR._concept.objects.visible(request.user).filter(readyToReview=True, statuses=None)
+    # The page is resolved to subclasses by paginated_list, the full list is
+    # only given for templates that want it and isn't evaluated otherwise.
+    return paginated_list(request, items, "aristotle_mdr/user/userReadyForReview.html", {'items': items.select_subclasses()})
 
 
 @login_required
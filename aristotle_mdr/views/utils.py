@@ -5,6 +5,8 @@ from django.core.urlresolvers import reverse
 from django.db.models import Count
 from django.shortcuts import render
 
+from aristotle_mdr.models import resolve_subclasses
+
 
 paginate_sort_opts = {
     "mod_asc": "modified",
@@ -16,7 +18,6 @@ paginate_sort_opts = {
 
 @login_required
 def paginated_list(request, items, template, extra_context={}):
-    items = items.select_subclasses()
     sort_by=request.GET.get('sort', "mod_desc")
     if sort_by not in paginate_sort_opts.keys():
         sort_by="mod_desc"
@@ -35,6 +36,7 @@ def paginated_list(request, items, template, extra_context={}):
     except EmptyPage:
         # If page is out of range (e.g. 9999), deliver last page of results.
         items = paginator.page(paginator.num_pages)
+    items.object_list = resolve_subclasses(items.object_list)
     context = {
         'sort': sort_by,
         'page': items,
@@ -7,7 +7,7 @@ from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.core.urlresolvers import reverse
 from django.db import transaction
 from django.forms.models import modelformset_factory
-from django.http import HttpResponse, Http404, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseBadRequest, Http404, HttpResponseRedirect, StreamingHttpResponse
 from django.shortcuts import render, redirect, get_object_or_404
 from django.template import RequestContext, TemplateDoesNotExist
 from django.template.defaultfilters import slugify
@@ -22,13 +22,14 @@ import reversion
 from reversion.revisions import default_revision_manager
 from reversion_compare.views import HistoryCompareDetailView
 
-from aristotle_mdr.perms import user_can_view, user_can_edit, user_can_change_status
+from aristotle_mdr.perms import user_can_view, user_can_edit, user_can_edit_many, user_can_change_status
 from aristotle_mdr import perms
-from aristotle_mdr.utils import cache_per_item_user, concept_to_dict, construct_change_message, url_slugify_concept
+from aristotle_mdr.utils import cache_per_item_user, concept_to_dict, construct_change_message, item_conditional_get, url_slugify_concept
 from aristotle_mdr import forms as MDRForms
 from aristotle_mdr import models as MDR
 from aristotle_mdr.utils import concept_to_clone_dict, get_concepts_for_apps
 from aristotle_mdr import exceptions as registry_exceptions
+from aristotle_mdr import downloads
 
 from haystack.views import SearchView, FacetedSearchView
 
@@ -86,6 +87,7 @@ def render_if_user_can_edit(item_type, request, *args, **kwargs):
     return render_if_condition_met(request, user_can_edit, item_type, *args, **kwargs)
 
 
+@item_conditional_get(download_items=True)
 def download(request, downloadType, iid=None):
     """
     By default, ``aristotle_mdr.views.download`` is called whenever a URL matches
@@ -95,8 +97,8 @@ def download(request, downloadType, iid=None):
 
     This is passed into ``download`` which resolves the item id (``iid``), and
     determins if a user has permission to view the request item with that id. If
-    a user is allowed to download this file, ``download`` iterates through each
-    download type defined in ``ARISTOTLE_DOWNLOADS``.
+    a user is allowed to download this file, ``download`` looks up the download
+    type in the download types defined in ``ARISTOTLE_DOWNLOADS``.
 
     A download option tuple takes the following form form::
 
@@ -116,14 +118,18 @@ def download(request, downloadType, iid=None):
     Where a ``file_type`` multiple is defined multiple times, **the last matching
     instance in the tuple is used**.
 
-    Next, the module that is defined for a ``file_type`` is dynamically imported using
-    ``exec``, and is wrapped in a ``try: except`` block to catch any exceptions. If
-    the ``module_name`` does not match the regex ``^[a-zA-Z0-9\_]+$`` ``download``
-    raises an exception.
+    The download modules are imported once, when the registry starts, by
+    ``aristotle_mdr.downloads``. If a ``file_type`` doesn't match the regex
+    ``^[a-zA-Z0-9\-\.]+$``, the ``module_name`` doesn't match the regex
+    ``^[a-zA-Z0-9\_]+$`` or ``downloader.py`` can't be imported from the module,
+    the registry raises an exception then.
 
-    If the module is able to be imported, ``downloader.py`` from the given module
-    is imported, this file **MUST** have a ``download`` function defined which returns
-    a Django ``HttpResponse`` object of some form.
+    ``downloader.py`` in the given module **MUST** have a ``download`` function
+    defined which returns a Django ``HttpResponse`` object of some form.
+
+    Successful downloads are sent with ``ETag`` and ``Last-Modified`` headers,
+    so clients that already have the current download are sent a
+    ``304 Not Modified`` response instead of it being produced again.
     """
     item = MDR._concept.objects.get_subclass(pk=iid)
     item = get_if_user_can_view(item.__class__, request.user, iid)
@@ -133,29 +139,76 @@ def download(request, downloadType, iid=None):
         else:
             raise PermissionDenied
 
-    downloadOpts = getattr(settings, 'ARISTOTLE_DOWNLOADS', "")
-    module_name = ""
-    for d in downloadOpts:
-        dt = d[0]
-        if dt == downloadType:
-            module_name = d[3]
-    if module_name:
-        import re
-        if not re.search('^[a-zA-Z0-9\-\.]+$', downloadType):  # pragma: no cover
-            # Invalid downloadType
-            raise registry_exceptions.BadDownloadTypeAbbreviation("Download type can only be composed of letters, numbers, hyphens or periods.")
-        elif not re.search('^[a-zA-Z0-9\_]+$', module_name):  # pragma: no cover
-            # bad module_name
-            raise registry_exceptions.BadDownloadModuleName("Download name isn't a valid Python module name.")
+    downloader = downloads.get_downloader(downloadType)
+    if downloader is None:
+        raise Http404
+    try:
+        return downloader(request, item)
+    except TemplateDoesNotExist:
+        raise Http404
+
+
+def download_bundle(request, downloadType):
+    """
+    Streams a zip archive of the downloads of many items in one format. The
+    items are given as one or more ``items`` parameters of item ids, or
+    otherwise are the results of a search using the same parameters as the
+    search page. Only items the user can view, and that can be downloaded in
+    the requested format, are included, up to ``BUNDLE_MAX_ITEMS`` items.
+
+    Entries are added to the archive as each download is ready, so download
+    modules that render in parallel, like the built-in PDF download, can send
+    the first files while later ones are still being rendered.
+    """
+    downloader = downloads.get_downloader(downloadType)
+    if downloader is None:
+        raise Http404
+    max_items = getattr(settings, 'ARISTOTLE_SETTINGS', {}).get('BUNDLE_MAX_ITEMS', 100)
+
+    if 'items' in request.GET:
         try:
-            downloader = None
-            # dangerous - we are really trusting the settings creators here.
-            exec("import %s.downloader as downloader" % module_name)
-            return downloader.download(request, downloadType, item)
-        except TemplateDoesNotExist:
-            raise Http404
+            ids = [int(iid) for value in request.GET.getlist('items') for iid in value.split(',') if iid]
+        except ValueError:
+            return HttpResponseBadRequest('Item ids must be numbers')
+    else:
+        form = MDRForms.search.PermissionSearchForm(request.GET)
+        form.request = request
+        ids = [int(result.pk) for result in form.search(repeat_search=True)[:max_items]]
+    ids = ids[:max_items]
+
+    items = MDR._concept.objects.visible(request.user).filter(pk__in=ids).resolve_subclasses()
+    items.sort(key=lambda item: ids.index(item.pk))
+
+    response = StreamingHttpResponse(
+        downloads.zip_stream(downloader.bundle_entries(request, items)),
+        content_type='application/zip'
+    )
+    response['Content-Disposition'] = 'attachment; filename="%s-bundle.zip"' % downloadType
+    return response
+
 
-    raise Http404
+def bulk_export(request, export_format):
+    """
+    Streams every item the user can view as CSV or newline-delimited JSON,
+    with its workgroup and current statuses. The items can be limited to
+    certain types by giving one or more ``type`` parameters of the form
+    ``app_label.model_name``.
+    """
+    from aristotle_mdr import exporter
+    if export_format not in exporter.EXPORT_FORMATS:
+        raise Http404
+    items = MDR._concept.objects.visible(request.user)
+    try:
+        items = exporter.filter_types(items, request.GET.getlist('type'))
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
+    response = StreamingHttpResponse(
+        exporter.export(items, export_format),
+        content_type=exporter.EXPORT_FORMATS[export_format]
+    )
+    response['Content-Disposition'] = 'attachment; filename="registry.%s"' % export_format
+    return response
 
 
 def concept(*args, **kwargs):
@@ -179,7 +232,7 @@ def measure(request, iid, model_slug, name_slug):
     # return render_if_user_can_view(MDR.Measure, *args, **kwargs)
 
 
-@cache_per_item_user(ttl=300, cache_post=False)
+@item_conditional_get(anonymous_only=True)
 def render_if_condition_met(request, condition, objtype, iid, model_slug=None, name_slug=None, subpage=None):
     item = get_object_or_404(objtype, pk=iid).item
     if item._meta.model_name != model_slug or not slugify(item.name).startswith(str(name_slug)):
@@ -193,10 +246,12 @@ def render_if_condition_met(request, condition, objtype, iid, model_slug=None, n
     # We add a user_can_edit flag in addition to others as we have odd rules around who can edit objects.
     isFavourite = request.user.is_authenticated() and request.user.profile.is_favourite(item)
 
-    last_edit = default_revision_manager.get_for_object_reference(
-        item.__class__,
-        item.pk,
-    ).first()
+    def last_edit():
+        # Only looked up if the cached body of the page has to be rendered.
+        return default_revision_manager.get_for_object_reference(
+            item.__class__,
+            item.pk,
+        ).first()
 
     default_template = "%s/concepts/%s.html" % (item.__class__._meta.app_label, item.__class__._meta.model_name)
     template = select_template([default_template, item.template])
@@ -213,6 +268,7 @@ def render_if_condition_met(request, condition, objtype, iid, model_slug=None, n
     return HttpResponse(template.render(context))
 
 
+@item_conditional_get(anonymous_only=True)
 def registrationHistory(request, iid):
     item = get_if_user_can_view(MDR._concept, request.user, iid)
     if not item:
@@ -475,11 +531,14 @@ def deprecate(request, iid):
             #    or wasn't superseded and is staying that way.
             with transaction.atomic(), reversion.revisions.create_revision():
                 reversion.revisions.set_user(request.user)
-                for i in item.supersedes.all():
-                    if i not in form.cleaned_data['olderItems'] and user_can_edit(request.user, i):
+                superseded = list(item.supersedes.all())
+                olderItems = list(form.cleaned_data['olderItems'])
+                can_edit = user_can_edit_many(request.user, superseded + olderItems)
+                for i in superseded:
+                    if i not in olderItems and can_edit[i.id]:
                         item.supersedes.remove(i)
-                for i in form.cleaned_data['olderItems']:
-                    if user_can_edit(request.user, i):  # Would check item.supersedes but its a set
+                for i in olderItems:
+                    if can_edit[i.id]:  # Would check item.supersedes but its a set
                         item.supersedes.add(i)
             return HttpResponseRedirect(url_slugify_concept(item))
     else:
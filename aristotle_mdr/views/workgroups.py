@@ -20,7 +20,7 @@ def workgroup(request, iid, name_slug):
     if not user_in_workgroup(request.user, wg):
         raise PermissionDenied
     renderDict = {"item": wg, "workgroup": wg, "user_is_admin": user_is_workgroup_manager(request.user, wg)}
-    renderDict['recent'] = MDR._concept.objects.filter(workgroup=iid).select_subclasses().order_by('-modified')[:5]
+    renderDict['recent'] = MDR._concept.objects.filter(workgroup=iid).order_by('-modified')[:5].resolve_subclasses()
     page = render(request, wg.template, renderDict)
     return page
 
@@ -30,7 +30,7 @@ def items(request, iid):
     wg = get_object_or_404(MDR.Workgroup, pk=iid)
     if not user_in_workgroup(request.user, wg):
         raise PermissionDenied
-    items = MDR._concept.objects.filter(workgroup=iid).select_subclasses()
+    items = MDR._concept.objects.filter(workgroup=iid)
     context = {"item": wg, "workgroup": wg, "user_is_admin": user_is_workgroup_manager(request.user, wg)}
     return paginated_list(request, items, "aristotle_mdr/workgroupItems.html", context)
 